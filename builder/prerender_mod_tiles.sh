@@ -2,17 +2,36 @@
 
 MOD_TILE_CONTAINER=lifemap-mod_tile
 PRERENDER_THREADS=7
+# Maps and maximum zoom of back/mod_tile_deepzoom/renderd.conf
+MAPS="default retina onlylabels nolabels"
+MAX_ZOOM=40
 
 # Kill render_list-
 echo "- KILL RENDER LIST"
 docker exec -t $MOD_TILE_CONTAINER killall render_list
 
-# Remove ALL old tiles
-echo "- REMOVE OLD TILES"
-docker exec -t $MOD_TILE_CONTAINER sh -c "rm -r /var/lib/mod_tile/*"
+# XYZexpired lists the metatiles covered by the nodes changed since the
+# previous build, at all the zooms at which they are drawn. Only these tiles
+# are removed, unless --full is given or the builder did not write the list
+# (first build, or too many changes), in which case all tiles are removed.
+if [ "$1" != "--full" ] && docker exec $MOD_TILE_CONTAINER test -f /opt/build_results/XYZexpired; then
+    echo "- REMOVE EXPIRED TILES"
+    # Each zoom is expired separately so that render_expired does not
+    # expire the ancestors of the listed tiles
+    docker exec -t $MOD_TILE_CONTAINER sh -c "
+        for zoom in \$(seq 0 $MAX_ZOOM); do
+            for map in $MAPS; do
+                grep \"^\$zoom/\" /opt/build_results/XYZexpired | /opt/mod_tile/render_expired --map=\$map --min-zoom=\$zoom --max-zoom=\$zoom --delete-from=0 >> /opt/build_results/tilerenderer.log
+            done
+        done"
+else
+    # Remove ALL old tiles
+    echo "- REMOVE OLD TILES"
+    docker exec -t $MOD_TILE_CONTAINER sh -c "rm -r /var/lib/mod_tile/*"
+fi
 
 
-# Compute tiles for the 5 first zoom levels on 7 threads
+# Compute the missing tiles of the list on 7 threads
 echo "- PRERENDER TILES"
 docker exec -t $MOD_TILE_CONTAINER sh -c "/opt/mod_tile/render_list -n $PRERENDER_THREADS < /opt/build_results/XYZcoordinates >> /opt/build_results/tilerenderer.log"
 docker exec -t $MOD_TILE_CONTAINER sh -c "/opt/mod_tile/render_list -m onlylabels -n $PRERENDER_THREADS < /opt/build_results/XYZcoordinates >> /opt/build_results/tilerenderer.log"
@@ -0,0 +1,86 @@
+"""
+Compare the computation of the ascends data frame of the eukaryotes tree by
+Traverse with the previous walk from each node up to the root.
+
+The previous walk built a Python list of taxid strings per node. Ascends
+are now computed in one top-down pass reusing the path of each parent, and
+stored as a list column of int32 taxids. Both are checked to give the same
+ancestors. Must be run from the builder directory, after the taxonomy has
+been downloaded, or on a synthetic tree:
+
+    uv run python scripts/bench_ancestor_paths.py [--synthetic 2000000]
+"""
+
+import logging
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from taxotree import TaxoTree
+from Traverse import GROUP_ROOTS, node_ascends
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def legacy_ascends(t: TaxoTree) -> pl.DataFrame:
+    """
+    Previous ascends computation, walking the parents of each node.
+    """
+    taxids = t.taxid.astype(str)
+    return pl.DataFrame(
+        {
+            "taxid": taxids,
+            "ascend": [
+                [taxids[up] for up in t.ancestors(n)] + ["0"] for n in range(t.n_nodes)
+            ],
+        }
+    )
+
+
+def eukaryotes_tree(synthetic: int | None) -> TaxoTree:
+    if synthetic is not None:
+        from check_layout import synthetic_tree
+
+        t = synthetic_tree(n_nodes=synthetic)
+        return t.subtree(t.taxid[t.root])
+
+    import getTrees
+
+    return getTrees.getTheTrees().subtree(GROUP_ROOTS["2"])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark ascends computation.")
+    parser.add_argument(
+        "--synthetic", type=int, default=None, help="Use a synthetic tree of this size"
+    )
+    args = parser.parse_args()
+
+    t = eukaryotes_tree(args.synthetic)
+    logger.info(f"{t.n_nodes} nodes, {len(t.levels())} levels")
+
+    start = time.perf_counter()
+    legacy = legacy_ascends(t)
+    legacy_time = time.perf_counter() - start
+    logger.info(
+        f"Parents walk: {legacy_time:.2f}s, {legacy.estimated_size() / 1024**2:.0f} MB data frame"
+    )
+
+    start = time.perf_counter()
+    ascends = node_ascends(t)
+    ascends_time = time.perf_counter() - start
+    logger.info(
+        f"Top-down paths: {ascends_time:.2f}s ({legacy_time / ascends_time:.0f}x faster), "
+        f"{ascends.estimated_size() / 1024**2:.0f} MB data frame"
+    )
+
+    same = ascends.with_columns(pl.col("ascend").cast(pl.List(pl.Utf8))).equals(legacy)
+    logger.info(f"  Same ancestors: {same}")
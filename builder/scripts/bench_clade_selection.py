@@ -0,0 +1,177 @@
+"""
+Compare clade selections and subtree membership tests on lmdata.parquet
+using the preorder intervals with the same queries using the ascends lists.
+
+With the rows sorted in preorder, the clade of a taxon is the slice of rows
+from its entry to its exit, and a taxon x is under a taxon y if the entry of
+x lies in the interval of y. With the ascends lists, a clade is selected by
+scanning the ancestors of all rows. Both are checked to give the same
+results. Runs on the lmdata.parquet file of a build, or on the converted
+features of a synthetic tree:
+
+    uv run python scripts/bench_clade_selection.py [--lmdata PATH] [--nodes 2000000]
+"""
+
+import logging
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from export_data import convert_features
+from taxotree import taxid_positions
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def synthetic_lmdata(n_nodes: int) -> pl.DataFrame:
+    """
+    Converted features of a synthetic tree, with random coordinates.
+    """
+    from check_layout import synthetic_tree
+    from Traverse import node_ascends
+
+    t = synthetic_tree(n_nodes=n_nodes)
+    t = t.subtree(t.taxid[t.root])
+    rng = np.random.default_rng(0)
+    features = node_ascends(t).with_columns(
+        sci_name=pl.col("taxid"),
+        zoom=pl.Series(rng.integers(4, 40, size=t.n_nodes)),
+        lat=pl.Series(rng.uniform(-90, 90, size=t.n_nodes)),
+        lon=pl.Series(rng.uniform(-180, 180, size=t.n_nodes)),
+    )
+    return convert_features(features)
+
+
+def ascend_clade(lm: pl.DataFrame, taxid: int) -> pl.DataFrame:
+    return lm.filter(
+        pl.col("pylifemap_ascend").list.contains(taxid) | (pl.col("taxid") == taxid)
+    )
+
+
+def interval_clade(lm: pl.DataFrame, row: int) -> pl.DataFrame:
+    taxon = lm.row(row, named=True)
+    return lm.slice(
+        taxon["pylifemap_entry"], taxon["pylifemap_exit"] - taxon["pylifemap_entry"] + 1
+    )
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark clade selections on lmdata.parquet.")
+    parser.add_argument(
+        "--lmdata", type=Path, default=None, help="lmdata.parquet file of a build"
+    )
+    parser.add_argument(
+        "--nodes", type=int, default=2_000_000, help="Synthetic tree size"
+    )
+    parser.add_argument(
+        "--clades", type=int, default=20, help="Number of random clades selected"
+    )
+    parser.add_argument(
+        "--pairs", type=int, default=1_000_000, help="Number of membership tests"
+    )
+    args = parser.parse_args()
+
+    lm = (
+        pl.read_parquet(args.lmdata)
+        if args.lmdata is not None
+        else synthetic_lmdata(args.nodes)
+    )
+    taxid = lm.get_column("taxid").to_numpy()
+    entry = lm.get_column("pylifemap_entry").to_numpy()
+    exit = lm.get_column("pylifemap_exit").to_numpy()
+    logger.info(
+        f"{len(lm)} taxa, sorted in preorder: {np.array_equal(entry, np.arange(len(lm)))}"
+    )
+
+    # The largest clades below the root, and random internal taxa
+    rng = np.random.default_rng(0)
+    sizes = exit - entry + 1
+    internal = np.flatnonzero(sizes > 1)
+    rows = np.concatenate(
+        [np.argsort(-sizes, kind="stable")[1:6], rng.choice(internal, size=args.clades)]
+    )
+
+    ascend_time = interval_time = 0.0
+    same = True
+    for row in rows.tolist():
+        by_ascend, elapsed = timed(ascend_clade, lm, int(taxid[row]))
+        ascend_time += elapsed
+        by_interval, elapsed = timed(interval_clade, lm, row)
+        interval_time += elapsed
+        same &= (
+            by_ascend.get_column("taxid")
+            .sort()
+            .equals(by_interval.get_column("taxid").sort())
+        )
+    logger.info(
+        f"{len(rows)} clades, {sizes[rows].sum()} taxa selected. "
+        f"Ascends: {ascend_time / len(rows) * 1000:.1f} ms per clade, "
+        f"intervals: {interval_time / len(rows) * 1000:.3f} ms per clade "
+        f"({ascend_time / interval_time:.0f}x faster)"
+    )
+    logger.info(f"  Same clades: {same}")
+
+    # Is x under y, for random pairs of taxids where y is an ancestor of x
+    # half of the time
+    x = rng.choice(taxid, size=args.pairs)
+    ancestor = (
+        pl.DataFrame(
+            {
+                "ascend": lm.get_column("pylifemap_ascend").gather(
+                    taxid_positions(taxid, x)
+                ),
+                "k": rng.integers(0, 1 << 30, size=args.pairs),
+            }
+        )
+        .select(
+            pl.col("ascend").list.get(
+                pl.col("k") % pl.col("ascend").list.len().clip(1), null_on_oob=True
+            )
+        )
+        .to_series()
+    )
+    y = np.where(
+        ancestor.is_not_null().to_numpy() & (rng.random(args.pairs) < 0.5),
+        ancestor.fill_null(0).to_numpy(),
+        rng.choice(taxid[internal], size=args.pairs),
+    )
+
+    start = time.perf_counter()
+    x_rows, y_rows = taxid_positions(taxid, x), taxid_positions(taxid, y)
+    by_ascend = (
+        pl.DataFrame(
+            {"ascend": lm.get_column("pylifemap_ascend").gather(x_rows), "y": y}
+        )
+        .select(
+            pl.col("ascend").list.contains(pl.col("y")) | (pl.lit(x) == pl.col("y"))
+        )
+        .to_series()
+        .to_numpy()
+    )
+    ascend_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    x_rows, y_rows = taxid_positions(taxid, x), taxid_positions(taxid, y)
+    by_interval = (entry[y_rows] <= entry[x_rows]) & (entry[x_rows] <= exit[y_rows])
+    interval_time = time.perf_counter() - start
+
+    logger.info(
+        f"{args.pairs} membership tests, {by_interval.sum()} true. Ascends: {ascend_time:.2f}s, "
+        f"intervals: {interval_time:.2f}s ({ascend_time / interval_time:.0f}x faster)"
+    )
+    logger.info(f"  Same results: {np.array_equal(by_ascend, by_interval)}")
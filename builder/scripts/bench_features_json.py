@@ -0,0 +1,172 @@
+"""
+Compare the serialization of the tree features by Traverse with the
+previous per-node JSON formatting.
+
+Features of a synthetic taxonomy, whose names include quotes, backslashes
+and control characters, are written as the previous TreeFeatures JSON
+files, and as the current Parquet and newline delimited JSON files. Both
+JSON outputs are parsed back to check that they are valid and that names
+are preserved. No database is needed:
+
+    uv run python scripts/bench_features_json.py
+"""
+
+import json
+import logging
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from check_layout import synthetic_tree
+from config import LANG_LIST
+from taxotree import NAME_COLUMNS
+from Traverse import CHUNK_SIZE, compute_layout, node_attributes, node_features
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+NAMES = [
+    "Homo sapiens",
+    "Escherichia coli str. K-12 substr. MG1655",
+    'Salmonella "Typhimurium"',
+    "Vibrio sp. C:\\Users",
+    "Bacillus\tsubtilis",
+    "Streptomyces\nsp.",
+    "Cr\u00e9pidule \u00e0 \u00e9paulettes",
+    "Orbigny's\u2019 shrimp",
+]
+
+
+def legacy_node2json(attrs, k, lay, node) -> str:
+    sci_name = attrs["sci_name"][k]
+    sci_name = sci_name.replace('"', '\\"')
+    common_name = {}
+    for lang in LANG_LIST:
+        common_name[lang] = attrs[f"common_name_long_{lang}"][k]
+        common_name[lang] = common_name[lang].replace('"', '\\"')
+    authority = attrs["authority"][k]
+    authority = authority.replace("\\", "\\\\")
+    authority = authority.replace('"', '\\"')
+    synonym = attrs["synonym"][k]
+    synonym = synonym.replace('"', '\\"')
+    taxid = attrs["taxid"][k]
+    rank = {lang: attrs[f"rank_{lang}"][k] for lang in LANG_LIST}
+    out = f"""{{
+        "taxid": "{taxid}",
+        "sci_name": "{sci_name}",
+        "suggest_weight": "{300 - len(sci_name)}",
+        "common_name_en": "{common_name["en"]}",
+        "common_name_fr": "{common_name["fr"]}",
+        "authority": "{authority}",
+        "synonym": "{synonym}",
+        "rank_en": "{rank["en"]}",
+        "rank_fr": "{rank["fr"]}",
+        "all_en": "{sci_name} | {common_name["en"]} | {rank["en"]} | {taxid}",
+        "all_fr": "{sci_name} | {common_name["fr"]} | {rank["fr"]} | {taxid}",
+        "zoom": {int(lay.zoomview[node] + 4)},
+        "nbdesc": {lay.nbdesc[node]},
+        "coordinates": [{lay.y[node]:.20f}, {lay.x[node]:.20f}],
+        "lat": {lay.y[node]:.20f},
+        "lon": {lay.x[node]:.20f}
+    }}"""
+    return out
+
+
+def named_tree(n_nodes: int):
+    """
+    Synthetic tree and layout, with names drawn from NAMES.
+    """
+    t = synthetic_tree(n_nodes=n_nodes)
+    t = t.subtree(t.taxid[t.root])
+    rng = np.random.default_rng(0)
+    t.names = pl.DataFrame(
+        {col: rng.choice(NAMES, size=t.n_nodes) for col in NAME_COLUMNS}
+    )
+    lay = compute_layout(t, x=0.0, y=-11.0, alpha=270.0, ray=10.0)
+    return t, lay
+
+
+def write_legacy(t, lay, path: Path) -> None:
+    with open(path, "w") as f:
+        f.write("[")
+        for start in range(0, t.n_nodes, CHUNK_SIZE):
+            nodes = np.arange(start, min(start + CHUNK_SIZE, t.n_nodes))
+            attrs = node_attributes(t, nodes)
+            if start > 0:
+                f.write(",")
+            f.write(
+                ",".join(
+                    legacy_node2json(attrs, k, lay, n)
+                    for k, n in enumerate(nodes.tolist())
+                )
+            )
+        f.write("]")
+
+
+def write_columnar(t, lay, directory: Path) -> pl.DataFrame:
+    features = pl.concat(
+        [
+            node_features(t, lay, np.arange(start, min(start + CHUNK_SIZE, t.n_nodes)))
+            for start in range(0, t.n_nodes, CHUNK_SIZE)
+        ]
+    )
+    features.write_parquet(directory / "TreeFeatures.parquet")
+    features.write_ndjson(directory / "TreeFeatures.json")
+    return features
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the serialization of the tree features."
+    )
+    parser.add_argument(
+        "--nodes", type=int, default=400_000, help="Synthetic tree size"
+    )
+    args = parser.parse_args()
+
+    t, lay = named_tree(args.nodes)
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+
+        _, legacy_time = timed(write_legacy, t, lay, directory / "legacy.json")
+        size = (directory / "legacy.json").stat().st_size / 1024**2
+        logger.info(
+            f"Previous JSON: {legacy_time:.2f}s, {t.n_nodes / legacy_time:.0f} documents/s, "
+            f"{size / legacy_time:.0f} MB/s"
+        )
+        try:
+            with open(directory / "legacy.json") as f:
+                json.load(f)
+            logger.info("  Valid JSON")
+        except json.JSONDecodeError as e:
+            logger.info(f"  Invalid JSON: {e}")
+
+        features, columnar_time = timed(write_columnar, t, lay, directory)
+        size = (directory / "TreeFeatures.json").stat().st_size / 1024**2
+        logger.info(
+            f"Parquet and NDJSON: {columnar_time:.2f}s ({legacy_time / columnar_time:.1f}x faster), "
+            f"{t.n_nodes / columnar_time:.0f} documents/s, {size / columnar_time:.0f} MB/s of NDJSON"
+        )
+        with open(directory / "TreeFeatures.json") as f:
+            documents = [json.loads(line) for line in f]
+        names = [document["sci_name"] for document in documents]
+        logger.info(
+            f"  {len(documents)} valid documents, "
+            f"names preserved: {names == features.get_column('sci_name').to_list()}, "
+            f"Parquet identical: {pl.read_parquet(directory / 'TreeFeatures.parquet').equals(features)}"
+        )
@@ -0,0 +1,184 @@
+"""
+Compare the size and the selective read latency of the lmdata parquet files
+exported in the preorder layout and in the client layout.
+
+Both layouts are exported from the complete features of a build, or from
+synthetic features of the three kingdoms, into temporary directories. The
+same queries (a zoom range, a kingdom, and both) are run on lmdata.parquet
+and lmdata_R.parquet of each layout with lazy scans, so that the client
+layout can skip row groups from their statistics, and on the per-kingdom
+files of the client layout. Queries are checked to return the same number
+of rows in both layouts:
+
+    uv run python scripts/bench_lmdata_layout.py [--features PATH] [--nodes 2000000]
+"""
+
+import logging
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from export_data import KINGDOMS, export_lmdata
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Share of the synthetic taxa in each kingdom
+KINGDOM_SHARES = {2157: 0.05, 2759: 0.35, 2: 0.6}
+
+# Number of runs of each query, the best time being kept
+REPEATS = 5
+
+
+def synthetic_features(n_nodes: int) -> pl.DataFrame:
+    """
+    Complete features of one synthetic tree per kingdom, with random
+    coordinates and zooms increasing with depth.
+    """
+    from check_layout import synthetic_tree
+    from Traverse import node_ascends
+
+    rng = np.random.default_rng(0)
+    features = []
+    for k, (root, share) in enumerate(KINGDOM_SHARES.items()):
+        t = synthetic_tree(n_nodes=int(n_nodes * share), seed=k)
+        t = t.subtree(t.taxid[t.root])
+        # Taxids of each tree are shifted to be distinct, and its root is
+        # given the taxid of the kingdom
+        t.taxid = np.where(
+            np.arange(t.n_nodes) == t.root, root, t.taxid + (k + 1) * 10**7
+        )
+        ascends = node_ascends(t)
+        features.append(
+            ascends.with_columns(
+                sci_name=pl.format("taxon {}", pl.col("taxid")),
+                zoom=(pl.col("ascend").list.len() + 4).cast(pl.Int64),
+                lat=pl.Series(rng.uniform(-80, 80, size=t.n_nodes)),
+                lon=pl.Series(rng.uniform(-170, 170, size=t.n_nodes)),
+            ).select("taxid", "sci_name", "zoom", "lat", "lon", "ascend")
+        )
+    return pl.concat(features)
+
+
+def queries(layout: str, columns: dict, zoom: int) -> dict[str, pl.Expr]:
+    """
+    Filters of the queries on a lmdata file of a layout.
+    """
+    archaea = next(root for root, name in KINGDOMS.items() if name == "archaea")
+    if columns["string_taxids"]:
+        archaea = str(archaea)
+    if layout == "client":
+        in_archaea = pl.col(columns["kingdom"]) == "archaea"
+    else:
+        in_archaea = pl.col(columns["ascend"]).list.contains(archaea) | (
+            pl.col("taxid") == archaea
+        )
+    in_zooms = pl.col(columns["zoom"]) <= zoom
+    return {
+        f"zoom <= {zoom}": in_zooms,
+        "archaea": in_archaea,
+        f"archaea, zoom <= {zoom}": in_archaea & in_zooms,
+    }
+
+
+def timed_scan(file: Path, predicate: pl.Expr | None = None) -> tuple[int, float]:
+    """
+    Number of rows read by a query, and its best time in ms.
+    """
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        lf = pl.scan_parquet(file)
+        if predicate is not None:
+            lf = lf.filter(predicate)
+        n_rows = len(lf.collect())
+        best = min(best, time.perf_counter() - start)
+    return n_rows, best * 1000
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the lmdata parquet layouts.")
+    parser.add_argument(
+        "--features",
+        type=Path,
+        default=None,
+        help="TreeFeaturesComplete.parquet of a build",
+    )
+    parser.add_argument(
+        "--nodes", type=int, default=2_000_000, help="Synthetic features size"
+    )
+    parser.add_argument(
+        "--zoom", type=int, default=8, help="Maximum zoom of the zoom range queries"
+    )
+    args = parser.parse_args()
+
+    files = {
+        "lmdata.parquet": {
+            "zoom": "pylifemap_zoom",
+            "ascend": "pylifemap_ascend",
+            "kingdom": "pylifemap_kingdom",
+            "string_taxids": False,
+        },
+        "lmdata_R.parquet": {
+            "zoom": "zoom",
+            "ascend": "ascend",
+            "kingdom": "kingdom",
+            "string_taxids": True,
+        },
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        features_file = args.features
+        if features_file is None:
+            features_file = directory / "TreeFeaturesComplete.parquet"
+            synthetic_features(args.nodes).write_parquet(features_file)
+        for layout in ["preorder", "client"]:
+            (directory / layout).mkdir()
+            start = time.perf_counter()
+            export_lmdata(
+                layout=layout, features_file=features_file, directory=directory / layout
+            )
+            logger.info(
+                f"{layout} layout exported in {time.perf_counter() - start:.1f}s"
+            )
+
+        for file, columns in files.items():
+            sizes = {
+                layout: (directory / layout / file).stat().st_size / 1024**2
+                for layout in ["preorder", "client"]
+            }
+            logger.info(
+                f"{file}: {sizes['preorder']:.1f} MB in preorder, {sizes['client']:.1f} MB in client layout"
+            )
+            n_rows, elapsed = timed_scan(directory / "preorder" / file)
+            logger.info(f"  Full read: {n_rows} rows, {elapsed:.1f} ms in preorder")
+            client_queries = queries("client", columns, args.zoom)
+            for name, predicate in queries("preorder", columns, args.zoom).items():
+                n_preorder, preorder_time = timed_scan(
+                    directory / "preorder" / file, predicate
+                )
+                n_client, client_time = timed_scan(
+                    directory / "client" / file, client_queries[name]
+                )
+                logger.info(
+                    f"  {name}: {n_preorder} rows, {preorder_time:.1f} ms in preorder, "
+                    f"{client_time:.1f} ms in client layout ({preorder_time / client_time:.1f}x speedup)"
+                    + ("" if n_preorder == n_client else f", but {n_client} rows")
+                )
+            kingdom_file = (
+                directory / "client" / file.replace(".parquet", "_archaea.parquet")
+            )
+            n_rows, elapsed = timed_scan(kingdom_file)
+            logger.info(
+                f"  {kingdom_file.name}: {n_rows} rows, {kingdom_file.stat().st_size / 1024**2:.1f} MB, "
+                f"{elapsed:.1f} ms"
+            )
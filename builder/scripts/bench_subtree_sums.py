@@ -0,0 +1,117 @@
+"""
+Compare the peak memory and time of the genomes counts of AdditionalInfo
+with the previous computation, which exploded the ascends lists of all
+nodes and grouped the genomes by ancestor.
+
+Ascends and genomes of a synthetic tree are written to temporary files,
+and each computation is run from these files in a new process, whose peak
+memory is read from /proc (Linux only). No build is needed:
+
+    uv run python scripts/bench_subtree_sums.py [--nodes 2000000]
+"""
+
+import logging
+import multiprocessing
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from AdditionalInfo import subtree_genomes
+from check_layout import synthetic_tree
+from Traverse import node_ascends
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def exploded_genomes(ascends: pl.DataFrame, genomes: pl.DataFrame) -> np.ndarray:
+    """
+    Previous computation, with one row per node and ancestor.
+    """
+    ascends = ascends.with_columns(pl.col("ascend").cast(pl.List(pl.Utf8)))
+    ascend = ascends.with_columns(
+        pl.col("ascend").list.concat(pl.col("taxid"))
+    ).explode("ascend")
+    n_genomes = (
+        ascend.join(genomes, left_on="taxid", right_on="taxid", how="left")
+        .with_columns(pl.col("n").fill_null(0))
+        .group_by("ascend")
+        .agg(genomes=pl.sum("n"))
+        .rename({"ascend": "taxid"})
+    )
+    addi = ascends.join(
+        n_genomes, on="taxid", how="left", maintain_order="left"
+    ).with_columns(pl.col("genomes").fill_null(0))
+    return addi.get_column("genomes").to_numpy()
+
+
+def memory_status(field: str) -> float:
+    """
+    Memory of the current process given in /proc/self/status, in MB.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def measure(method: str, directory: str) -> tuple[float, float, np.ndarray]:
+    """
+    Time (s), peak memory above the memory used before reading the files
+    (MB) and result of a computation.
+    """
+    baseline = memory_status("VmRSS")
+    start = time.perf_counter()
+    ascends = pl.read_parquet(Path(directory) / "ascends.parquet")
+    genomes = pl.read_parquet(Path(directory) / "genomes.parquet")
+    function = subtree_genomes if method == "subtree" else exploded_genomes
+    result = function(ascends, genomes)
+    elapsed = time.perf_counter() - start
+    return elapsed, memory_status("VmHWM") - baseline, result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark genomes counts over subtrees.")
+    parser.add_argument(
+        "--nodes", type=int, default=2_000_000, help="Synthetic tree size"
+    )
+    args = parser.parse_args()
+
+    t = synthetic_tree(n_nodes=args.nodes)
+    t = t.subtree(t.taxid[t.root])
+    rng = np.random.default_rng(0)
+    with_genomes = rng.choice(t.taxid, size=t.n_nodes // 10, replace=False)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        node_ascends(t).write_parquet(Path(directory) / "ascends.parquet")
+        pl.DataFrame(
+            {
+                "taxid": with_genomes.astype(str),
+                "n": rng.integers(1, 20, size=len(with_genomes)),
+            }
+        ).write_parquet(Path(directory) / "genomes.parquet")
+        for method in ["explode", "subtree"]:
+            # A new process per method, for its peak memory
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                elapsed, peak, results[method] = pool.submit(
+                    measure, method, directory
+                ).result()
+            logger.info(f"{method}: {elapsed:.2f}s, peak memory +{peak:.0f} MB")
+
+    logger.info(
+        f"Same genomes counts: {np.array_equal(results['explode'], results['subtree'])}"
+    )
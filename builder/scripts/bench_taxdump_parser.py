@@ -0,0 +1,128 @@
+"""
+Compare the columnar taxdump parser of getTrees with the previous line by line
+parser, on the names.dmp and nodes.dmp files in TAXO_DIRECTORY.
+
+Both parsers are checked to give the same attributes. Must be run from the
+builder directory, after taxdump.tar.gz has been extracted:
+
+    uv run python scripts/bench_taxdump_parser.py
+"""
+
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+
+from config import LANG_LIST, TAXO_DIRECTORY
+from getTrees import _read_dmp, read_names
+from taxotree import NAME_COLUMNS
+from utils import get_translations_fr
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def legacy_names() -> dict[str, dict]:
+    """
+    Previous names.dmp parser, splitting each line three times.
+    """
+    taxo_fr_translations = get_translations_fr()
+    attr: dict[str, dict[str, Any]] = {}
+    with open(TAXO_DIRECTORY / "names.dmp") as f:
+        for line in f:
+            taxid = line.split("|")[0].replace("\t", "")
+            tid_val = line.split("|")[1].replace("\t", "")
+            tid_type = line.split("|")[3].replace("\t", "")
+            if taxid not in attr:
+                attr[taxid] = {
+                    "sci_name": "",
+                    "authority": "",
+                    "synonym": "",
+                    "common_name": {},
+                }
+                for lang in LANG_LIST:
+                    attr[taxid]["common_name"][lang] = []
+            if tid_type == "common name":
+                attr[taxid]["common_name"]["en"].append(tid_val)
+            if taxid in taxo_fr_translations:
+                attr[taxid]["common_name"]["fr"] = taxo_fr_translations[taxid]
+            if tid_type == "scientific name":
+                attr[taxid]["sci_name"] = tid_val
+            if tid_type in ("authority", "synonym"):
+                if attr[taxid][tid_type] != "":
+                    attr[taxid][tid_type] = attr[taxid][tid_type] + ", " + tid_val
+                else:
+                    attr[taxid][tid_type] = tid_val
+
+    res = {}
+    for taxid, values in attr.items():
+        row = {
+            "sci_name": values["sci_name"].replace("'", "''"),
+            "authority": values["authority"],
+            "synonym": values["synonym"],
+        }
+        for lang in LANG_LIST:
+            common_names = list(values["common_name"][lang])
+            row[f"common_name_{lang}"] = (
+                common_names[0].replace("'", "''") if common_names else ""
+            )
+            row[f"common_name_long_{lang}"] = ", ".join(common_names)
+        res[taxid] = row
+    return res
+
+
+def legacy_nodes() -> tuple[list, list, list]:
+    """
+    Previous nodes.dmp parser.
+    """
+    taxids, parents, ranks = [], [], []
+    with open(TAXO_DIRECTORY / "nodes.dmp") as fp:
+        for line in fp:
+            line = line.split("|")
+            taxids.append(int(line[0].replace("\t", "")))
+            parents.append(int(line[1].replace("\t", "")))
+            ranks.append(line[2].replace("\t", ""))
+    return taxids, parents, ranks
+
+
+if __name__ == "__main__":
+    # Load translations once so that their loading time isn't counted
+    get_translations_fr()
+
+    start = time.perf_counter()
+    legacy = legacy_names()
+    taxids, parents, ranks = legacy_nodes()
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    names = read_names()
+    nodes = _read_dmp(
+        TAXO_DIRECTORY / "nodes.dmp", {"taxid": 0, "parent": 1, "rank": 2}
+    )
+    columnar_time = time.perf_counter() - start
+
+    logger.info(f"{len(legacy)} taxids with names, {len(taxids)} nodes")
+    logger.info(f"Line by line parser:\t{legacy_time:.1f}s")
+    logger.info(f"Columnar parser:\t{columnar_time:.1f}s")
+
+    expected = pl.DataFrame(
+        {
+            "taxid": [int(taxid) for taxid in legacy],
+            **{col: [row[col] for row in legacy.values()] for col in NAME_COLUMNS},
+        },
+        schema_overrides={"taxid": pl.Int32},
+    )
+    same_names = names.equals(expected)
+    same_nodes = nodes.select(pl.col("taxid", "parent").cast(pl.Int64), "rank").equals(
+        pl.DataFrame({"taxid": taxids, "parent": parents, "rank": ranks})
+    )
+    if not (same_names and same_nodes):
+        logger.error(f"Parsers results differ: names {same_names}, nodes {same_nodes}")
+        sys.exit(1)
+    logger.info("Parsers results are identical")
@@ -0,0 +1,129 @@
+"""
+Compare memory usage and running time of the array-backed TaxoTree with the
+previous ete4 based tree, on the taxdump files in TAXO_DIRECTORY.
+
+Each engine is run in its own subprocess so that peak RSS values are not mixed.
+Must be run from the builder directory, after taxdump.tar.gz has been extracted:
+
+    uv run python scripts/bench_taxotree.py
+"""
+
+import logging
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+GROUPS = {
+    "2157": (6.0, 9.660254 - 10.0, 30.0, 10.0),
+    "2759": (-6.0, 9.660254 - 10.0, 150.0, 10.0),
+    "2": (0.0, -11.0, 270.0, 10.0),
+}
+
+
+def build_ete4():
+    from config import LANG_LIST, TAXO_DIRECTORY
+    from ete4 import Tree
+    from getTrees import read_names
+
+    attr = {str(row["taxid"]): row for row in read_names().iter_rows(named=True)}
+    tree = {}
+    with open(TAXO_DIRECTORY / "nodes.dmp") as fp:
+        _ = fp.readline()
+        for line in fp:
+            line = line.split("|")
+            dad = line[1].replace("\t", "")
+            son = line[0].replace("\t", "")
+            for taxid in (dad, son):
+                if taxid not in tree:
+                    tree[taxid] = Tree()
+                    tree[taxid].props["taxid"] = taxid
+                    tree[taxid].props["sci_name"] = attr[taxid]["sci_name"]
+                    tree[taxid].props["common_name"] = {
+                        lang: attr[taxid][f"common_name_{lang}"] for lang in LANG_LIST
+                    }
+                    tree[taxid].props["common_name_long"] = {
+                        lang: attr[taxid][f"common_name_long_{lang}"]
+                        for lang in LANG_LIST
+                    }
+                    tree[taxid].props["synonym"] = attr[taxid]["synonym"]
+                    tree[taxid].props["authority"] = attr[taxid]["authority"]
+            tree[son].props["rank"] = {"en": line[2].replace("\t", "")}
+            tree[dad].add_child(tree[son])
+    del attr
+    return tree
+
+
+def layout_ete4(tree):
+    for taxid, (x, y, alpha, ray) in GROUPS.items():
+        t = tree[taxid]
+        t.props.update(x=x, y=y, alpha=alpha, ray=ray)
+        for n in t.traverse():
+            child = n.children
+            tot = sum(np.sqrt(len(i)) for i in child)
+            n.props["nbdesc"] = len(n)
+            angles = []
+            for i in child:
+                ang = 180 * (np.sqrt(len(i)) / tot) / 2
+                angles.append(ang)
+                i.props["ray"] = (n.props["ray"] * np.tan(np.radians(ang))) / (
+                    1 + np.tan(np.radians(ang))
+                )
+            ang = np.cumsum(np.repeat(angles, 2))[0::2] - (90 - n.props["alpha"])
+            for cpt, i in enumerate(child):
+                dist = n.props["ray"] - i.props["ray"]
+                i.props["alpha"] = ang[cpt]
+                i.props["x"] = n.props["x"] + dist * np.cos(np.radians(ang[cpt]))
+                i.props["y"] = n.props["y"] + dist * np.sin(np.radians(ang[cpt]))
+                i.props["zoomview"] = max(np.ceil(np.log2(30 / i.props["ray"])), 0)
+
+
+def build_array():
+    from getTrees import getTheTrees
+
+    return getTheTrees()
+
+
+def layout_array(tree):
+    from Traverse import compute_layout
+
+    for taxid, (x, y, alpha, ray) in GROUPS.items():
+        compute_layout(tree.subtree(taxid), x=x, y=y, alpha=alpha, ray=ray)
+
+
+def run(engine: str) -> None:
+    build, layout = (
+        (build_ete4, layout_ete4) if engine == "ete4" else (build_array, layout_array)
+    )
+    start = time.perf_counter()
+    tree = build()
+    built = time.perf_counter()
+    layout(tree)
+    end = time.perf_counter()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{engine}\t{built - start:.1f}\t{end - built:.1f}\t{peak:.0f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+        sys.exit(0)
+
+    logger.info("engine\tbuild (s)\tlayout (s)\tpeak RSS (MB)")
+    for engine in ("ete4", "array"):
+        res = subprocess.run(
+            [sys.executable, __file__, engine],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        logger.info(res.stdout.strip().splitlines()[-1].replace("\t", "\t\t"))
@@ -0,0 +1,176 @@
+"""
+Compare the computation of the prerendered tiles lists of GetAllTilesCoord
+with the previous scanner of the TreeFeatures JSON files.
+
+The previous scanner listed the tile of each node center at its zoom and,
+from zoom 5, at the 3 previous zooms, once per node. It is run on the
+zoom, lat and lon lines of the features as laid out in the previous
+TreeFeatures JSON files, one field per line. The same rule is
+computed with vectorized tile math on the zoom, lat and lon columns of
+TreeFeaturesComplete.parquet, and both are checked to give the same
+distinct tiles. The tiles lists of the current builder, covering the
+extents of the node features, are computed from the tree layout and
+checked to include them.
+Must be run from the builder directory, after a build:
+
+    uv run python scripts/bench_tile_coords.py
+"""
+
+import io
+import logging
+import math
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+
+import getTrees
+from config import BUILD_DIRECTORY
+from geometry import to_web_mercator
+from GetAllTilesCoord import (
+    MAX_ZOOM,
+    PREVIOUS_ZOOMS,
+    covered_tiles,
+    prerendered_tiles,
+    tile_key,
+    write_tiles,
+)
+from Traverse import GROUP_ROOTS, group_layout
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def deg2num(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(lat_deg)
+    n = 2.0**zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int(
+        (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi)
+        / 2.0
+        * n
+    )
+    return [xtile, ytile]
+
+
+def legacy_text(features: pl.DataFrame) -> str:
+    """
+    Zoom and coordinates of the nodes, laid out as in the previous TreeFeatures JSON files.
+    """
+    return "".join(
+        f'        "zoom": {zoom},\n        "lat": {lat:.20f},\n        "lon": {lon:.20f}\n'
+        for zoom, lat, lon in features.iter_rows()
+    )
+
+
+def legacy_tiles(text: str) -> list[str]:
+    """
+    Previous scanner of the TreeFeatures JSON files, parsing them line by line.
+    """
+    coo = io.StringIO()
+    zoom = lat = lon = False
+    for line in io.StringIO(text):
+        tmp = line.split(":")
+        if len(tmp) > 1:
+            key = tmp[0].replace('"', "").replace(" ", "")
+            val = tmp[1].replace('"', "").replace(" ", "").replace(",", "").rstrip()
+            if key == "zoom":
+                zoom = val
+            if key == "lat":
+                lat = val
+            if key == "lon":
+                lon = val
+                if int(zoom) <= 20:
+                    xy = deg2num(float(lat), float(lon), float(zoom))
+                    coo.write(f"{xy[0]:d} {xy[1]:d} {zoom}\n")
+                    if int(zoom) >= 5:
+                        for shift in range(1, 4):
+                            xy = deg2num(
+                                float(lat), float(lon), float(int(zoom) - shift)
+                            )
+                            coo.write(f"{xy[0]:d} {xy[1]:d} {int(zoom) - shift:d}\n")
+                zoom = lat = lon = False
+    return coo.getvalue().splitlines()
+
+
+def read_features() -> pl.DataFrame:
+    """
+    Zoom and coordinates of the nodes.
+    """
+    return pl.read_parquet(
+        BUILD_DIRECTORY / "TreeFeaturesComplete.parquet", columns=["zoom", "lat", "lon"]
+    )
+
+
+def center_tiles(features: pl.DataFrame) -> np.ndarray:
+    """
+    Distinct tiles of the node centers, with the rule of the previous scanner.
+    """
+    zoom = features.get_column("zoom").cast(pl.Int64).to_numpy()
+    points = to_web_mercator(
+        np.stack(
+            (
+                features.get_column("lon").to_numpy(),
+                features.get_column("lat").to_numpy(),
+            ),
+            axis=-1,
+        )
+    )
+    extents = np.concatenate((points, points), axis=1)
+    keys = []
+    for shift in range(PREVIOUS_ZOOMS + 1):
+        nodes = np.flatnonzero((zoom <= MAX_ZOOM) & ((shift == 0) | (zoom >= 5)))
+        shift_keys, _ = covered_tiles(extents[nodes], zoom[nodes] - shift, margin=0)
+        keys.append(shift_keys)
+    return np.unique(np.concatenate(keys))
+
+
+def parse_keys(lines: list[str]) -> np.ndarray:
+    coords = np.array([line.split() for line in lines], dtype=np.int64).reshape(-1, 3)
+    return np.unique(tile_key(coords[:, 2], coords[:, 0], coords[:, 1]))
+
+
+if __name__ == "__main__":
+    features = read_features()
+    text = legacy_text(features)
+    start = time.perf_counter()
+    lines = legacy_tiles(text)
+    legacy_time = time.perf_counter() - start
+    legacy = parse_keys(lines)
+    logger.info(
+        f"Previous scanner: {legacy_time:.2f}s, {len(lines)} lines, {len(legacy)} distinct tiles"
+    )
+
+    start = time.perf_counter()
+    centers = center_tiles(features)
+    center_time = time.perf_counter() - start
+    logger.info(
+        f"Vectorized centers: {center_time:.2f}s ({legacy_time / center_time:.0f}x faster), "
+        f"{len(centers)} distinct tiles"
+    )
+    missing = np.setdiff1d(legacy, centers)
+    extra = np.setdiff1d(centers, legacy)
+    logger.info(
+        f"  Tiles only listed by the previous scanner: {len(missing)}, only vectorized: {len(extra)}"
+    )
+
+    tree = getTrees.getTheTrees()
+    start = time.perf_counter()
+    keys = np.unique(
+        np.concatenate(
+            [prerendered_tiles(*group_layout(tree, groupnb)) for groupnb in GROUP_ROOTS]
+        )
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        write_tiles(Path(directory) / "XYZcoordinates", keys)
+    logger.info(
+        f"Feature extents tiles: {time.perf_counter() - start:.2f}s from the tree layout, "
+        f"{len(keys)} distinct tiles, "
+        f"{len(np.setdiff1d(legacy, keys))} tiles of the previous scanner not included"
+    )
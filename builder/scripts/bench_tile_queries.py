@@ -0,0 +1,160 @@
+"""
+Replay the tile queries of the bbox tilesets (see back/bbox/bbox.toml.j2) on
+the postgis tables with EXPLAIN ANALYZE, to measure the effect of indexes
+and clustering at each zoom level.
+
+For each zoom, tiles are sampled around points visible at this zoom, and the
+ranks, polygons and branches queries are run with the bounding box filter
+and buffer added by bbox, as well as the queries of the generalized tables
+at low zooms. Execution time, shared buffers hit and read, and the scan
+nodes of the plans are reported. Must be run from the builder directory,
+once the tables have been built:
+
+    uv run python scripts/bench_tile_queries.py --zooms 4 8 12 16 20
+"""
+
+import json
+import logging
+import statistics
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+
+from db import db_connection
+from Traverse import LOWZOOM_ZOOMS
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Half width of the CustomWebMercator grid of bbox, in meters
+ORIGIN = 20037508.342789248
+# bbox buffer_size of the layers, in pixels of 256 pixels tiles
+BUFFER_SIZE = 256
+
+QUERIES = {
+    "ranks": (
+        "SELECT way, id, ref, zoomview, clade, rankname, rank_en, rank_fr, convex, taxid "
+        "FROM ranks{suffix} WHERE rankname=True and zoomview between {zoom}-4 and {zoom}-2 "
+        "AND way && {bbox} LIMIT 100"
+    ),
+    "polygons": (
+        "SELECT way, id, ref, zoomview, clade, taxid "
+        "FROM polygons{suffix} WHERE zoomview between {zoom}-4 and {zoom}+1 "
+        "AND way && {bbox} ORDER BY nbdesc DESC"
+    ),
+    "branches": (
+        "SELECT way, id, ref, z_order, branch, zoomview, nbdesc, taxid "
+        "FROM branches{suffix} WHERE zoomview < {zoom}+11 "
+        "AND way && {bbox} ORDER BY zoomview"
+    ),
+    # Generalized tables served up to zoom 8
+    "polygons_lowzoom": (
+        "SELECT way, id, ref, zoomview, clade, taxid "
+        "FROM polygons_lowzoom{suffix} WHERE genzoom = {zoom} "
+        "AND way && {bbox} ORDER BY nbdesc DESC"
+    ),
+    "branches_lowzoom": (
+        "SELECT way, id, ref, branch, zoomview "
+        "FROM branches_lowzoom{suffix} WHERE genzoom = {zoom} "
+        "AND way && {bbox} ORDER BY zoomview"
+    ),
+}
+
+
+def tile_bbox(x: float, y: float, zoom: int) -> str:
+    """
+    Buffered envelope of the tile containing a point, in EPSG:3857.
+    """
+    size = 2 * ORIGIN / 2**zoom
+    col = (x + ORIGIN) // size
+    row = (ORIGIN - y) // size
+    buffer = size * BUFFER_SIZE / 256
+    xmin = -ORIGIN + col * size - buffer
+    ymax = ORIGIN - row * size + buffer
+    return f"ST_MakeEnvelope({xmin}, {ymax - size - 2 * buffer}, {xmin + size + 2 * buffer}, {ymax}, 3857)"
+
+
+def scan_nodes(plan: dict) -> list[str]:
+    """
+    Scan nodes of a plan, with the index they use.
+    """
+    nodes = []
+    if "Scan" in plan["Node Type"]:
+        index = plan.get("Index Name")
+        nodes.append(f"{plan['Node Type']} {index}" if index else plan["Node Type"])
+    for child in plan.get("Plans", []):
+        nodes.extend(scan_nodes(child))
+    return nodes
+
+
+def sample_points(
+    cur, zoom: int, n: int, suffix: str, seed: int
+) -> list[tuple[float, float]]:
+    """
+    Coordinates of points visible at a zoom, in EPSG:3857.
+    """
+    cur.execute(f"SELECT setseed({seed / 2**31});")
+    cur.execute(
+        f"SELECT ST_X(way), ST_Y(way) FROM points{suffix} "
+        f"WHERE zoomview between {zoom}-4 and {zoom}-2 ORDER BY random() LIMIT {n};"
+    )
+    return cur.fetchall()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark bbox tile queries with EXPLAIN ANALYZE."
+    )
+    parser.add_argument(
+        "--zooms",
+        type=int,
+        nargs="+",
+        default=list(range(4, 33, 4)),
+        help="Zoom levels",
+    )
+    parser.add_argument(
+        "--tiles", type=int, default=20, help="Number of tiles sampled at each zoom"
+    )
+    parser.add_argument(
+        "--tables",
+        choices=["prod", "build"],
+        default="prod",
+        help="Query production or build tables",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Tiles sampling seed")
+    args = parser.parse_args()
+    suffix = "_prod" if args.tables == "prod" else ""
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    logger.info("zoom\tquery\t\ttiles\tmedian (ms)\tmax (ms)\thit\tread\tscans")
+    for zoom in args.zooms:
+        points = sample_points(cur, zoom, args.tiles, suffix, args.seed)
+        if not points:
+            logger.info(f"{zoom}\tno visible point")
+            continue
+        for name, query in QUERIES.items():
+            if name.endswith("_lowzoom") and zoom not in LOWZOOM_ZOOMS:
+                continue
+            times, hits, reads, scans = [], 0, 0, set()
+            for x, y in points:
+                sql = query.format(suffix=suffix, zoom=zoom, bbox=tile_bbox(x, y, zoom))
+                cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}")  # type: ignore
+                result = cur.fetchone()[0]  # type: ignore
+                result = (
+                    result[0] if not isinstance(result, str) else json.loads(result)[0]
+                )
+                times.append(result["Execution Time"])
+                hits += result["Plan"].get("Shared Hit Blocks", 0)
+                reads += result["Plan"].get("Shared Read Blocks", 0)
+                scans.update(scan_nodes(result["Plan"]))
+            logger.info(
+                f"{zoom}\t{name:<16}\t{len(times)}\t{statistics.median(times):.2f}\t\t{max(times):.2f}"
+                f"\t\t{hits}\t{reads}\t{', '.join(sorted(scans))}"
+            )
+
+    conn.close()
@@ -0,0 +1,128 @@
+"""
+Measure the memory used by Traverse to build database records, when all
+records of a tree are materialized at once versus streamed by chunks, and
+to write the feature files, when all features are concatenated before being
+written versus written chunk by chunk.
+
+Records are generated on synthetic taxonomies of increasing size, and are
+dropped as soon as they are generated in streaming mode, as CopyWriter does
+once they are sent to the server. Features are mostly held by polars and
+pyarrow outside of the Python heap, so their peak resident memory is
+measured in a new process for each run. No database is needed:
+
+    uv run python scripts/bench_traverse_memory.py
+"""
+
+import logging
+import multiprocessing
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import Traverse
+from bench_features_json import named_tree
+from check_layout import synthetic_tree
+from metrics import peak_rss_mb, reset_peak_rss
+from Traverse import CHUNK_SIZE, compute_layout, iter_features, iter_records
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def measure(n_nodes: int, chunk_size: int | None) -> tuple[float, float]:
+    """
+    Peak memory (MB) and time (s) to generate the records of a synthetic tree.
+    All records are kept if `chunk_size` is None.
+    """
+    t = synthetic_tree(n_nodes=n_nodes)
+    t = t.subtree(t.taxid[t.root])
+    lay = compute_layout(t, x=0.0, y=-11.0, alpha=270.0, ray=10.0)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = []
+    for chunk in iter_records(t, lay, "3", chunk_size=chunk_size or t.n_nodes):
+        if chunk_size is None:
+            kept.append(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024**2, elapsed
+
+
+def measure_features(n_nodes: int, streamed: bool) -> tuple[float, float]:
+    """
+    Peak resident memory increase (MB) and time (s) to write the feature
+    files of a synthetic tree, with `Traverse.write_features` if `streamed`,
+    or by concatenating all features first.
+    """
+    t, lay = named_tree(n_nodes)
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        Traverse.BUILD_DIRECTORY = directory
+        reset_peak_rss()
+        base = peak_rss_mb()
+        start = time.perf_counter()
+        if streamed:
+            Traverse.write_features(t, lay, "3", disable_progress=True)
+        else:
+            features = pl.concat(list(iter_features(t, lay)))
+            features.write_parquet(directory / "TreeFeatures3.parquet")
+            features.write_ndjson(directory / "TreeFeatures3.json")
+            Traverse.node_ascends(t).write_parquet(directory / "ascends_3.parquet")
+        elapsed = time.perf_counter() - start
+    return peak_rss_mb() - base, elapsed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark memory usage of traversal records generation."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[20_000, 100_000, 400_000],
+        help="Synthetic tree sizes",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE, help="Streaming chunk size"
+    )
+    args = parser.parse_args()
+
+    logger.info(
+        "nodes\t\tmaterialized (MB)\tstreamed (MB)\tmaterialized (s)\tstreamed (s)"
+    )
+    for n_nodes in args.sizes:
+        full_peak, full_time = measure(n_nodes, None)
+        chunk_peak, chunk_time = measure(n_nodes, args.chunk_size)
+        logger.info(
+            f"{n_nodes}\t\t{full_peak:.0f}\t\t\t{chunk_peak:.0f}\t\t{full_time:.1f}\t\t\t{chunk_time:.1f}"
+        )
+
+    logger.info(
+        "nodes\t\tconcatenated features (MB)\tstreamed features (MB)\t"
+        "concatenated (s)\tstreamed (s)"
+    )
+    spawn = multiprocessing.get_context("spawn")
+    for n_nodes in args.sizes:
+        results = []
+        for streamed in (False, True):
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                results.append(
+                    executor.submit(measure_features, n_nodes, streamed).result()
+                )
+        (full_peak, full_time), (chunk_peak, chunk_time) = results
+        logger.info(
+            f"{n_nodes}\t\t{full_peak:.0f}\t\t\t\t{chunk_peak:.0f}\t\t\t{full_time:.1f}\t\t\t{chunk_time:.1f}"
+        )
@@ -0,0 +1,95 @@
+"""
+Check that Traverse.compute_layout gives exactly the same coordinates as the
+reference stored in layout_golden.npz, on a synthetic taxonomy.
+
+    uv run python scripts/check_layout.py
+
+Use --update to regenerate the reference file after an intended layout change.
+"""
+
+import logging
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+
+from taxotree import NAME_COLUMNS, TaxoTree
+from Traverse import compute_layout
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+GOLDEN_FILE = Path(__file__).parent / "layout_golden.npz"
+LAYOUT_FIELDS = ["x", "y", "alpha", "ray", "zoomview", "nbdesc"]
+
+
+def synthetic_tree(n_nodes: int = 1500, seed: int = 20160205) -> TaxoTree:
+    """
+    Random taxonomy with NCBI-like shapes: a few very large clades, many
+    small ones and chains of single-child nodes. Nodes are not listed in
+    parent-before-child order.
+    """
+    rng = np.random.default_rng(seed)
+    parent = np.zeros(n_nodes, dtype=np.int64)
+    for i in range(1, n_nodes):
+        r = rng.random()
+        if r < 0.15:
+            parent[i] = i - 1
+        elif r < 0.5:
+            parent[i] = rng.integers(0, min(i, 20))
+        else:
+            parent[i] = rng.integers(max(0, i - 200), i)
+    taxid = rng.permutation(np.arange(1, n_nodes + 1))
+    order = np.concatenate([[0], 1 + rng.permutation(n_nodes - 1)])
+    return TaxoTree.from_parents(
+        taxid=taxid[order],
+        parent_taxid=taxid[parent[order]],
+        rank=np.zeros(n_nodes, dtype=np.int16),
+        rank_table=pl.DataFrame({"en": ["no rank"], "fr": ["sans rang"]}),
+        names=pl.DataFrame({col: [""] * n_nodes for col in NAME_COLUMNS}),
+    )
+
+
+def layout_arrays() -> dict[str, np.ndarray]:
+    t = synthetic_tree()
+    t = t.subtree(t.taxid[t.root])
+    res = {}
+    for name, (x, y, alpha, ray) in {
+        "archaea": (6.0, 9.660254 - 10.0, 30.0, 10.0),
+        "eukaryotes": (-6.0, 9.660254 - 10.0, 150.0, 10.0),
+        "bacteria": (0.0, -11.0, 270.0, 10.0),
+    }.items():
+        lay = compute_layout(t, x=x, y=y, alpha=alpha, ray=ray)
+        for field in LAYOUT_FIELDS:
+            res[f"{name}_{field}"] = getattr(lay, field)
+    return res
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Compare tree layout with the reference layout."
+    )
+    parser.add_argument(
+        "--update", action="store_true", help="Overwrite the reference layout"
+    )
+    args = parser.parse_args()
+
+    arrays = layout_arrays()
+    if args.update:
+        np.savez_compressed(GOLDEN_FILE, allow_pickle=False, **arrays)
+        logger.info(f"Reference layout written to {GOLDEN_FILE}")
+        sys.exit(0)
+
+    golden = np.load(GOLDEN_FILE)
+    different = [
+        key for key in golden.files if not np.array_equal(golden[key], arrays[key])
+    ]
+    if different:
+        logger.error(f"Layout differs from reference for: {', '.join(different)}")
+        sys.exit(1)
+    logger.info("Layout is identical to reference")
@@ -0,0 +1,220 @@
+"""
+Check the loading of the Solr cores against a local stub server.
+
+The stub implements the part of the Solr API used by solr_index: core
+STATUS, CREATE and SWAP, JSON updates, and document counts, with basic
+authentication. Synthetic documents files are loaded with several workers,
+and the check verifies that the live cores keep their previous documents
+until the swap, that all documents are loaded, and that a rollback brings
+the previous documents back. No Solr server is needed:
+
+    uv run python scripts/check_solr_index.py
+"""
+
+import base64
+import json
+import logging
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "tree"))
+
+import solr_index
+from config import SOLR_PASSWD, SOLR_USER
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Documents of the live cores before loading
+N_PREVIOUS = 5
+
+# Time in seconds taken by the stub to index a batch
+UPDATE_DELAY = 0.01
+
+
+class StubSolr:
+    """
+    State of the stub server: committed and pending documents of each core.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.committed = {
+            core: [{"previous": k} for k in range(N_PREVIOUS)]
+            for core in solr_index.CORES
+        }
+        self.pending = {core: list(docs) for core, docs in self.committed.items()}
+        # Number of live documents seen during the updates of build cores
+        self.live_counts: list[int] = []
+        self.running = 0
+        self.max_running = 0
+
+    def core_admin(self, params: dict[str, str]) -> dict:
+        action = params["action"]
+        with self.lock:
+            if action == "STATUS":
+                core = params["core"]
+                return {
+                    "status": {core: {"name": core} if core in self.committed else {}}
+                }
+            if action == "CREATE":
+                self.committed[params["name"]] = []
+                self.pending[params["name"]] = []
+                return {"core": params["name"]}
+            if action == "SWAP":
+                core, other = params["core"], params["other"]
+                for docs in (self.committed, self.pending):
+                    docs[core], docs[other] = docs[other], docs[core]
+                return {}
+        raise ValueError(f"Unknown action {action}")
+
+    def update(self, core: str, body: list | dict) -> None:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            if core.endswith("_build"):
+                self.live_counts.append(
+                    len(self.committed[core.removesuffix("_build")])
+                )
+        time.sleep(UPDATE_DELAY)
+        with self.lock:
+            self.running -= 1
+            if isinstance(body, list):
+                self.pending[core].extend(body)
+            elif "delete" in body:
+                self.pending[core] = []
+            elif "commit" in body:
+                self.committed[core] = list(self.pending[core])
+
+
+def stub_handler(solr: StubSolr) -> type[BaseHTTPRequestHandler]:
+    expected = (
+        "Basic " + base64.b64encode(f"{SOLR_USER}:{SOLR_PASSWD}".encode()).decode()
+    )
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, data: dict) -> None:
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self) -> bool:
+            if (
+                SOLR_PASSWD is not None
+                and self.headers.get("Authorization") != expected
+            ):
+                self.send_error(401)
+                return False
+            return True
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            parts = url.path.strip("/").split("/")
+            if parts[1:] == ["admin", "cores"]:
+                self._reply(solr.core_admin(params))
+            elif parts[2:] == ["select"]:
+                self._reply({"response": {"numFound": len(solr.committed[parts[1]])}})
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            parts = urlparse(self.path).path.strip("/").split("/")
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if parts[2:] != ["update"] or parts[1] not in solr.pending:
+                self.send_error(404)
+                return
+            solr.update(parts[1], body)
+            self._reply({"responseHeader": {"status": 0}})
+
+    return Handler
+
+
+def write_documents(directory: Path, n_docs: int) -> dict[str, int]:
+    """
+    Write synthetic documents files, and return the number of documents of each core.
+    """
+    counts = {}
+    for core, files in solr_index.CORES.items():
+        counts[core] = 0
+        for k, file in enumerate(files):
+            with open(directory / file, "w") as f:
+                f.writelines(
+                    json.dumps({"taxid": str(i), "sci_name": f'{core} "{k}"\\{i}'})
+                    + "\n"
+                    for i in range(n_docs)
+                )
+            counts[core] += n_docs
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Check Solr cores loading against a stub server."
+    )
+    parser.add_argument(
+        "--docs", type=int, default=20_000, help="Number of documents per file"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="Documents per update request"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Concurrent update requests"
+    )
+    args = parser.parse_args()
+
+    solr = StubSolr()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stub_handler(solr))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/solr"
+
+    with tempfile.TemporaryDirectory() as directory:
+        counts = write_documents(Path(directory), args.docs)
+        solr_index.load_cores(
+            url, Path(directory), batch_size=args.batch_size, workers=args.workers
+        )
+
+    errors = []
+    for core, n_docs in counts.items():
+        if len(solr.committed[core]) != n_docs:
+            errors.append(
+                f"{core} has {len(solr.committed[core])} documents instead of {n_docs}"
+            )
+        if len(solr.committed[solr_index.build_core(core)]) != N_PREVIOUS:
+            errors.append(
+                f"Previous documents of {core} are not kept in its build core"
+            )
+    if set(solr.live_counts) != {N_PREVIOUS}:
+        errors.append("Live cores changed before the end of loading")
+    if solr.max_running < min(args.workers, 2):
+        errors.append(f"Only {solr.max_running} concurrent update requests")
+
+    solr_index.rollback_cores(url)
+    if any(len(solr.committed[core]) != N_PREVIOUS for core in solr_index.CORES):
+        errors.append("Rollback didn't restore the previous documents")
+    server.shutdown()
+
+    if errors:
+        for error in errors:
+            logger.error(error)
+        sys.exit(1)
+    logger.info(
+        f"Cores loaded and swapped, with up to {solr.max_running} concurrent update requests"
+    )
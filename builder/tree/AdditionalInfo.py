@@ -2,8 +2,11 @@
 
 import logging
 
+import metrics
+import numpy as np
 import polars as pl
 from config import BUILD_DIRECTORY, GENOMES_DIRECTORY, TAXO_DIRECTORY
+from taxotree import subtree_sums, taxid_positions
 from utils import download_ftp_file_if_newer
 
 logger = logging.getLogger("LifemapBuilder")
@@ -17,58 +20,107 @@ def download_genomes() -> None:
             local_file=GENOMES_DIRECTORY / f"{name}.txt",
         )
         if genome_downloaded or not (GENOMES_DIRECTORY / f"{name}.parquet").exists():
-            d = pl.read_csv(
-                GENOMES_DIRECTORY / f"{name}.txt",
-                separator="\t",
-                infer_schema_length=20000,
-                null_values=["-"],
-                quote_char=None,
-            )
             # For the moment we only keep the total number of complete genomes
-            # by taxid
+            # by taxid, so only the TaxID and Status columns are parsed
             d = (
-                d.filter(pl.col("Status") == "Complete Genome")
+                pl.scan_csv(
+                    GENOMES_DIRECTORY / f"{name}.txt",
+                    separator="\t",
+                    infer_schema_length=20000,
+                    null_values=["-"],
+                    quote_char=None,
+                )
+                .filter(pl.col("Status") == "Complete Genome")
                 .group_by("TaxID")
                 .len(name="n")
                 .select(pl.col("TaxID").cast(pl.Utf8).alias("taxid"), pl.col("n"))
+                .collect()
             )
             d.write_parquet(GENOMES_DIRECTORY / f"{name}.parquet")
     eu = pl.read_parquet(GENOMES_DIRECTORY / "eukaryotes.parquet")
     pro = pl.read_parquet(GENOMES_DIRECTORY / "prokaryotes.parquet")
     genomes = eu.vstack(pro)
     genomes.write_parquet(GENOMES_DIRECTORY / "genomes.parquet")
+    metrics.add(rows=len(genomes))
     logger.info("Genomes info downloaded and saved to parquet.")
 
 
-def add_info(nbgroup: str):
-    #######################################################################################################################
-    ##                       NOW WE RETRIEVE WHAT WE WILL PUT IN THE JSON FILES
-    #######################################################################################################################
+def subtree_genomes(ascends: pl.DataFrame, genomes: pl.DataFrame) -> np.ndarray:
+    """
+    Number of complete genomes in the subtree of each node.
 
-    logger.info("  Loading data...")
-    ascends = pl.read_parquet(BUILD_DIRECTORY / f"ascends_{nbgroup}.parquet")
+    Parameters
+    ----------
+    ascends : pl.DataFrame
+        Taxid and ancestors of the nodes of one or several trees. The first
+        ancestor of a node is its parent, and the last one is LUCA.
+    genomes : pl.DataFrame
+        Number of complete genomes `n` of each taxid, taxids being unique.
 
-    genomes = pl.read_parquet(GENOMES_DIRECTORY / "genomes.parquet")
-    ages = pl.read_csv(TAXO_DIRECTORY / "timetreetimes.csv").with_columns(
-        pl.col("node").cast(pl.Utf8).alias("taxid"), pl.col("age").round(1)
+    Returns
+    -------
+    np.ndarray
+        Genomes of each node of `ascends` and of its descendants.
+    """
+    taxid = ascends.get_column("taxid").cast(pl.Int64).to_numpy()
+    parent = taxid_positions(
+        taxid, ascends.get_column("ascend").list.first().cast(pl.Int64).to_numpy()
+    )
+    depth = ascends.get_column("ascend").list.len().to_numpy() - 1
+    n_genomes = np.zeros(len(taxid), dtype=np.int64)
+    nodes = taxid_positions(
+        taxid, genomes.get_column("taxid").cast(pl.Int64).to_numpy()
     )
+    found = nodes >= 0
+    n_genomes[nodes[found]] = genomes.get_column("n").to_numpy()[found]
+    return subtree_sums(parent, depth, n_genomes)
 
-    addi = ascends
-    ascend = ascends.with_columns(pl.col("ascend").list.concat(pl.col("taxid"))).explode("ascend")
-    logger.info("  Merging additional data...")
-    n_genomes = (
-        ascend.join(genomes, left_on="taxid", right_on="taxid", how="left")
-        .with_columns(pl.col("n").fill_null(0))
-        .group_by("ascend")
-        .agg(genomes=pl.sum("n"))
-        .rename({"ascend": "taxid"})
+
+def add_info() -> None:
+    """
+    Compute the additional info of the nodes of all groups, and write it to
+    the ADDITIONAL.{nbgroup}.json files.
+
+    The number of complete genomes of each node is summed over its subtree
+    in a single bottom-up pass over the trees of all groups, whose parents
+    and depths are read from the ascends data frames.
+    """
+    logger.info("  Loading data...")
+    ascends = pl.concat(
+        [
+            pl.scan_parquet(BUILD_DIRECTORY / f"ascends_{i}.parquet").with_columns(
+                group=pl.lit(str(i))
+            )
+            for i in range(1, 4)
+        ]
+    ).collect()
+    genomes = (
+        pl.scan_parquet(GENOMES_DIRECTORY / "genomes.parquet")
+        .group_by("taxid")
+        .agg(pl.sum("n"))
+        .collect()
+    )
+    ages = (
+        pl.scan_csv(TAXO_DIRECTORY / "timetreetimes.csv")
+        .with_columns(
+            pl.col("node").cast(pl.Utf8).alias("taxid"), pl.col("age").round(1)
+        )
+        .collect()
     )
-    addi = addi.join(n_genomes, on="taxid", how="left").with_columns(pl.col("genomes").fill_null(0))
 
-    addi = addi.join(ages, on="taxid", how="left")
+    logger.info("  Summing genomes over subtrees...")
+    ascends = ascends.with_columns(genomes=subtree_genomes(ascends, genomes))
+    metrics.add(rows=len(ascends))
 
     logger.info("  Saving to json...")
-    addi.write_json(BUILD_DIRECTORY / f"ADDITIONAL.{nbgroup}.json")
+    for i in range(1, 4):
+        addi = (
+            ascends.filter(pl.col("group") == str(i))
+            .drop("group")
+            .with_columns(pl.col("ascend").cast(pl.List(pl.Utf8)))
+            .join(ages, on="taxid", how="left", maintain_order="left")
+        )
+        addi.write_ndjson(BUILD_DIRECTORY / f"ADDITIONAL.{i}.json")
 
 
 def merge_features() -> None:
@@ -76,8 +128,9 @@ def merge_features() -> None:
     features = []
     for i in range(1, 4):
         ascends = pl.read_parquet(BUILD_DIRECTORY / f"ascends_{i}.parquet")
-        tree_features = pl.read_json(BUILD_DIRECTORY / f"TreeFeatures{i}.json").select(
-            ["taxid", "sci_name", "zoom", "lat", "lon"]
+        tree_features = pl.read_parquet(
+            BUILD_DIRECTORY / f"TreeFeatures{i}.parquet",
+            columns=["taxid", "sci_name", "zoom", "lat", "lon"],
         )
         merged = tree_features.join(ascends, on="taxid", how="left")
         features.append(merged)
@@ -85,3 +138,4 @@ def merge_features() -> None:
     logger.info("  Combining and saving merged features...")
     features = pl.concat(features)
     features.write_parquet(BUILD_DIRECTORY / "TreeFeaturesComplete.parquet")
+    metrics.add(rows=len(features))
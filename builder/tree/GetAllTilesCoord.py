@@ -1,58 +1,553 @@
+"""
+Lists of the mod_tile tiles to prerender, and of the tiles to expire.
+
+Each node is prerendered at the zoom level where it appears, as written in
+TreeFeatures files, and, from zoom level 5, at the 3 previous zoom levels.
+At each of these zooms, all the tiles covered by the extent of the node
+features (point, branch from its parent and clade polygon) are listed, not
+only the tile of the node.
+
+The content of each node is summarized by a hash, saved with the position
+of its features for the next build. The metatiles covered by the features
+of the nodes which changed since the previous build, at all the zooms at
+which mod_tile draws them, are listed to be expired, whether they were
+prerendered or rendered on demand. When there are too many of them, no list
+is written and the whole tiles cache is removed.
+"""
+
+import logging
 import math
+from itertools import pairwise
+from pathlib import Path
 
+import numpy as np
+import polars as pl
 from config import BUILD_DIRECTORY
+from geometry import EARTH_RADIUS, to_web_mercator
+from taxotree import TaxoTree
+from Traverse import (
+    CHUNK_SIZE,
+    GROUP_ROOTS,
+    Layout,
+    branch_lines,
+    clade_rings,
+    group_layout,
+)
+
+logger = logging.getLogger("LifemapBuilder")
+
+TILES_FILE = BUILD_DIRECTORY / "XYZcoordinates"
+EXPIRED_TILES_FILE = BUILD_DIRECTORY / "XYZexpired"
+NODES_CONTENT_FILE = BUILD_DIRECTORY / "nodes_content.parquet"
+NEW_NODES_CONTENT_FILE = BUILD_DIRECTORY / "nodes_content_new.parquet"
+
+# Maximum prerendered zoom, and number of previous zooms prerendered
+MAX_ZOOM = 20
+PREVIOUS_ZOOMS = 3
+# Maximum zoom of the mod_tile maps, see back/mod_tile_deepzoom/renderd.conf
+RENDER_MAX_ZOOM = 40
+# mod_tile renders and stores tiles by metatiles of METATILE x METATILE tiles
+METATILE = 8
+# Above this number of expired metatiles, the whole tiles cache is removed
+MAX_EXPIRED_METATILES = 1_000_000
+# Labels and strokes are drawn up to this distance from geometries, in pixels
+TILE_MARGIN = 64
+# Start of the branch from LUCA to the root of each group
+LUCA = (0.0, -4.226497)
+# Features of each node, drawn at different zooms, see `feature_zooms`
+FEATURES = ("point", "clade", "branch")
+
+ORIGIN = math.pi * EARTH_RADIUS
+
+
+def tile_key(zoom: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Pack tile coordinates in a single uint64 key, ordered by zoom, x and y.
+    """
+    return (
+        (zoom.astype(np.uint64) << np.uint64(58))
+        | (x.astype(np.uint64) << np.uint64(29))
+        | y.astype(np.uint64)
+    )
+
+
+def tile_coords(keys: np.ndarray) -> np.ndarray:
+    """
+    Unpack tile keys as a (N, 3) array of x, y, zoom tile coordinates.
+    """
+    mask = np.uint64((1 << 29) - 1)
+    return np.stack(
+        (keys >> np.uint64(29) & mask, keys & mask, keys >> np.uint64(58)), axis=-1
+    ).astype(np.int64)
+
+
+def _segment_boxes(
+    start: np.ndarray, end: np.ndarray, size: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Extents of the pieces of segments cut in pieces at most `size` long, so
+    that long diagonal segments are not covered by their whole extent.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        (N, 4) array of xmin, ymin, xmax, ymax of pieces, and index of their
+        segment.
+    """
+    length = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+    pieces = np.maximum(np.ceil(length / size), 1).astype(np.int64)
+    segment = np.repeat(np.arange(len(start)), pieces)
+    k = np.arange(int(pieces.sum())) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    delta = (end - start)[segment]
+    p0 = start[segment] + delta * (k / pieces[segment])[:, None]
+    p1 = start[segment] + delta * ((k + 1) / pieces[segment])[:, None]
+    return np.concatenate((np.minimum(p0, p1), np.maximum(p0, p1)), axis=1), segment
+
 
+def node_extents(
+    t: TaxoTree, lay: Layout, zoom: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Extents of the features of each node displayed up to MAX_ZOOM: its point
+    and clade polygon, and its branch from its parent (or from LUCA for the
+    root) cut in pieces at most one tile long at the node zoom.
 
-def deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 2.0**zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int(
-        (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi)
-        / 2.0
-        * n
+    Parameters
+    ----------
+    t : TaxoTree
+        Tree.
+    lay : Layout
+        Tree layout.
+    zoom : np.ndarray
+        Zoom level of each node.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        (N, 4) array of xmin, ymin, xmax, ymax in EPSG:3857, and node of
+        each extent, sorted by node.
+    """
+    lower = np.stack((lay.x, lay.y), axis=-1)
+    upper = lower.copy()
+    clades = np.flatnonzero(~t.is_leaf & (zoom <= MAX_ZOOM))
+    for start in range(0, len(clades), CHUNK_SIZE):
+        chunk = clades[start : start + CHUNK_SIZE]
+        rings = clade_rings(
+            lay.x[chunk], lay.y[chunk], lay.ray[chunk], lay.alpha[chunk]
+        )
+        lower[chunk] = np.minimum(lower[chunk], rings.min(axis=1))
+        upper[chunk] = np.maximum(upper[chunk], rings.max(axis=1))
+    # Projection is monotonic in longitude and latitude
+    extents = [np.concatenate((to_web_mercator(lower), to_web_mercator(upper)), axis=1)]
+    owners = [np.arange(t.n_nodes)]
+
+    nodes = np.flatnonzero((t.parent >= 0) & (zoom <= MAX_ZOOM))
+    lines = to_web_mercator(branch_lines(lay, nodes, t.parent[nodes]))
+    luca = to_web_mercator(np.array([LUCA, (lay.x[0], lay.y[0])]))
+    start = np.concatenate((lines[:, 0], lines[:, 1], luca[:1]))
+    end = np.concatenate((lines[:, 1], lines[:, 2], luca[1:]))
+    segment_owner = np.concatenate((nodes, nodes, [0]))
+    size = 2 * ORIGIN / 2.0 ** np.minimum(zoom[segment_owner], MAX_ZOOM)
+    pieces, segment = _segment_boxes(start, end, size)
+    extents.append(pieces)
+    owners.append(segment_owner[segment])
+
+    owners = np.concatenate(owners)
+    order = np.argsort(owners, kind="stable")
+    return np.concatenate(extents)[order], owners[order]
+
+
+def node_hashes(t: TaxoTree, lay: Layout, groupnb: str) -> dict[str, np.ndarray]:
+    """
+    Hash of the attributes drawn by mod_tile for each feature of each node,
+    see the layers of back/mod_tile_deepzoom/style/lifemap_style.xml: its
+    point with its name, its clade polygon with its clade and rank names,
+    and its branch from its parent.
+
+    Hashes are stable between runs but not between polars versions, in
+    which case all features are expired once.
+    """
+    parent = np.where(t.parent >= 0, t.parent, 0)
+    attributes = pl.DataFrame(
+        {
+            "group": np.full(t.n_nodes, int(groupnb)),
+            "x": lay.x,
+            "y": lay.y,
+            "alpha": lay.alpha,
+            "ray": lay.ray,
+            "zoomview": lay.zoomview,
+            "nbdesc": lay.nbdesc,
+            "parent_x": lay.x[parent],
+            "parent_y": lay.y[parent],
+            "is_leaf": t.is_leaf,
+            "rank_en": t.rank_names("en"),
+        }
+    ).hstack(t.names.select("sci_name", "common_name_en"))
+    features = {
+        "point": [
+            "group",
+            "x",
+            "y",
+            "zoomview",
+            "nbdesc",
+            "is_leaf",
+            "sci_name",
+            "common_name_en",
+        ],
+        "clade": [
+            "group",
+            "x",
+            "y",
+            "alpha",
+            "ray",
+            "zoomview",
+            "nbdesc",
+            "is_leaf",
+            "sci_name",
+            "common_name_en",
+            "rank_en",
+        ],
+        "branch": ["group", "x", "y", "parent_x", "parent_y", "zoomview"],
+    }
+    return {
+        kind: attributes.select(columns).hash_rows(seed=0).to_numpy()
+        for kind, columns in features.items()
+    }
+
+
+def covered_tiles(
+    extents: np.ndarray, zooms: np.ndarray, margin: float = TILE_MARGIN
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keys of the tiles of a zoom covered by extents.
+
+    Parameters
+    ----------
+    extents : np.ndarray
+        (N, 4) array of xmin, ymin, xmax, ymax in EPSG:3857.
+    zooms : np.ndarray
+        Zoom level of each extent.
+    margin : float
+        Margin around extents, in pixels.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Tile keys of all extents, and index of the extent of each tile.
+    """
+    n = 2**zooms
+    size = 2 * ORIGIN / n
+    buffer = size * margin / 256
+    x0 = np.clip((extents[:, 0] - buffer + ORIGIN) // size, 0, n - 1).astype(np.int64)
+    x1 = np.clip((extents[:, 2] + buffer + ORIGIN) // size, 0, n - 1).astype(np.int64)
+    y0 = np.clip((ORIGIN - extents[:, 3] - buffer) // size, 0, n - 1).astype(np.int64)
+    y1 = np.clip((ORIGIN - extents[:, 1] + buffer) // size, 0, n - 1).astype(np.int64)
+
+    # Enumerate the tiles of each range, row by row
+    widths = x1 - x0 + 1
+    counts = widths * (y1 - y0 + 1)
+    index = np.repeat(np.arange(len(extents)), counts)
+    offset = np.arange(int(counts.sum())) - np.repeat(
+        np.cumsum(counts) - counts, counts
     )
-    return [xtile, ytile]
-
-
-##output
-
-
-def getXYZ(fi, coo):
-    zoom = False
-    lat = False
-    lon = False
-    with open(BUILD_DIRECTORY / fi) as f:
-        for line in f:
-            tmp = line.split(":")
-            if len(tmp) > 1:
-                key = tmp[0].replace('"', "").replace(" ", "")
-                val = tmp[1].replace('"', "").replace(" ", "").replace(",", "").rstrip()
-                if key == "zoom":
-                    zoom = val
-                if key == "lat":
-                    lat = val
-                if key == "lon":
-                    lon = val
-                    # do stuff
-                    if int(zoom) <= 20:
-                        # 						print zoom
-                        xy = deg2num(float(lat), float(lon), float(zoom))
-                        coo.write("%d %d %s\n" % (xy[0], xy[1], zoom))
-                        if int(zoom) >= 5:
-                            xy2 = deg2num(float(lat), float(lon), float(int(zoom) - 1))
-                            xy3 = deg2num(float(lat), float(lon), float(int(zoom) - 2))
-                            xy4 = deg2num(float(lat), float(lon), float(int(zoom) - 3))
-                            coo.write("%d %d %d\n" % (xy2[0], xy2[1], int(zoom) - 1))
-                            coo.write("%d %d %d\n" % (xy3[0], xy3[1], int(zoom) - 2))
-                            coo.write("%d %d %d\n" % (xy4[0], xy4[1], int(zoom) - 3))
-                    zoom = False
-                    lat = False
-                    lon = False
-
-
-def get_all_coords():
-    with open(BUILD_DIRECTORY / "XYZcoordinates", "w") as coo:
-        getXYZ("TreeFeatures1.json", coo)
-        getXYZ("TreeFeatures2.json", coo)
-        getXYZ("TreeFeatures3.json", coo)
+    x = x0[index] + offset % widths[index]
+    y = y0[index] + offset // widths[index]
+    return tile_key(zooms[index], x, y), index
+
+
+def prerendered_tiles(t: TaxoTree, lay: Layout) -> np.ndarray:
+    """
+    Sorted keys of the prerendered tiles of a group.
+    """
+    node_zoom = lay.zoomview.astype(np.int64) + 4
+    extents, owners = node_extents(t, lay, node_zoom)
+    # Extents of each chunk of nodes are contiguous
+    bounds = np.searchsorted(owners, np.arange(0, t.n_nodes + CHUNK_SIZE, CHUNK_SIZE))
+    keys = []
+    for shift in range(PREVIOUS_ZOOMS + 1):
+        shown = (node_zoom <= MAX_ZOOM) & ((shift == 0) | (node_zoom >= 5))
+        for lo, hi in pairwise(bounds):
+            chunk = lo + np.flatnonzero(shown[owners[lo:hi]])
+            chunk_keys, _ = covered_tiles(
+                extents[chunk], node_zoom[owners[chunk]] - shift
+            )
+            keys.append(np.unique(chunk_keys))
+    return np.unique(np.concatenate(keys))
+
+
+def node_content(t: TaxoTree, lay: Layout, groupnb: str) -> pl.DataFrame:
+    """
+    Hashes of the features of each node, see `node_hashes`, and their
+    position in EPSG:3857: its point, the extent of its clade polygon (null
+    for leaves), and its branch from its parent (or from LUCA for the root)
+    as a line of 3 points.
+    """
+    lower = np.full((t.n_nodes, 2), np.nan)
+    upper = np.full((t.n_nodes, 2), np.nan)
+    clades = np.flatnonzero(~t.is_leaf)
+    for start in range(0, len(clades), CHUNK_SIZE):
+        chunk = clades[start : start + CHUNK_SIZE]
+        rings = clade_rings(
+            lay.x[chunk], lay.y[chunk], lay.ray[chunk], lay.alpha[chunk]
+        )
+        lower[chunk] = rings.min(axis=1)
+        upper[chunk] = rings.max(axis=1)
+    # Projection is monotonic in longitude and latitude
+    lower, upper = to_web_mercator(lower), to_web_mercator(upper)
+
+    lines = np.empty((t.n_nodes, 3, 2))
+    nodes = np.flatnonzero(t.parent >= 0)
+    lines[nodes] = branch_lines(lay, nodes, t.parent[nodes])
+    lines[0] = [LUCA, (lay.x[0], lay.y[0]), (lay.x[0], lay.y[0])]
+    lines = to_web_mercator(lines)
+    point = to_web_mercator(np.stack((lay.x, lay.y), axis=-1))
+
+    hashes = node_hashes(t, lay, groupnb)
+    return pl.DataFrame(
+        {
+            "taxid": t.taxid,
+            **{f"{kind}_hash": hashes[kind] for kind in FEATURES},
+            "zoomview": lay.zoomview.astype(np.int32),
+            "x": point[:, 0],
+            "y": point[:, 1],
+            "clade_xmin": lower[:, 0],
+            "clade_ymin": lower[:, 1],
+            "clade_xmax": upper[:, 0],
+            "clade_ymax": upper[:, 1],
+            **{
+                f"branch_{axis}{k}": lines[:, k, i]
+                for k in range(3)
+                for i, axis in enumerate("xy")
+            },
+        },
+        nan_to_null=True,
+    )
+
+
+def changed_nodes(previous: pl.DataFrame, current: pl.DataFrame) -> pl.DataFrame:
+    """
+    Content of the nodes with features added, removed or changed between two
+    builds, as they were in the previous build and as they are now, with a
+    "<feature>_changed" flag for each feature instead of its hash.
+    """
+    hashes = [f"{kind}_hash" for kind in FEATURES]
+    flags = (
+        previous.select("taxid", *hashes)
+        .join(current.select("taxid", *hashes), on="taxid", how="full", coalesce=True)
+        .select(
+            "taxid",
+            *[
+                pl.col(f"{kind}_hash")
+                .ne_missing(pl.col(f"{kind}_hash_right"))
+                .alias(f"{kind}_changed")
+                for kind in FEATURES
+            ],
+        )
+        .filter(pl.any_horizontal(f"{kind}_changed" for kind in FEATURES))
+    )
+    return pl.concat([previous, current]).drop(hashes).join(flags, on="taxid")
+
+
+def feature_zooms(zoomview: np.ndarray) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    First and last zooms at which mod_tile draws the features of nodes, as
+    set by the scale denominators of the rules of their zoomview in
+    back/mod_tile_deepzoom/style/lifemap_style.xml:
+
+    - tip and node names from their zoomview, up to the maximum zoom;
+    - clade polygons, with their clade and rank names, from their zoomview
+      to 4 zooms further;
+    - branches from zoom 0 to 11 zooms after their zoomview, and up to the
+      maximum zoom for zoomviews 0 and 1.
+    """
+    zoomview = zoomview.astype(np.int64)
+    return {
+        "point": (zoomview, np.full(len(zoomview), RENDER_MAX_ZOOM)),
+        "clade": (zoomview, zoomview + 4),
+        "branch": (
+            np.zeros(len(zoomview), dtype=np.int64),
+            np.where(zoomview <= 1, RENDER_MAX_ZOOM, zoomview + 11),
+        ),
+    }
+
+
+def _metatile_ranges(
+    extents: np.ndarray, zoom: int, margin: float = TILE_MARGIN
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Ranges of the metatiles of a zoom covered by extents, as x0, x1, y0, y1
+    in metatiles.
+    """
+    n = max(2**zoom // METATILE, 1)
+    size = 2 * ORIGIN / n
+    buffer = 2 * ORIGIN / 2**zoom * margin / 256
+    x0 = np.clip((extents[:, 0] - buffer + ORIGIN) // size, 0, n - 1).astype(np.int64)
+    x1 = np.clip((extents[:, 2] + buffer + ORIGIN) // size, 0, n - 1).astype(np.int64)
+    y0 = np.clip((ORIGIN - extents[:, 3] - buffer) // size, 0, n - 1).astype(np.int64)
+    y1 = np.clip((ORIGIN - extents[:, 1] + buffer) // size, 0, n - 1).astype(np.int64)
+    return x0, x1, y0, y1
+
+
+def expired_metatiles(nodes: pl.DataFrame) -> dict[int, np.ndarray] | None:
+    """
+    Metatiles covered by the changed features of nodes, at all the zooms at
+    which they are drawn.
+
+    Parameters
+    ----------
+    nodes : pl.DataFrame
+        Content of changed nodes, see `changed_nodes`.
+
+    Returns
+    -------
+    dict[int, np.ndarray] | None
+        Sorted distinct x, y coordinates in metatiles of the expired
+        metatiles of each zoom, or None if more than MAX_EXPIRED_METATILES
+        metatiles would have to be enumerated.
+    """
+    zooms = feature_zooms(nodes.get_column("zoomview").to_numpy())
+    changed = {
+        kind: nodes.get_column(f"{kind}_changed").to_numpy() for kind in FEATURES
+    }
+    point = nodes.select("x", "y").to_numpy()
+    clade = nodes.select(
+        "clade_xmin", "clade_ymin", "clade_xmax", "clade_ymax"
+    ).to_numpy()
+    changed["clade"] &= ~np.isnan(clade[:, 0])
+    boxes = {
+        "point": np.concatenate((point, point), axis=1)[changed["point"]],
+        "clade": clade[changed["clade"]],
+    }
+
+    # Both segments of each branch
+    lines = nodes.select([f"branch_{axis}{k}" for k in range(3) for axis in "xy"])
+    lines = lines.to_numpy().reshape(-1, 3, 2)[changed["branch"]]
+    start = np.concatenate((lines[:, 0], lines[:, 1]))
+    end = np.concatenate((lines[:, 1], lines[:, 2]))
+    length = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+    branch_first, branch_last = (
+        np.tile(bound[changed["branch"]], 2) for bound in zooms["branch"]
+    )
+
+    expired = {}
+    total = 0
+    for zoom in range(RENDER_MAX_ZOOM + 1):
+        # Segments are cut in pieces at most one metatile long, so that long
+        # diagonal segments are not covered by their whole extent
+        size = 2 * ORIGIN / max(2**zoom // METATILE, 1)
+        shown = (branch_first <= zoom) & (branch_last >= zoom)
+        total += int(np.maximum(np.ceil(length[shown] / size), 1).sum())
+        if total > MAX_EXPIRED_METATILES:
+            return None
+        pieces, _ = _segment_boxes(start[shown], end[shown], np.full(shown.sum(), size))
+
+        extents = [pieces]
+        for kind, kind_boxes in boxes.items():
+            first, last = (bound[changed[kind]] for bound in zooms[kind])
+            extents.append(kind_boxes[(first <= zoom) & (last >= zoom)])
+        extents = np.concatenate(extents)
+        x0, x1, y0, y1 = _metatile_ranges(extents, zoom)
+        widths = x1 - x0 + 1
+        counts = widths * (y1 - y0 + 1)
+        total += int(counts.sum())
+        if total > MAX_EXPIRED_METATILES:
+            return None
+
+        # Enumerate the metatiles of each range, row by row
+        index = np.repeat(np.arange(len(extents)), counts)
+        offset = np.arange(int(counts.sum())) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        x = x0[index] + offset % widths[index]
+        y = y0[index] + offset // widths[index]
+        if len(x):
+            expired[zoom] = np.unique(np.stack((x, y), axis=-1), axis=0)
+    return expired
+
+
+def write_tiles(path: Path, keys: np.ndarray) -> None:
+    """
+    Write tiles as "x y zoom" lines, the input format of render_list.
+    """
+    coords = tile_coords(keys)
+    pl.DataFrame(
+        {"x": coords[:, 0], "y": coords[:, 1], "zoom": coords[:, 2]}
+    ).write_csv(path, separator=" ", include_header=False)
+
+
+def write_expired(path: Path, expired: dict[int, np.ndarray]) -> None:
+    """
+    Write expired metatiles as "zoom/x/y" lines of the tile at their origin,
+    the input format of render_expired, by increasing zoom.
+    """
+    zooms, x, y = [np.empty(0, dtype=np.int64)], [], []
+    for zoom, metatiles in expired.items():
+        tiles = np.minimum(metatiles * METATILE, 2**zoom - 1)
+        zooms.append(np.full(len(tiles), zoom))
+        x.append(tiles[:, 0])
+        y.append(tiles[:, 1])
+    pl.DataFrame(
+        {
+            "zoom": np.concatenate(zooms),
+            "x": np.concatenate([zooms[0], *x]),
+            "y": np.concatenate([zooms[0], *y]),
+        }
+    ).write_csv(path, separator="/", include_header=False)
+
+
+def get_all_coords(tree: TaxoTree) -> None:
+    """
+    Write the list of prerendered tiles in XYZcoordinates, and the list of
+    the metatiles to expire since the previous published build in
+    XYZexpired. The expired list is not written if there is no previous
+    build or if there are too many expired metatiles, in which case the
+    whole tiles cache must be removed.
+
+    The content of the nodes is saved in NEW_NODES_CONTENT_FILE, until the
+    build tables are published with `publish_nodes_content`.
+
+    Parameters
+    ----------
+    tree : TaxoTree
+        Global tree.
+    """
+    keys, nodes = [], []
+    for groupnb in GROUP_ROOTS:
+        t, lay = group_layout(tree, groupnb)
+        keys.append(prerendered_tiles(t, lay))
+        nodes.append(node_content(t, lay, groupnb))
+    keys = np.unique(np.concatenate(keys))
+    write_tiles(TILES_FILE, keys)
+    logger.info(f"  {len(keys)} tiles written to {TILES_FILE}")
+
+    nodes = pl.concat(nodes)
+    EXPIRED_TILES_FILE.unlink(missing_ok=True)
+    if NODES_CONTENT_FILE.exists():
+        changed = changed_nodes(pl.read_parquet(NODES_CONTENT_FILE), nodes)
+        expired = expired_metatiles(changed)
+        if expired is None:
+            logger.info(
+                f"  {changed.get_column('taxid').n_unique()} changed nodes cover more than "
+                f"{MAX_EXPIRED_METATILES} metatiles, the tiles cache must be removed"
+            )
+        else:
+            write_expired(EXPIRED_TILES_FILE, expired)
+            logger.info(
+                f"  {sum(len(metatiles) for metatiles in expired.values())} metatiles of "
+                f"{changed.get_column('taxid').n_unique()} changed nodes written to {EXPIRED_TILES_FILE}"
+            )
+    else:
+        logger.info(
+            "  No nodes content of previous build, the tiles cache must be removed"
+        )
+
+    nodes.write_parquet(NEW_NODES_CONTENT_FILE)
+
+
+def publish_nodes_content() -> None:
+    """
+    Keep the nodes content of the build whose tables were just published, as
+    reference for the next build.
+    """
+    if NEW_NODES_CONTENT_FILE.exists():
+        NEW_NODES_CONTENT_FILE.replace(NODES_CONTENT_FILE)
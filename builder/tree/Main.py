@@ -1,35 +1,71 @@
 import gc
 import logging
+import multiprocessing
 import sys
+import time
 from argparse import ArgumentParser
+from collections.abc import Set as AbstractSet
 from pathlib import Path
+from typing import Literal
 
 import AdditionalInfo
 import check_ranks
 import db
 import export_data
 import export_metadata
+import geometry
 import GetAllTilesCoord
 import getTrees
+import incremental
+import metrics
+import mvt
+import pipeline
+import pmtiles_archive
+import solr_index
+import taxotree
 import Traverse
+import vector_tiles
 from config import (
     BUILD_DIRECTORY,
     GENOMES_DIRECTORY,
+    LMDATA_DIRECTORY,
+    TAXO_DIRECTORY,
 )
+from taxotree import TaxoTree
+from utils import get_translations_fr
 
 # Init logging
 log_path = BUILD_DIRECTORY / "builder.log"
 logger = logging.getLogger("LifemapBuilder")
-logger.handlers.clear()
-fh = logging.FileHandler(log_path, mode="w")
-ch = logging.StreamHandler(stream=sys.stdout)
-# formatter = logging.Formatter("%(asctime)s   %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-# ch.setFormatter(formatter)
-# fh.setFormatter(formatter)
-logger.addHandler(ch)
-logger.addHandler(fh)
-logger.setLevel(logging.DEBUG)
-logger.propagate = False
+# Worker processes of the parallel traversal import this module again, and
+# must not truncate the log file
+if multiprocessing.parent_process() is None:
+    logger.handlers.clear()
+    fh = logging.FileHandler(log_path, mode="w")
+    ch = logging.StreamHandler(stream=sys.stdout)
+    # formatter = logging.Formatter("%(asctime)s   %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    # ch.setFormatter(formatter)
+    # fh.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.addHandler(fh)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+
+# Stages of the build, in execution order
+STAGES = [
+    "taxonomy",
+    "traversal",
+    "pmtiles",
+    "publish",
+    "genomes",
+    "add_info",
+    "merge",
+    "lmdata",
+    "metadata",
+    "check_ranks",
+    "solr",
+]
 
 
 def lifemap_build(
@@ -40,116 +76,385 @@ def lifemap_build(
     skip_rdata: bool = False,
     skip_index: bool = False,
     disable_progress: bool = False,
+    traversal_workers: int = 1,
+    incremental_update: bool = False,
+    index_workers: int = 1,
+    maintenance_work_mem: str | None = None,
+    skip_pmtiles: bool = False,
+    pmtiles_minzoom: int = 0,
+    pmtiles_maxzoom: int = 8,
+    tile_workers: int = 1,
+    skip_solr: bool = False,
+    solr_workers: int = 4,
+    solr_batch_size: int = solr_index.BATCH_SIZE,
+    lmdata_layout: Literal["preorder", "client"] = "preorder",
+    rerun: AbstractSet[str] = frozenset(),
+    slowdown_threshold: float = metrics.SLOWDOWN_THRESHOLD,
 ) -> None:
+    """
+    Run the stages of the build which are not up to date.
+
+    Stages are checkpointed in the build manifest, so that a build resumes
+    from the first stage which failed or whose inputs changed. Stages in
+    `rerun` are run even if they are up to date. The metrics of the stages
+    are written to build_metrics.json, and stages slower than in the
+    previous build by more than `slowdown_threshold` are flagged.
+    """
     logger.info("-- Creating genomes directory if needed")
     Path(GENOMES_DIRECTORY).mkdir(exist_ok=True)
     logger.info("-- Done")
 
-    ## get the tree and update database
-    if skip_traversal:
-        logger.info("--- Skipping tree traversal as requested ---")
-    else:
-        logger.info("-- CREATING DATABASE")
+    # The tree is shared by the traversal and vector tiles stages, and only
+    # built if one of them runs
+    trees = {}
+
+    def get_tree() -> TaxoTree:
+        if "tree" not in trees:
+            logger.info("---- Building NCBI tree...")
+            tree = getTrees.getTheTrees()
+            trees["tree"] = Traverse.simplify_tree(tree) if simplify else tree
+        return trees["tree"]
+
+    def update_taxonomy() -> None:
         logger.info("---- Updating NCBI database...")
         Traverse.updateDB()
-        logger.info("---- Building NCBI tree...")
-        tree = getTrees.getTheTrees()
-        if simplify:
-            tree = Traverse.simplify_tree(tree)
-        logger.info("---- Initialize Postgis database ----")
-        db.init_db()
-        logger.info("---- Doing Archaeal tree...")
-        ndid = Traverse.traverse_tree(tree, groupnb="1", starti=1, disable_progress=disable_progress)
-        logger.info("---- Done")
-        logger.info("---- Doing Eukaryotic tree... start at id: %s" % ndid)
-        ndid = Traverse.traverse_tree(tree, groupnb="2", starti=ndid, disable_progress=disable_progress)
-        logger.info("---- Done")
-        logger.info("---- Doing Bact tree... start at id:%s " % ndid)
-        ndid = Traverse.traverse_tree(tree, groupnb="3", starti=ndid, disable_progress=disable_progress)
-        logger.info("---- Done")
-        logger.info("---- Create Postgis geometries ----")
-        db.create_geometries()
-        logger.info("---- Done")
-        del tree
-
-    # Garbage collect
-    gc.collect()
-
-    # Copy postgis data to production tables
-    logger.info("-- Copy postgis data to production tables --")
-    db.copy_db_to_prod()
-    logger.info("-- Done --")
-
-    logger.info("-- Creating indexes... ")
-    db.create_index()
-    logger.info("-- Done")
+        get_translations_fr()
 
-    # Garbage collect
-    gc.collect()
+    def traverse() -> None:
+        tree = get_tree()
+        previous_sizes = db.table_sizes("_prod")
+        start = time.perf_counter()
+        updated = incremental_update and incremental.update_tables(
+            tree, simplify, disable_progress=disable_progress
+        )
+        if updated:
+            logger.info(f"---- Tables updated in {time.perf_counter() - start:.1f}s")
+        else:
+            logger.info("---- Initialize Postgis database ----")
+            incremental.clear_build_state()
+            db.init_db()
+            Traverse.traverse_trees(
+                tree, workers=traversal_workers, disable_progress=disable_progress
+            )
+            logger.info(f"---- Trees traversed in {time.perf_counter() - start:.1f}s")
+        incremental.save_build_state(simplify)
+        sizes = db.table_sizes()
+        for table, size in sizes.items():
+            logger.info(
+                f"---- Table {table}: {size / 1024**2:.1f} MB "
+                f"(previous build: {previous_sizes[table] / 1024**2:.1f} MB)"
+            )
+        metrics.add(rows=tree.n_nodes, bytes_written=sum(sizes.values()))
+        ## Get New coordinates for generating tiles
+        logger.info("---- Get new tiles coordinates")
+        GetAllTilesCoord.get_all_coords(tree)
 
-    ## Get additional info
-    if skip_add_info:
-        logger.info("--- Skipping additional info as requested ---")
-    else:
-        logger.info("-- Downloading genomes if needed...")
-        AdditionalInfo.download_genomes()
-        logger.info("-- Getting additional Archaeal info...")
-        AdditionalInfo.add_info(nbgroup="1")
-        logger.info("-- Done")
-        logger.info("-- Getting additional Euka info...")
-        AdditionalInfo.add_info(nbgroup="2")
-        logger.info("-- Done")
-        logger.info("-- Getting additional Bacter info...")
-        AdditionalInfo.add_info(nbgroup="3")
-        logger.info("-- Done")
-        logger.info("-- Combining tree and additional features...")
-        AdditionalInfo.merge_features()
-        logger.info("-- Done")
-
-    # Garbage collect
-    gc.collect()
+    def write_pmtiles() -> None:
+        vector_tiles.write_pmtiles(
+            get_tree(),
+            min_zoom=pmtiles_minzoom,
+            max_zoom=pmtiles_maxzoom,
+            workers=tile_workers,
+            disable_progress=disable_progress,
+        )
+
+    # Index build tables, then swap them in as production tables
+    def publish() -> None:
+        # The tree isn't used by the next stages
+        trees.clear()
+        gc.collect()
+        if not db.build_tables_exist():
+            logger.info("--- No build tables to publish ---")
+            return
+        logger.info("---- Creating indexes... ")
+        db.create_index(
+            workers=index_workers, maintenance_work_mem=maintenance_work_mem
+        )
+        logger.info("---- Publishing postgis data to production tables --")
+        db.publish_tables()
+        GetAllTilesCoord.publish_nodes_content()
 
     ## Write whole data to Rdada file for use in R package LifemapR (among others)
-    if skip_rdata:
-        logger.info("--- Skipping Rdata export as requested ---")
-    else:
-        logger.info("-- Exporting data to parquet and Rdata...")
+    def export_lmdata() -> None:
         export_data.clean_lmdata()
-        export_data.export_lmdata()
-        logger.info("-- Done ")
-
-    ## Get New coordinates for generating tiles
-    logger.info("-- Get new tiles coordinates")
-    GetAllTilesCoord.get_all_coords()
-    logger.info("-- Done")
+        export_data.export_lmdata(layout=lmdata_layout)
 
-    # Export metadata to metadata.json
-    logger.info("-- Export metadata.json")
-    export_metadata.export_metadata()
-    logger.info("-- Done")
+    taxonomy_files = [*getTrees.SNAPSHOT_SOURCES, TAXO_DIRECTORY / "ranks.csv"]
+    groups = range(1, 4)
+    features_files = [BUILD_DIRECTORY / f"TreeFeatures{i}.parquet" for i in groups]
+    ascends_files = [BUILD_DIRECTORY / f"ascends_{i}.parquet" for i in groups]
+    stages = [
+        pipeline.Stage(
+            "taxonomy",
+            update_taxonomy,
+            outputs=[TAXO_DIRECTORY / "taxdump.tar.gz", *getTrees.SNAPSHOT_SOURCES],
+            cached=False,
+        ),
+        pipeline.Stage(
+            "traversal",
+            traverse,
+            inputs=taxonomy_files,
+            outputs=[
+                *features_files,
+                *(BUILD_DIRECTORY / f"TreeFeatures{i}.json" for i in groups),
+                *ascends_files,
+                incremental.BUILD_STATE_FILE,
+                GetAllTilesCoord.TILES_FILE,
+            ],
+            modules=[
+                getTrees,
+                taxotree,
+                Traverse,
+                incremental,
+                db,
+                geometry,
+                GetAllTilesCoord,
+            ],
+            params={"simplify": simplify},
+        ),
+        pipeline.Stage(
+            "pmtiles",
+            write_pmtiles,
+            inputs=taxonomy_files,
+            outputs=[vector_tiles.PMTILES_FILE],
+            modules=[
+                getTrees,
+                taxotree,
+                Traverse,
+                geometry,
+                mvt,
+                pmtiles_archive,
+                vector_tiles,
+            ],
+            params={
+                "simplify": simplify,
+                "min_zoom": pmtiles_minzoom,
+                "max_zoom": pmtiles_maxzoom,
+            },
+        ),
+        pipeline.Stage(
+            "publish", publish, modules=[db, GetAllTilesCoord], after=["traversal"]
+        ),
+        pipeline.Stage(
+            "genomes",
+            AdditionalInfo.download_genomes,
+            outputs=[GENOMES_DIRECTORY / "genomes.parquet"],
+            cached=False,
+        ),
+        pipeline.Stage(
+            "add_info",
+            AdditionalInfo.add_info,
+            inputs=[
+                *ascends_files,
+                GENOMES_DIRECTORY / "genomes.parquet",
+                TAXO_DIRECTORY / "timetreetimes.csv",
+            ],
+            outputs=[BUILD_DIRECTORY / f"ADDITIONAL.{i}.json" for i in groups],
+            modules=[AdditionalInfo, taxotree],
+        ),
+        pipeline.Stage(
+            "merge",
+            AdditionalInfo.merge_features,
+            inputs=[*features_files, *ascends_files],
+            outputs=[BUILD_DIRECTORY / "TreeFeaturesComplete.parquet"],
+            modules=[AdditionalInfo],
+        ),
+        pipeline.Stage(
+            "lmdata",
+            export_lmdata,
+            inputs=[BUILD_DIRECTORY / "TreeFeaturesComplete.parquet"],
+            outputs=[
+                LMDATA_DIRECTORY / "lmdata.parquet",
+                LMDATA_DIRECTORY / "lmdata_R.parquet",
+            ],
+            modules=[export_data, taxotree],
+            params={"layout": lmdata_layout},
+        ),
+        pipeline.Stage(
+            "metadata",
+            export_metadata.export_metadata,
+            inputs=[TAXO_DIRECTORY / "taxdump.tar.gz"],
+            outputs=[BUILD_DIRECTORY / "metadata.json"],
+            modules=[export_metadata],
+            after=["publish"],
+        ),
+        # Check for missing rank translations
+        pipeline.Stage(
+            "check_ranks",
+            check_ranks.check_ranks,
+            inputs=[TAXO_DIRECTORY / "ranks.csv"],
+            modules=[check_ranks],
+            after=["publish"],
+        ),
+        # Load Solr build cores, then swap them in as live cores
+        pipeline.Stage(
+            "solr",
+            lambda: solr_index.load_cores(
+                batch_size=solr_batch_size, workers=solr_workers
+            ),
+            inputs=[
+                BUILD_DIRECTORY / file
+                for files in solr_index.CORES.values()
+                for file in files
+            ],
+            modules=[solr_index],
+        ),
+    ]
+    assert [stage.name for stage in stages] == STAGES
 
-    # Check for missing rank translations
-    logger.info("-- Check for missing rank translations")
-    check_ranks.check_ranks()
-    logger.info("-- Done")
+    skip = set()
+    if skip_traversal:
+        skip |= {"taxonomy", "traversal", "pmtiles"}
+    if skip_pmtiles:
+        skip.add("pmtiles")
+    if skip_index:
+        skip.add("publish")
+    if skip_add_info:
+        skip |= {"genomes", "add_info", "merge"}
+    if skip_merge_jsons:
+        skip.add("merge")
+    if skip_rdata:
+        skip.add("lmdata")
+    if skip_solr:
+        skip.add("solr")
+    pipeline.run_stages(
+        stages,
+        skip=skip,
+        rerun=set(STAGES) if "all" in rerun else set(rerun),
+        slowdown_threshold=slowdown_threshold,
+    )
 
 
 if __name__ == "__main__":
-    parser = ArgumentParser(description="Perform all Lifemap tree analysis, cleaning previous data if any.")
+    parser = ArgumentParser(
+        description="Perform all Lifemap tree analysis, cleaning previous data if any."
+    )
     parser.add_argument(
         "--simplify",
         action="store_true",
         help="Should the tree be simplified by removing environmental and unidentified species?",
     )
-    parser.add_argument("--skip-traversal", action="store_true", help="Skip tree building")
-    parser.add_argument("--skip-add-info", action="store_true", help="Skip additional info")
-    parser.add_argument("--skip-merge-jsons", action="store_true", help="Skip JSONs merging")
+    parser.add_argument(
+        "--skip-traversal", action="store_true", help="Skip tree building"
+    )
+    parser.add_argument(
+        "--skip-add-info", action="store_true", help="Skip additional info"
+    )
+    parser.add_argument(
+        "--skip-merge-jsons",
+        action="store_true",
+        help="Skip merging of tree and additional features",
+    )
     parser.add_argument("--skip-rdata", action="store_true", help="Skip Rdata export")
-    parser.add_argument("--skip-index", action="store_true", help="Skip index creation")
-    parser.add_argument("--disable-progress", action="store_true", help="Disable progress bars")
+    parser.add_argument(
+        "--skip-index",
+        action="store_true",
+        help="Skip index creation and publication of the build tables",
+    )
+    parser.add_argument(
+        "--lmdata-layout",
+        choices=["preorder", "client"],
+        default="preorder",
+        help="Rows order of the lmdata parquet files: preorder, or sorted by kingdom and zoom with "
+        "per-kingdom files for selective reads by clients",
+    )
+    parser.add_argument(
+        "--rerun",
+        nargs="+",
+        choices=[*STAGES, "all"],
+        default=[],
+        metavar="STAGE",
+        help=f"Run these stages even if they are up to date, among {', '.join(STAGES)}, or all",
+    )
+    parser.add_argument(
+        "--slowdown-threshold",
+        type=float,
+        default=metrics.SLOWDOWN_THRESHOLD,
+        help="Relative increase of wall time above which a stage is flagged as slower than in the "
+        "previous build, such as 0.2 for 20%%",
+    )
+    parser.add_argument(
+        "--disable-progress", action="store_true", help="Disable progress bars"
+    )
+    parser.add_argument(
+        "--traversal-workers",
+        type=int,
+        default=1,
+        help="Number of processes used to traverse Archaea, Eukaryotes and Bacteria trees in parallel",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Swap the previous production tables back in, and exit",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only update records changed since the previous build, if possible",
+    )
+    parser.add_argument(
+        "--index-workers",
+        type=int,
+        default=1,
+        help="Number of tables indexed, clustered and analyzed concurrently",
+    )
+    parser.add_argument(
+        "--maintenance-work-mem",
+        default=None,
+        help="maintenance_work_mem of each indexing connection, such as 1GB (server default if not given)",
+    )
+    parser.add_argument(
+        "--skip-pmtiles", action="store_true", help="Skip vector tiles generation"
+    )
+    parser.add_argument(
+        "--pmtiles-minzoom",
+        type=int,
+        default=0,
+        help="Minimum zoom of generated vector tiles",
+    )
+    parser.add_argument(
+        "--pmtiles-maxzoom",
+        type=int,
+        default=8,
+        help="Maximum zoom of generated vector tiles",
+    )
+    parser.add_argument(
+        "--tile-workers",
+        type=int,
+        default=1,
+        help="Number of processes encoding vector tiles",
+    )
+    parser.add_argument(
+        "--skip-solr", action="store_true", help="Skip Solr cores loading"
+    )
+    parser.add_argument(
+        "--solr-workers",
+        type=int,
+        default=4,
+        help="Number of concurrent Solr update requests",
+    )
+    parser.add_argument(
+        "--solr-batch-size",
+        type=int,
+        default=solr_index.BATCH_SIZE,
+        help="Number of documents per Solr update request",
+    )
 
     args = parser.parse_args()
 
+    if args.rollback:
+        db.rollback_prod()
+        # The next build must generate the build tables again
+        incremental.clear_build_state()
+        invalidated = ["traversal"]
+        if not args.skip_solr:
+            solr_index.rollback_cores()
+            invalidated.append("solr")
+        pipeline.invalidate(invalidated)
+        # Tiles of the next build must be compared with the restored tables
+        GetAllTilesCoord.NODES_CONTENT_FILE.unlink(missing_ok=True)
+        sys.exit(0)
+
     # Build or update tree
     lifemap_build(
         simplify=args.simplify,
@@ -159,4 +464,18 @@ if __name__ == "__main__":
         skip_rdata=args.skip_rdata,
         skip_index=args.skip_index,
         disable_progress=args.disable_progress,
+        traversal_workers=args.traversal_workers,
+        incremental_update=args.incremental,
+        index_workers=args.index_workers,
+        maintenance_work_mem=args.maintenance_work_mem,
+        skip_pmtiles=args.skip_pmtiles,
+        pmtiles_minzoom=args.pmtiles_minzoom,
+        pmtiles_maxzoom=args.pmtiles_maxzoom,
+        tile_workers=args.tile_workers,
+        skip_solr=args.skip_solr,
+        solr_workers=args.solr_workers,
+        solr_batch_size=args.solr_batch_size,
+        lmdata_layout=args.lmdata_layout,
+        rerun=set(args.rerun),
+        slowdown_threshold=args.slowdown_threshold,
     )
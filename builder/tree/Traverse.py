@@ -6,16 +6,32 @@
 # Added possibility to have groups containing only one descendants to be visible. Adds a few zoom levels (not so many)
 
 import logging
-import math
+import multiprocessing
 import os
+import sys
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass
+from itertools import pairwise
 from typing import Literal
 
+import metrics
 import numpy as np
 import polars as pl
+import pyarrow.parquet as pq
 
 # import cPickle as pickle
 from config import BUILD_DIRECTORY, LANG_LIST, TAXO_DIRECTORY
-from db import db_connection
+from db import TABLES, CopyWriter, db_connection
+from geometry import (
+    EARTH_RADIUS,
+    ewkb_linestrings,
+    ewkb_points,
+    ewkb_polygons,
+    to_web_mercator,
+)
+from taxotree import NAME_COLUMNS, TaxoTree, list_series
 from tqdm import tqdm
 from utils import download_ftp_file_if_newer
 
@@ -23,6 +39,26 @@ from utils import download_ftp_file_if_newer
 
 logger = logging.getLogger("LifemapBuilder")
 
+# Number of nodes whose records are built and held in memory at once
+CHUNK_SIZE = 50_000
+
+# Root taxid of each group: Archaea, Eukaryotes and Bacteria
+GROUP_ROOTS = {"1": "2157", "2": "2759", "3": "2"}
+
+# Tile zooms served from the generalized branches_lowzoom and polygons_lowzoom tables
+LOWZOOM_ZOOMS = range(9)
+# Maximum distance between generalized and full resolution geometries, in pixels
+GENERALIZE_TOLERANCE = 0.25
+# Possible numbers of steps of generalized clade outlines halves, full ones having 30
+LOWZOOM_STEPS = np.array([4, 6, 8, 12, 16, 22, 30])
+
+# Records of a node have ids derived from its taxid, one slot per kind of
+# record, so that they keep their ids from one build to the next. The root
+# of a group has no branch in the group, and its branch slot is used by the
+# branch from LUCA.
+RECORD_SLOTS = 8
+POINT, BRANCH, POLYGON, CLADECENTER, RANK = range(5)
+
 
 ##update db (if requested?)
 def updateDB():
@@ -36,26 +72,18 @@ def updateDB():
         os.system(f"tar xvzf {TAXO_DIRECTORY / 'taxdump.tar.gz'} -C {TAXO_DIRECTORY}")
 
 
-def simplify_tree(arbre):
+def simplify_tree(arbre: TaxoTree) -> TaxoTree:
     logger.info("Simplifying tree...")
-    initialSize = len(arbre)
-    for n in arbre.traverse():
-        if n.is_leaf and (n.props["rank_en"] == "no rank"):
-            n.detach()
-        else:
-            if (
-                ("Unclassified" in n.props["sci_name"])
-                or ("unclassified" in n.props["sci_name"])
-                or ("uncultured" in n.props["sci_name"])
-                or ("Uncultured" in n.props["sci_name"])
-                or ("unidentified" in n.props["sci_name"])
-                or ("Unidentified" in n.props["sci_name"])
-                or ("environmental" in n.props["sci_name"])
-                or ("sp." in n.props["sci_name"])
-            ):
-                n.detach()
+    is_leaf = arbre.is_leaf
+    initialSize = int(arbre.leaf_counts()[arbre.root])
+    rank_en = arbre.rank_names("en")
+    sci_name = arbre.names.get_column("sci_name")
+    remove = (is_leaf & (rank_en == "no rank")) | sci_name.str.contains(
+        "Unclassified|unclassified|uncultured|Uncultured|unidentified|Unidentified|environmental|sp\\."
+    ).to_numpy()
+    arbre = arbre.prune(remove)
     logger.info("Tree HAS BEEN simplified")
-    finalSize = len(arbre)
+    finalSize = int(arbre.leaf_counts()[arbre.root])
     diffInSize = initialSize - finalSize
     logger.info(
         str(diffInSize)
@@ -68,22 +96,22 @@ def simplify_tree(arbre):
 
 
 def midpoint(x1, y1, x2, y2):
-    # Input values as degrees
+    # Input values as degrees, scalars or arrays
     # Convert to radians
-    lat1 = math.radians(x1)
-    lon1 = math.radians(y1)
-    lat2 = math.radians(x2)
-    lon2 = math.radians(y2)
-    cos1 = math.cos(lat1)
-    cos2 = math.cos(lat2)
-    bx = cos2 * math.cos(lon2 - lon1)
-    by = cos2 * math.sin(lon2 - lon1)
-    lat3 = math.atan2(
-        math.sin(lat1) + math.sin(lat2),
-        math.sqrt((cos1 + bx) * (cos1 + bx) + by**2),
+    lat1 = np.radians(x1)
+    lon1 = np.radians(y1)
+    lat2 = np.radians(x2)
+    lon2 = np.radians(y2)
+    cos1 = np.cos(lat1)
+    cos2 = np.cos(lat2)
+    bx = cos2 * np.cos(lon2 - lon1)
+    by = cos2 * np.sin(lon2 - lon1)
+    lat3 = np.arctan2(
+        np.sin(lat1) + np.sin(lat2),
+        np.sqrt((cos1 + bx) * (cos1 + bx) + by**2),
     )
-    lon3 = lon1 + math.atan2(by, cos1 + bx)
-    return [math.degrees(lat3), math.degrees(lon3)]
+    lon3 = lon1 + np.arctan2(by, cos1 + bx)
+    return [np.degrees(lat3), np.degrees(lon3)]
 
 
 def rad(deg):
@@ -91,9 +119,9 @@ def rad(deg):
 
 
 def halfCircle(x, y, r, start, end, nsteps):
-    rs = np.linspace(start, end, num=nsteps)
-    xc = x + r * np.cos(rs)
-    yc = y + r * np.sin(rs)
+    rs = np.linspace(start, end, num=nsteps, axis=-1)
+    xc = x[:, None] + r[:, None] * np.cos(rs)
+    yc = y[:, None] + r[:, None] * np.sin(rs)
     return (xc, yc)
 
 
@@ -101,387 +129,924 @@ def ellipse(x, y, r, alpha, nsteps):
     start = 0
     end = np.pi + start
     rs = np.linspace(start, end, num=nsteps)
-    a = r
+    a = r[:, None]
     b = (
-        float(r) / 6
+        r[:, None] / 6
     )  ##Change this value to change the shape of polygons. This controls how flat is the elliptic side of the polygon. The other side is always a half cricle.
     xs = a * np.cos(rs)
     ys = b * np.sin(rs)
     ##rotation
-    cosa = np.cos(alpha)
-    sina = np.sin(alpha)
-    xs2 = x + (xs * cosa - ys * sina)
-    ys2 = y + (xs * sina + ys * cosa)
+    cosa = np.cos(alpha)[:, None]
+    sina = np.sin(alpha)[:, None]
+    xs2 = x[:, None] + (xs * cosa - ys * sina)
+    ys2 = y[:, None] + (xs * sina + ys * cosa)
     return (xs2, ys2)
 
 
 def HalfCircPlusEllips(x, y, r, alpha, start, end, nsteps):
+    """
+    Compute clade polygons outlines for arrays of N nodes.
+
+    Returns
+    -------
+    np.ndarray
+        Rings coordinates, as an (N, 2 * nsteps, 2) array.
+    """
     circ = halfCircle(x, y, r, start, end, nsteps)
     elli = ellipse(x, y, r, alpha, nsteps)
-    return (np.concatenate((circ[0], elli[0])), np.concatenate((circ[1], elli[1])))
-
-
-def get_way_record(node, id, groupnb):
-    # Create branch names
-    Upsci_name = node.up.props["sci_name"]
-    Upcommon_name_en = node.up.props["common_name"]["en"]
-    Downsci_name = node.props["sci_name"]
-    Downcommon_name_en = node.props["common_name"]["en"]
-    left = Upsci_name + " " + Upcommon_name_en
-    right = Downsci_name + " " + Downcommon_name_en
-    if node.props["x"] >= node.up.props["x"]:  # we are on the right
-        wayName = "\\u2190  " + left + "     -     " + right + "  \\u2192"
-    else:  # we are on the left
-        wayName = "\\u2190  " + right + "     -     " + left + "  \\u2192"
-
-    ##new with midpoints:
-    midlatlon = midpoint(node.up.props["x"], node.up.props["y"], node.props["x"], node.props["y"])
-
-    record = (
-        id,
-        "TRUE",
-        int(node.props["zoomview"]),
-        groupnb,
-        wayName,
-        f"LINESTRING({node.up.props['x']:.20f} {node.up.props['y']:.20f}, {midlatlon[0]:.20f} {midlatlon[1]:.20f}, {node.props['x']:.20f} {node.props['y']:.20f} )",
+    return np.stack(
+        (
+            np.concatenate((circ[0], elli[0]), axis=1),
+            np.concatenate((circ[1], elli[1]), axis=1),
+        ),
+        axis=-1,
     )
 
-    return record
 
+@dataclass
+class CladeGeometries:
+    """
+    Geometries of a set of clades (internal nodes).
+    """
+
+    # Polygon rings, (N, 60, 2)
+    rings: np.ndarray
+    # Polygon centers, (N, 2)
+    centers: np.ndarray
+    # Lines on which rank names are written, (N, 3, 2)
+    rank_lines: np.ndarray
+    # Convexity of rank lines, (N,)
+    convexity: np.ndarray
 
-def get_polyg_record(node, ids, groupnb):
-    polyg = HalfCircPlusEllips(
-        node.props["x"],
-        node.props["y"],
-        node.props["ray"],
-        rad(node.props["alpha"]) + np.pi / 2,
-        rad(node.props["alpha"]) - np.pi / 2,
-        rad(node.props["alpha"]) + np.pi / 2,
-        30,
-    )
-    polygcenter = (np.mean(polyg[0]), np.mean(polyg[1]))
-    cooPolyg = "POLYGON((%.20f %.20f " % (polyg[0][0], polyg[1][0])
-    for i in range(1, 59):
-        cooPolyg += ",%.20f %.20f" % (polyg[0][i], polyg[1][i])
-    cooPolyg += ",%.20f %.20f" % (polyg[0][0], polyg[1][0])
-    # to close the ring...
-    cooPolyg += "))"
-    polygon_record = (
-        int(ids[60]),
-        groupnb,
-        True,
-        node.props["taxid"],
-        node.props["sci_name"],
-        node.props["common_name"]["en"],
-        node.props["rank"]["en"],
-        int(node.props["nbdesc"]),
-        int(node.props["zoomview"]),
-        cooPolyg,
+
+def clade_rings(x, y, ray, alpha, nsteps: int = 30) -> np.ndarray:
+    """
+    Compute clade polygons outlines, each half of the outline having `nsteps` points.
+    """
+    return HalfCircPlusEllips(
+        x,
+        y,
+        ray,
+        rad(alpha) + np.pi / 2,
+        rad(alpha) - np.pi / 2,
+        rad(alpha) + np.pi / 2,
+        nsteps,
     )
 
-    cladecenter_record = (
-        int(ids[61]),
-        True,
-        node.props["taxid"],
-        node.props["sci_name"],
-        node.props["common_name"]["en"],
-        node.props["rank"]["en"],
-        int(node.props["nbdesc"]),
-        int(node.props["zoomview"]),
-        f"POINT({polygcenter[0]:.20f} {polygcenter[1]:.20f})",
+
+def clade_geometries(x, y, ray, alpha) -> CladeGeometries:
+    """
+    Compute polygons, centers and rank lines of clades in one pass.
+
+    Parameters
+    ----------
+    x, y, ray, alpha : np.ndarray
+        Layout values of the clades nodes, alpha in degrees.
+
+    Returns
+    -------
+    CladeGeometries
+        Clades geometries.
+    """
+    rings = clade_rings(x, y, ray, alpha)
+    # Mean over contiguous rows, to sum in the same order as a 1D mean
+    centers = np.stack(
+        (
+            np.ascontiguousarray(rings[:, :, 0]).mean(axis=1),
+            np.ascontiguousarray(rings[:, :, 1]).mean(axis=1),
+        ),
+        axis=-1,
     )
 
     # we add a way on which we will write the rank
-    cooLine = "LINESTRING(%.20f %.20f" % (polyg[0][39], polyg[1][39])
-    for i in range(40, 42):
-        cooLine += ",%.20f %.20f" % (polyg[0][i], polyg[1][i])
-    cooLine += ")"
-    start, mid, end = 39, 40, 41
-    if polyg[0][start] > polyg[0][end]:
-        start, end = end, start
-    x1, y1 = polyg[0][start], polyg[1][start]
-    x2, y2 = polyg[0][mid], polyg[1][mid]
-    x3, y3 = polyg[0][end], polyg[1][end]
-    slope1 = (y2 - y1) / (x2 - x1)
-    slope2 = (y3 - y2) / (x3 - x2)
+    rank_lines = rings[:, 39:42, :]
+    swap = rank_lines[:, 0, 0] > rank_lines[:, 2, 0]
+    x1 = np.where(swap, rank_lines[:, 2, 0], rank_lines[:, 0, 0])
+    y1 = np.where(swap, rank_lines[:, 2, 1], rank_lines[:, 0, 1])
+    x2, y2 = rank_lines[:, 1, 0], rank_lines[:, 1, 1]
+    x3 = np.where(swap, rank_lines[:, 0, 0], rank_lines[:, 2, 0])
+    y3 = np.where(swap, rank_lines[:, 0, 1], rank_lines[:, 2, 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope1 = (y2 - y1) / (x2 - x1)
+        slope2 = (y3 - y2) / (x3 - x2)
     convexity = slope1 - slope2
 
-    rank_record = (
-        int(ids[62]),
-        groupnb,
-        True,
-        node.props["taxid"],
-        node.props["sci_name"],
-        int(node.props["zoomview"]),
-        node.props["rank"]["en"],
-        node.props["rank"]["fr"],
-        int(node.props["nbdesc"]),
-        convexity,
-        cooLine,
+    return CladeGeometries(
+        rings=rings, centers=centers, rank_lines=rank_lines, convexity=convexity
     )
 
-    return polygon_record, cladecenter_record, rank_record
+
+def close_rings(rings: np.ndarray) -> np.ndarray:
+    """
+    Close polygon rings on their first point. As always in Lifemap, the
+    closing point replaces the last point of the ring.
+    """
+    return np.concatenate((rings[:, :-1, :], rings[:, :1, :]), axis=1)
 
 
-def node2json(node) -> str:
-    sci_name = node.props["sci_name"]
-    sci_name = sci_name.replace('"', '\\"')
-    common_name = {}
-    for lang in LANG_LIST:
-        common_name[lang] = node.props["common_name_long"][lang]
-        common_name[lang] = common_name[lang].replace('"', '\\"')
-    ##new attributes
-    authority = node.props["authority"]
-    authority = authority.replace("\\", "\\\\")
-    authority = authority.replace('"', '\\"')
-    synonym = node.props["synonym"]
-    synonym = synonym.replace('"', '\\"')
-    out = f"""{{
-        "taxid": "{node.props["taxid"]}",
-        "sci_name": "{sci_name}",
-        "suggest_weight": "{300 - len(sci_name)}",
-        "common_name_en": "{common_name["en"]}",
-        "common_name_fr": "{common_name["fr"]}",
-        "authority": "{authority}",
-        "synonym": "{synonym}",
-        "rank_en": "{node.props["rank"]["en"]}",
-        "rank_fr": "{node.props["rank"]["fr"]}",
-        "all_en": "{sci_name} | {common_name["en"]} | {node.props["rank"]["en"]} | {node.props["taxid"]}",
-        "all_fr": "{sci_name} | {common_name["fr"]} | {node.props["rank"]["fr"]} | {node.props["taxid"]}",
-        "zoom": {int(node.props["zoomview"] + 4)},
-        "nbdesc": {node.props["nbdesc"]},
-        "coordinates": [{node.props["y"]:.20f}, {node.props["x"]:.20f}],
-        "lat": {node.props["y"]:.20f},
-        "lon": {node.props["x"]:.20f}
-    }}"""
+@dataclass
+class Layout:
+    """
+    Node coordinates and display attributes of a tree, as arrays indexed by node.
+    """
+
+    x: np.ndarray
+    y: np.ndarray
+    alpha: np.ndarray
+    ray: np.ndarray
+    zoomview: np.ndarray
+    nbdesc: np.ndarray
+
+
+def _segment_cumsum(values: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Cumulative sums of consecutive segments of `values`.
+
+    Each segment is summed sequentially from its start, so that results are
+    bit-identical to a Python loop. Segments are padded with zeros into 2D
+    blocks of same width and accumulated along rows.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Values to sum.
+    counts : np.ndarray
+        Length of each segment. Sum must be equal to len(values).
+
+    Returns
+    -------
+    np.ndarray
+        Cumulative sums, same shape as `values`.
+    """
+    out = np.empty_like(values)
+    starts = np.cumsum(counts) - counts
+    widths = np.zeros(len(counts), dtype=np.int64)
+    widths[counts > 0] = 2 ** np.ceil(np.log2(counts[counts > 0])).astype(np.int64)
+    for width in np.unique(widths[widths > 0]):
+        seg = np.flatnonzero(widths == width)
+        cols = np.arange(width)
+        valid = cols < counts[seg, None]
+        pos = (starts[seg, None] + cols)[valid]
+        block = np.zeros((len(seg), width))
+        block[valid] = values[pos]
+        out[pos] = np.cumsum(block, axis=1)[valid]
     return out
 
 
-def traverse_tree(
-    tree: dict,
-    groupnb: Literal["1", "2", "3"],
-    starti: int,
-    disable_progress: bool = False,
-) -> int:
+def compute_layout(t: TaxoTree, x: float, y: float, alpha: float, ray: float) -> Layout:
     """
-    Open taxonomic tree and recode it into PostGRES/PostGIS database for visualisation in Lifemap.
+    Compute nodes coordinates by traversing the tree level by level from its root.
+
+    All children of a depth level are computed at once from their parents
+    values. Per-parent sums are done sequentially so that coordinates are
+    exactly the same as with a node by node traversal.
 
     Parameters
     ----------
-    tree : dict
-        Global NCBI tree
-    groupnb : {'1', '2', '3'}
-        Group to look at. Can be 1,2 or 3 for Archaea, Eukaryotes and Bacteria respectively
-    starti : int
-        index of the first node met in the tree
-    disable_progress : bool
-        If True, disable progress bars
+    t : TaxoTree
+        Tree to lay out, its nodes being in breadth-first order.
+    x, y : float
+        Root coordinates.
+    alpha : float
+        Root angle, in degrees.
+    ray : float
+        Root ray.
 
     Returns
     -------
-    int
-        ndid
+    Layout
+        Nodes layout.
     """
+    n_nodes = t.n_nodes
+    lay = Layout(
+        x=np.zeros(n_nodes),
+        y=np.zeros(n_nodes),
+        alpha=np.zeros(n_nodes),
+        ray=np.zeros(n_nodes),
+        zoomview=np.zeros(n_nodes),
+        nbdesc=t.leaf_counts(),
+    )
+    lay.x[0] = x
+    lay.y[0] = y
+    lay.alpha[0] = alpha
+    lay.ray[0] = ray
+    lay.zoomview[0] = np.ceil(np.log2(30 / ray))
 
-    ##let's try to write the tree entirely here, in a file
+    levels = t.levels()
+    n_children = t.n_children
+    for level, child in pairwise(levels):
+        counts = n_children[level]
+        up = t.parent[child]
+        # Angle of each child is proportional to the sqrt of its number of
+        # leaves: using sqrt we decrease difference between large and small groups
+        sqrt_nbdesc = np.sqrt(lay.nbdesc[child])
+        tot = _segment_cumsum(sqrt_nbdesc, counts)[
+            np.repeat(np.cumsum(counts) - 1, counts)
+        ]
+        ang = 180 * (sqrt_nbdesc / tot) / 2
 
-    logger.info("Downloading tree...")
+        ray = lay.ray[up]
+        only_child = np.repeat(counts == 1, counts)
+        special_1 = only_child & (lay.nbdesc[up] > 1)
+        special_2 = only_child & (lay.nbdesc[up] == 1)
+        lay.ray[child] = np.where(
+            special_1,
+            ray - (ray * 20) / 100,
+            np.where(
+                special_2,
+                ray - (ray * 50) / 100,
+                (ray * np.sin(rad(ang)) / np.cos(rad(ang)))
+                / (1 + (np.sin(rad(ang)) / np.cos(rad(ang)))),
+            ),
+        )
+        dist = ray - lay.ray[child]
 
-    if groupnb == "1":
-        logger.info("Archaeal tree...")
-        t = tree["2157"].copy()
-        t.props["x"] = 6.0
-        t.props["y"] = 9.660254 - 10.0
-        t.props["alpha"] = 30.0
-        t.props["ray"] = 10.0
-    elif groupnb == "2":
-        t = tree["2759"].copy()
-        logger.info("Eukaryotic tree loaded")
-        t.props["x"] = -6.0
-        t.props["y"] = 9.660254 - 10.0
-        t.props["alpha"] = 150.0
-        t.props["ray"] = 10.0
-    else:
-        t = tree["2"].copy()
-        logger.info("Bacterial tree loaded")
-        t.props["x"] = 0.0
-        t.props["y"] = -11.0
-        t.props["alpha"] = 270.0
-        t.props["ray"] = 10.0
-
-    t.props["zoomview"] = np.ceil(np.log2(30 / t.props["ray"]))
-
-    # species and node ids
-    nbsp = len(t)
-    spid = starti
-    ndid = starti + nbsp
-    maxZoomView = 0
-
-    logger.info("Tree traversal 1/2...")
-    points_records = []
-    for n in tqdm(t.traverse(), total=len(t)):
-        special = 0
-        n.props["dist"] = 1.0
-        tot = 0.0
-        if n.is_leaf:
-            spid = spid + 1
-            n.props["id"] = spid
-        else:
-            ndid = ndid + 1
-            n.props["id"] = ndid
-        child = n.children
-        ##NEW  -->|
-        if (len(child) == 1) & (len(n) > 1):
-            special = 1
-        if (len(child) == 1) & (len(n) == 1):
-            special = 2
-        ## |<-- NEW
-        for i in child:
-            tot = tot + np.sqrt(len(i))
-        nbdesc = len(n)
-        n.props["nbdesc"] = nbdesc
-
-        angles = []
-        ray = n.props["ray"]
-        for i in child:
-            # i.ang = 180*(len(i)/float(nbdesc))/2;
-            i.props["ang"] = 180 * (np.sqrt(len(i)) / tot) / 2
-            # using sqrt we decrease difference between large and small groups
-            angles.append(i.props["ang"])
-            if special == 1:
-                i.props["ray"] = ray - (ray * 20) / 100
-            else:
-                if special == 2:
-                    i.props["ray"] = ray - (ray * 50) / 100
-                else:
-                    i.props["ray"] = (ray * np.sin(rad(i.props["ang"])) / np.cos(rad(i.props["ang"]))) / (
-                        1 + (np.sin(rad(i.props["ang"])) / np.cos(rad(i.props["ang"])))
-                    )
-            i.props["dist"] = ray - i.props["ray"]
-        ang = np.repeat(angles, 2)
-        ang = np.cumsum(ang)
-        ang = ang[0::2]
-        ang = [i - (90 - n.props["alpha"]) for i in ang]
-        cpt = 0
-        for i in child:
-            i.props["alpha"] = ang[cpt]
-            i.props["x"] = n.props["x"] + i.props["dist"] * np.cos(rad(i.props["alpha"]))
-            i.props["y"] = n.props["y"] + i.props["dist"] * np.sin(rad(i.props["alpha"]))
-            i.props["zoomview"] = np.ceil(np.log2(30 / i.props["ray"]))
-            if i.props["zoomview"] <= 0:
-                i.props["zoomview"] = 0
-                if maxZoomView < i.props["zoomview"]:
-                    maxZoomView = i.props["zoomview"]
-            cpt = cpt + 1
-        # Append node info to postgis COPY records
-        points_records.append(
-            (
-                n.props["id"],
-                n.props["taxid"],
-                groupnb,
-                n.props["sci_name"],
-                n.props["common_name"]["en"],
-                n.props["rank"]["en"],
-                n.props["nbdesc"],
-                int(n.props["zoomview"]),
-                n.is_leaf,
-                f"POINT({n.props['x']:.20f} {n.props['y']:.20f})",
-            )
+        lay.alpha[child] = _segment_cumsum(np.repeat(ang, 2), 2 * counts)[0::2] - (
+            90 - lay.alpha[up]
         )
+        lay.x[child] = lay.x[up] + dist * np.cos(rad(lay.alpha[child]))
+        lay.y[child] = lay.y[up] + dist * np.sin(rad(lay.alpha[child]))
+        zoomview = np.ceil(np.log2(30 / lay.ray[child]))
+        zoomview[zoomview <= 0] = 0
+        lay.zoomview[child] = zoomview
 
-    # Postgis connection
-    conn = db_connection()
-    cur = conn.cursor()
+    return lay
+
+
+def node_attributes(t: TaxoTree, nodes: np.ndarray) -> dict[str, list]:
+    """
+    Get string attributes of a set of nodes as lists aligned with `nodes`,
+    for fast per-node access when building records.
+    """
+    names = t.names[nodes]
+    attrs = {col: names.get_column(col).to_list() for col in NAME_COLUMNS}
+    attrs["taxid"] = t.taxid[nodes].astype(str).tolist()
+    for lang in LANG_LIST:
+        attrs[f"rank_{lang}"] = t.rank_names(lang)[nodes].tolist()
+    return attrs
 
-    logger.info("Inserting points data into postgis")
-    with cur.copy(
-        "COPY points (id, taxid, ref, sci_name, common_name_en, rank_en, nbdesc, zoomview, tip,geom_txt) FROM STDIN"
-    ) as copy:
-        for record in tqdm(points_records, disable=disable_progress):
-            copy.write_row(record)
-    conn.commit()
 
-    logger.info("Tree traversal 2/2... ")
+def branch_lines(lay: Layout, nodes: np.ndarray, ups: np.ndarray) -> np.ndarray:
+    """
+    Branches between a set of nodes and their parents, as an (N, 3, 2) array.
+    """
+    ##new with midpoints:
+    midlatlon = midpoint(lay.x[ups], lay.y[ups], lay.x[nodes], lay.y[nodes])
+    return np.stack(
+        (
+            np.stack((lay.x[ups], lay.y[ups]), axis=-1),
+            np.stack(midlatlon, axis=-1),
+            np.stack((lay.x[nodes], lay.y[nodes]), axis=-1),
+        ),
+        axis=1,
+    )
+
+
+def record_ids(taxid: np.ndarray, slot: int) -> np.ndarray:
+    """
+    Database ids of the records of one kind of a set of nodes.
+    """
+    return np.asarray(taxid, dtype=np.int64) * RECORD_SLOTS + slot
+
+
+def get_way_records(attrs, up_attrs, lay, nodes, ups, ids, groupnb):
+    """
+    Build branches records between a set of nodes and their parents.
+
+    `attrs` and `up_attrs` are the string attributes of `nodes` and `ups`.
+    """
+    geoms = ewkb_linestrings(branch_lines(lay, nodes, ups))
+    right = (lay.x[nodes] >= lay.x[ups]).tolist()
+    zoomviews = lay.zoomview[nodes].astype(int).tolist()
+
+    records = []
+    for k, id in enumerate(ids.tolist()):
+        # Create branch names
+        left_name = up_attrs["sci_name"][k] + " " + up_attrs["common_name_en"][k]
+        right_name = attrs["sci_name"][k] + " " + attrs["common_name_en"][k]
+        if right[k]:  # we are on the right
+            wayName = "\\u2190  " + left_name + "     -     " + right_name + "  \\u2192"
+        else:  # we are on the left
+            wayName = "\\u2190  " + right_name + "     -     " + left_name + "  \\u2192"
+        records.append((id, True, zoomviews[k], int(groupnb), wayName, geoms[k]))
+
+    return records
+
+
+def get_polyg_records(attrs, lay, nodes, taxids, groupnb):
+    """
+    Build polygons, clade centers and ranks records of a set of clades.
+
+    Parameters
+    ----------
+    attrs : dict
+        String attributes of `nodes`.
+    lay : Layout
+        Nodes layout.
+    nodes : np.ndarray
+        Indexes of the clades nodes.
+    taxids : np.ndarray
+        Taxids of `nodes`, from which records ids are derived.
+    groupnb : str
+        Group number.
+    """
+    geom = clade_geometries(
+        lay.x[nodes], lay.y[nodes], lay.ray[nodes], lay.alpha[nodes]
+    )
+    polygons = ewkb_polygons(close_rings(geom.rings))
+    centers = ewkb_points(geom.centers)
+    rank_lines = ewkb_linestrings(geom.rank_lines)
 
-    lines_records = []
     polygons_records = []
     cladecenters_records = []
     ranks_records = []
+    for k, (polygon_id, center_id, rank_id, nbdesc, zoomview) in enumerate(
+        zip(
+            record_ids(taxids, POLYGON).tolist(),
+            record_ids(taxids, CLADECENTER).tolist(),
+            record_ids(taxids, RANK).tolist(),
+            lay.nbdesc[nodes].tolist(),
+            lay.zoomview[nodes].astype(int).tolist(),
+        )
+    ):
+        polygons_records.append(
+            (
+                polygon_id,
+                int(groupnb),
+                True,
+                attrs["taxid"][k],
+                attrs["sci_name"][k],
+                attrs["common_name_en"][k],
+                attrs["rank_en"][k],
+                nbdesc,
+                zoomview,
+                polygons[k],
+            )
+        )
+        cladecenters_records.append(
+            (
+                center_id,
+                True,
+                attrs["taxid"][k],
+                attrs["sci_name"][k],
+                attrs["common_name_en"][k],
+                attrs["rank_en"][k],
+                nbdesc,
+                zoomview,
+                centers[k],
+            )
+        )
+        ranks_records.append(
+            (
+                rank_id,
+                int(groupnb),
+                True,
+                attrs["taxid"][k],
+                attrs["sci_name"][k],
+                zoomview,
+                attrs["rank_en"][k],
+                attrs["rank_fr"][k],
+                nbdesc,
+                geom.convexity[k],
+                rank_lines[k],
+            )
+        )
+
+    return polygons_records, cladecenters_records, ranks_records
+
+
+def pixel_size(zoom: int) -> float:
+    """
+    Width in degrees of a pixel of 256 pixels tiles at a zoom.
+    """
+    return 360 / (256 * 2**zoom)
+
+
+def lowzoom_branches(lay, nodes, ups) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Generalized branches between a set of nodes and their parents, at each
+    low tile zoom at which they are displayed.
 
-    ##LAST LOOP TO write coords of polygs and JSON file
-    json_file = open(BUILD_DIRECTORY / f"TreeFeatures{groupnb}.json", "w")
-    first = True
-    ascends = []
-    for n in tqdm(t.traverse(), total=len(t), disable=disable_progress):
-        if first:
-            json_file.write("[")
-            first = False
-        else:
-            json_file.write(",")
-        if not n.is_root:
-            ndid = ndid + 1
-            lines_records.append(get_way_record(n, ndid, groupnb))
-        if not n.is_leaf:
-            indexes = np.linspace(ndid + 1, ndid + 63, num=63)
-            polygon_record, cladecenter_record, rank_record = get_polyg_record(n, indexes, groupnb)
-            polygons_records.append(polygon_record)
-            cladecenters_records.append(cladecenter_record)
-            ranks_records.append(rank_record)
-            ndid = ndid + 63
-        json_file.write(node2json(n))
-        # Compute note ascend list
-        row = {"taxid": n.props["taxid"], "ascend": []}
-        node = n
-        while node.up:
-            row["ascend"].append(node.up.props["taxid"])
-            node = node.up
-        row["ascend"].append("0")
-        ascends.append(row)
-
-    json_file.write("]")
-    json_file.close()
+    At each zoom, branches smaller than the tolerance are dropped, and
+    branches whose midpoint is within the tolerance of the straight line
+    between their ends are drawn as this line.
+
+    Yields
+    ------
+    tuple[int, np.ndarray, np.ndarray]
+        Zoom, indexes in `nodes` of a set of branches, and their lines, of 2
+        points for straight ones and of 3 points otherwise.
+    """
+    lines = branch_lines(lay, nodes, ups)
+    zoomview = lay.zoomview[nodes].astype(int)
+    # Distances are measured on the map, in degrees at the equator
+    projected = to_web_mercator(lines) * 180 / (np.pi * EARTH_RADIUS)
+    start, mid, end = projected[:, 0], projected[:, 1], projected[:, 2]
+    extent = np.maximum(np.hypot(*(mid - start).T), np.hypot(*(end - start).T))
+    chord = np.hypot(*(end - start).T)
+    cross = np.abs(
+        (end - start)[:, 0] * (mid - start)[:, 1]
+        - (end - start)[:, 1] * (mid - start)[:, 0]
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deviation = np.where(chord > 0, cross / chord, np.hypot(*(mid - start).T))
+
+    for zoom in LOWZOOM_ZOOMS:
+        tolerance = GENERALIZE_TOLERANCE * pixel_size(zoom)
+        shown = np.flatnonzero((zoomview < zoom + 11) & (extent >= tolerance))
+        straight = deviation[shown] < tolerance
+        yield zoom, shown[straight], lines[shown[straight]][:, [0, 2]]
+        yield zoom, shown[~straight], lines[shown[~straight]]
+
+
+def get_lowzoom_way_records(lay, nodes, ups, ids, groupnb):
+    """
+    Build generalized branches records between a set of nodes and their
+    parents, for each low tile zoom at which they are displayed, see
+    `lowzoom_branches`.
+    """
+    zoomview = lay.zoomview[nodes].astype(int)
+    records = []
+    for zoom, group, coords in lowzoom_branches(lay, nodes, ups):
+        geoms = ewkb_linestrings(coords)
+        records.extend(
+            (int(ids[k]), True, int(zoomview[k]), int(groupnb), zoom, geom)
+            for k, geom in zip(group.tolist(), geoms)
+        )
+    return records
+
+
+def lowzoom_rings(lay, nodes) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Generalized outlines of a set of clades, at each low tile zoom at which
+    they are displayed.
+
+    Outlines are computed with as few steps as possible so that their chords
+    stay within the tolerance of the full resolution arcs, which are at most
+    as far from their chords as arcs of a circle of the clade ray.
+
+    Yields
+    ------
+    tuple[int, np.ndarray, np.ndarray]
+        Zoom, indexes in `nodes` of a set of clades, and their closed rings,
+        all with the same number of points.
+    """
+    zoomview = lay.zoomview[nodes].astype(int)
+    for zoom in LOWZOOM_ZOOMS:
+        shown = np.flatnonzero((zoomview >= zoom - 4) & (zoomview <= zoom + 1))
+        ray = lay.ray[nodes[shown]] / pixel_size(zoom)
+        # Half angle of the largest arc within tolerance of its chord
+        half_angle = np.arccos(np.clip(1 - GENERALIZE_TOLERANCE / ray, -1, 1))
+        needed = np.ceil(np.pi / (2 * half_angle)) + 1
+        steps = LOWZOOM_STEPS[
+            np.minimum(np.searchsorted(LOWZOOM_STEPS, needed), len(LOWZOOM_STEPS) - 1)
+        ]
+        for nsteps in np.unique(steps).tolist():
+            group = shown[steps == nsteps]
+            clades = nodes[group]
+            rings = clade_rings(
+                lay.x[clades], lay.y[clades], lay.ray[clades], lay.alpha[clades], nsteps
+            )
+            yield zoom, group, close_rings(rings)
+
+
+def get_lowzoom_polyg_records(taxids, lay, nodes, ids, groupnb):
+    """
+    Build generalized polygons records of a set of clades, for each low tile
+    zoom at which they are displayed, see `lowzoom_rings`.
+
+    Parameters
+    ----------
+    taxids : list[str]
+        Taxids of `nodes`.
+    lay : Layout
+        Nodes layout.
+    nodes : np.ndarray
+        Indexes of the clades nodes.
+    ids : np.ndarray
+        Polygon records ids of `nodes`.
+    groupnb : str
+        Group number.
+    """
+    zoomview = lay.zoomview[nodes].astype(int)
+    records = []
+    for zoom, group, rings in lowzoom_rings(lay, nodes):
+        polygons = ewkb_polygons(rings)
+        records.extend(
+            (
+                int(ids[k]),
+                int(groupnb),
+                True,
+                taxids[k],
+                int(lay.nbdesc[nodes[k]]),
+                int(zoomview[k]),
+                zoom,
+                polygon,
+            )
+            for k, polygon in zip(group.tolist(), polygons)
+        )
+    return records
+
+
+def node_features(t: TaxoTree, lay: Layout, nodes: np.ndarray) -> pl.DataFrame:
+    """
+    Build the features of a set of nodes as a typed data frame, with the
+    fields of the taxo Solr documents.
+
+    Parameters
+    ----------
+    t : TaxoTree
+        Tree.
+    lay : Layout
+        Tree layout.
+    nodes : np.ndarray
+        Indexes of the nodes.
+
+    Returns
+    -------
+    pl.DataFrame
+        One row per node, in the order of `nodes`.
+    """
+    names = t.names[nodes]
+    columns = {
+        "taxid": pl.Series(t.taxid[nodes]).cast(pl.Utf8),
+        "sci_name": names.get_column("sci_name"),
+    }
+    for lang in LANG_LIST:
+        columns[f"common_name_{lang}"] = names.get_column(f"common_name_long_{lang}")
+    columns["authority"] = names.get_column("authority")
+    columns["synonym"] = names.get_column("synonym")
+    for lang in LANG_LIST:
+        columns[f"rank_{lang}"] = pl.Series(t.rank_names(lang)[nodes], dtype=pl.Utf8)
+    columns["zoom"] = pl.Series(lay.zoomview[nodes].astype(np.int64) + 4)
+    columns["nbdesc"] = pl.Series(lay.nbdesc[nodes].astype(np.int64))
+    columns["lat"] = pl.Series(lay.y[nodes], dtype=pl.Float64)
+    columns["lon"] = pl.Series(lay.x[nodes], dtype=pl.Float64)
+
+    features = pl.DataFrame(columns).with_columns(
+        suggest_weight=300 - pl.col("sci_name").str.len_chars().cast(pl.Int64),
+        coordinates=pl.concat_list("lat", "lon"),
+        **{
+            f"all_{lang}": pl.concat_str(
+                ["sci_name", f"common_name_{lang}", f"rank_{lang}", "taxid"],
+                separator=" | ",
+            )
+            for lang in LANG_LIST
+        },
+    )
+    return features.select(
+        "taxid",
+        "sci_name",
+        "suggest_weight",
+        *[f"common_name_{lang}" for lang in LANG_LIST],
+        "authority",
+        "synonym",
+        *[f"rank_{lang}" for lang in LANG_LIST],
+        *[f"all_{lang}" for lang in LANG_LIST],
+        "zoom",
+        "nbdesc",
+        "coordinates",
+        "lat",
+        "lon",
+    )
+
+
+def iter_records(
+    t: TaxoTree,
+    lay: Layout,
+    groupnb: str,
+    nodes: np.ndarray | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[dict[str, list]]:
+    """
+    Generate the database records of a tree by chunks of nodes.
+
+    Only the attributes and geometries of the nodes of the current chunk are
+    held in memory, so that records can be streamed to the database.
+
+    Parameters
+    ----------
+    t : TaxoTree
+        Tree, with nodes in breadth-first order.
+    lay : Layout
+        Tree layout.
+    groupnb : str
+        Group number.
+    nodes : np.ndarray, optional
+        Sorted indexes of the nodes whose records are generated, all nodes
+        by default. The branch record of a node is the one to its parent.
+    chunk_size : int
+        Number of nodes per chunk.
+
+    Yields
+    ------
+    dict[str, list]
+        Records of each table of the chunk.
+    """
+    is_leaf = t.is_leaf
+    if nodes is None:
+        nodes = np.arange(t.n_nodes)
+    for start in range(0, len(nodes), chunk_size):
+        chunk = nodes[start : start + chunk_size]
+        attrs = node_attributes(t, chunk)
+        points = ewkb_points(np.stack((lay.x[chunk], lay.y[chunk]), axis=-1))
+        point_ids = record_ids(t.taxid[chunk], POINT).tolist()
+        points_records = [
+            (
+                point_ids[k],
+                attrs["taxid"][k],
+                int(groupnb),
+                attrs["sci_name"][k],
+                attrs["common_name_en"][k],
+                attrs["rank_en"][k],
+                int(lay.nbdesc[n]),
+                int(lay.zoomview[n]),
+                bool(is_leaf[n]),
+                points[k],
+            )
+            for k, n in enumerate(chunk.tolist())
+        ]
+
+        branch_nodes = chunk[t.parent[chunk] >= 0]
+        branch_ups = t.parent[branch_nodes]
+        branch_ids = record_ids(t.taxid[branch_nodes], BRANCH)
+        lines_records = get_way_records(
+            node_attributes(t, branch_nodes),
+            node_attributes(t, branch_ups),
+            lay,
+            branch_nodes,
+            branch_ups,
+            branch_ids,
+            groupnb,
+        )
+
+        lowzoom_lines_records = get_lowzoom_way_records(
+            lay, branch_nodes, branch_ups, branch_ids, groupnb
+        )
+
+        clade_nodes = chunk[~is_leaf[chunk]]
+        clade_attrs = node_attributes(t, clade_nodes)
+        clade_taxids = t.taxid[clade_nodes]
+        polygons_records, cladecenters_records, ranks_records = get_polyg_records(
+            clade_attrs, lay, clade_nodes, clade_taxids, groupnb
+        )
+        lowzoom_polygons_records = get_lowzoom_polyg_records(
+            clade_attrs["taxid"],
+            lay,
+            clade_nodes,
+            record_ids(clade_taxids, POLYGON),
+            groupnb,
+        )
+
+        yield {
+            "points": points_records,
+            "branches": lines_records,
+            "polygons": polygons_records,
+            "cladecenters": cladecenters_records,
+            "ranks": ranks_records,
+            "branches_lowzoom": lowzoom_lines_records,
+            "polygons_lowzoom": lowzoom_polygons_records,
+        }
+
+
+def iter_features(
+    t: TaxoTree, lay: Layout, chunk_size: int = CHUNK_SIZE
+) -> Iterator[pl.DataFrame]:
+    """
+    Generate the features of a tree by chunks of nodes, in breadth-first order.
+    """
+    for start in range(0, t.n_nodes, chunk_size):
+        yield node_features(
+            t, lay, np.arange(start, min(start + chunk_size, t.n_nodes))
+        )
+
+
+def node_ascends(t: TaxoTree) -> pl.DataFrame:
+    """
+    Ancestors of each node of a tree, from its parent to the group root,
+    followed by LUCA (taxid 0).
+
+    Returns
+    -------
+    pl.DataFrame
+        Taxid of each node, as a string, and its ancestors taxids, as a list
+        of int32.
+    """
+    offsets, values = t.ancestor_paths(base=(0,))
+    return pl.DataFrame(
+        {
+            "taxid": pl.Series(t.taxid).cast(pl.Utf8),
+            "ascend": list_series("ascend", offsets, values),
+        }
+    )
+
+
+def write_features(
+    t: TaxoTree, lay: Layout, groupnb: str, disable_progress: bool = False
+) -> None:
+    """
+    Write the features of a group, and its ascends data frame.
+
+    Features are saved to TreeFeatures{groupnb}.parquet, read by the next
+    build stages, and serialized in bulk to TreeFeatures{groupnb}.json,
+    with one Solr document per line. Both files are written chunk by chunk,
+    so that the features of the whole group are never held in memory.
+    """
+    logger.info("Writing features...")
+    schema = node_features(t, lay, np.arange(0)).to_arrow().schema
+    with (
+        pq.ParquetWriter(
+            BUILD_DIRECTORY / f"TreeFeatures{groupnb}.parquet",
+            schema,
+            compression="zstd",
+        ) as parquet,
+        open(BUILD_DIRECTORY / f"TreeFeatures{groupnb}.json", "wb") as ndjson,
+        tqdm(total=t.n_nodes, disable=disable_progress) as progress,
+    ):
+        for chunk in iter_features(t, lay):
+            parquet.write_table(chunk.to_arrow())
+            chunk.write_ndjson(ndjson)
+            progress.update(len(chunk))
 
     logger.info("Saving ascends data frame...")
-    ascends = pl.DataFrame(ascends)
-    ascends.write_parquet(BUILD_DIRECTORY / f"ascends_{groupnb}.parquet")
+    node_ascends(t).write_parquet(BUILD_DIRECTORY / f"ascends_{groupnb}.parquet")
 
-    logger.info("Inserting branches data into postgis...")
-    with cur.copy("COPY branches (id, branch, zoomview, ref, name, geom_txt) FROM STDIN") as copy:
-        for record in tqdm(lines_records, disable=disable_progress):
-            copy.write_row(record)
-    conn.commit()
 
-    logger.info("Inserting polygons data into postgis...")
-    with cur.copy(
-        "COPY polygons (id, ref, clade, taxid, sci_name, common_name_en, rank_en, nbdesc,zoomview, geom_txt) FROM STDIN"
-    ) as copy:
-        for record in tqdm(polygons_records, disable=disable_progress):
-            copy.write_row(record)
-    conn.commit()
+def write_records(
+    t: TaxoTree,
+    lay: Layout,
+    groupnb: str,
+    nodes: np.ndarray | None = None,
+    disable_progress: bool = False,
+) -> None:
+    """
+    Stream the database records of a tree, or of some of its nodes, into
+    one open COPY per table.
+    """
+    with ExitStack() as stack:
+        writers = {table: stack.enter_context(CopyWriter(table)) for table in TABLES}
+        progress = stack.enter_context(
+            tqdm(
+                total=t.n_nodes if nodes is None else len(nodes),
+                disable=disable_progress,
+            )
+        )
+        for chunk in iter_records(t, lay, groupnb, nodes=nodes):
+            for table, writer in writers.items():
+                writer.write(chunk[table])
+            progress.update(len(chunk["points"]))
+    for table, writer in writers.items():
+        logger.info(f"  {writer.n_rows} records inserted into {table}")
+        metrics.record(f"copy/{groupnb}/{table}", writer.metrics)
 
-    logger.info("Inserting cladecenters data into postgis...")
-    with cur.copy(
-        "COPY cladecenters (id, cladecenter, taxid, sci_name, common_name_en, rank_en, nbdesc,zoomview, geom_txt) FROM STDIN"
-    ) as copy:
-        for record in tqdm(cladecenters_records, disable=disable_progress):
-            copy.write_row(record)
-    conn.commit()
 
-    logger.info("Inserting ranks data into postgis...")
-    with cur.copy(
-        "COPY ranks (id, ref, rankname, taxid, sci_name, zoomview, rank_en, rank_fr, nbdesc, convex, geom_txt) FROM STDIN"
-    ) as copy:
-        for record in tqdm(ranks_records, disable=disable_progress):
-            copy.write_row(record)
+def insert_luca_branch(t: TaxoTree, groupnb: str, lay: Layout) -> None:
+    """
+    Insert the branch from LUCA to the root of a group.
+    """
+    ndid = int(record_ids(t.taxid[t.root], BRANCH))
+    conn = db_connection()
+    cur = conn.cursor()
+    command = f"INSERT INTO branches (id, branch, zoomview, ref, way) VALUES ({ndid},'TRUE', '4', '{groupnb}', ST_Transform(ST_GeomFromText('LINESTRING(0 -4.226497, {lay.x[0]:.20f} {lay.y[0]:.20f})', 4326), 3857));"
+    cur.execute(command)  # type: ignore
+    # The branch is displayed at all low zooms
+    cur.execute(
+        "INSERT INTO branches_lowzoom (id, branch, zoomview, ref, genzoom, way) "
+        "SELECT id, branch, zoomview, ref, genzoom, way FROM branches, "
+        f"generate_series({LOWZOOM_ZOOMS.start}, {LOWZOOM_ZOOMS.stop - 1}) AS genzoom WHERE id = {ndid};"
+    )  # type: ignore
     conn.commit()
+    conn.close()
+
+
+def group_layout(tree: TaxoTree, groupnb: str) -> tuple[TaxoTree, Layout]:
+    """
+    Extract the subtree of a group and compute its layout.
+    """
+    if groupnb == "1":
+        logger.info("Archaeal tree...")
+        t = tree.subtree(GROUP_ROOTS["1"])
+        lay = compute_layout(t, x=6.0, y=9.660254 - 10.0, alpha=30.0, ray=10.0)
+    elif groupnb == "2":
+        t = tree.subtree(GROUP_ROOTS["2"])
+        logger.info("Eukaryotic tree loaded")
+        lay = compute_layout(t, x=-6.0, y=9.660254 - 10.0, alpha=150.0, ray=10.0)
+    else:
+        t = tree.subtree(GROUP_ROOTS["3"])
+        logger.info("Bacterial tree loaded")
+        lay = compute_layout(t, x=0.0, y=-11.0, alpha=270.0, ray=10.0)
+    return t, lay
+
+
+def traverse_tree(
+    tree: TaxoTree,
+    groupnb: Literal["1", "2", "3"],
+    disable_progress: bool = False,
+) -> None:
+    """
+    Open taxonomic tree and recode it into PostGRES/PostGIS database for visualisation in Lifemap.
+
+    Records are generated by chunks of nodes and streamed into one open COPY
+    per table, instead of being accumulated in memory first.
+
+    Parameters
+    ----------
+    tree : TaxoTree
+        Global NCBI tree
+    groupnb : {'1', '2', '3'}
+        Group to look at. Can be 1,2 or 3 for Archaea, Eukaryotes and Bacteria respectively
+    disable_progress : bool
+        If True, disable progress bars
+    """
+
+    ##let's try to write the tree entirely here, in a file
+
+    logger.info("Downloading tree...")
+    t, lay = group_layout(tree, groupnb)
+
+    maxZoomView = int(lay.zoomview.max())
+
+    logger.info("Tree traversal and insertion into postgis...")
+    write_records(t, lay, groupnb, disable_progress=disable_progress)
+    write_features(t, lay, groupnb, disable_progress=disable_progress)
 
     ##we add the way from LUCA to the root of the subtree
-    ndid = ndid + 1
-    command = f"INSERT INTO branches (id, branch, zoomview, ref, way) VALUES ({ndid},'TRUE', '4', '{groupnb}', ST_Transform(ST_GeomFromText('LINESTRING(0 -4.226497, {t.props['x']:.20f} {t.props['y']:.20f})', 4326), 3857));"
-    cur.execute(command)  # type: ignore
-    conn.commit()
+    insert_luca_branch(t, groupnb, lay)
 
-    logger.info(f"DONE - ndid:{ndid} - spid:{spid} - Max zoom view: {maxZoomView}")
+    logger.info(
+        f"DONE - nodes:{t.n_nodes} - species:{int(lay.nbdesc[0])} - Max zoom view: {maxZoomView}"
+    )
 
-    conn.close()
-    return ndid
+
+def _init_worker(log_files: list[str]) -> None:
+    """
+    Send logs of a traversal worker process to the builder log files.
+    """
+    logger.handlers.clear()
+    logger.addHandler(logging.StreamHandler(stream=sys.stdout))
+    for log_file in log_files:
+        logger.addHandler(logging.FileHandler(log_file, mode="a"))
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+
+def _traverse_group(subtree: TaxoTree, groupnb: str) -> tuple[float, dict[str, dict]]:
+    # A worker may traverse several groups, its peak memory is measured for each
+    metrics.reset_peak_rss()
+    measured = metrics.Measure()
+    traverse_tree(subtree, groupnb=groupnb, disable_progress=True)  # type: ignore
+    values = measured.values(rows=subtree.n_nodes)
+    metrics.record(f"group/{groupnb}", values)
+    # Metrics of the group and of its COPYs are sent back to the main process
+    return values["wall_time_s"], metrics.take_steps()
+
+
+def traverse_trees(
+    tree: TaxoTree, workers: int = 1, disable_progress: bool = False
+) -> None:
+    """
+    Traverse the three groups of the tree, serially or in parallel.
+
+    In parallel, each group is traversed in its own process, with its own
+    database connections. As records ids are derived from taxids, they are
+    the same as in a serial run. Groups are submitted from the largest one,
+    so that it doesn't end up waiting for a worker.
+
+    Parameters
+    ----------
+    tree : TaxoTree
+        Global NCBI tree
+    workers : int
+        Number of worker processes. Groups are traversed serially if 1.
+    disable_progress : bool
+        If True, disable progress bars
+    """
+    if workers <= 1:
+        for groupnb in GROUP_ROOTS:
+            logger.info(f"---- Doing tree {groupnb}...")
+            traverse_tree(tree, groupnb=groupnb, disable_progress=disable_progress)  # type: ignore
+        return
+
+    subtrees = {groupnb: tree.subtree(taxid) for groupnb, taxid in GROUP_ROOTS.items()}
+    log_files = [
+        h.baseFilename for h in logger.handlers if isinstance(h, logging.FileHandler)
+    ]
+    # Workers are spawned, as forking a process which already used polars
+    # threads may deadlock
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(GROUP_ROOTS)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(log_files,),
+    ) as pool:
+        order = sorted(subtrees, key=lambda g: subtrees[g].n_nodes, reverse=True)
+        # Subtrees are released once sent to the workers
+        futures = {
+            pool.submit(_traverse_group, subtrees.pop(groupnb), groupnb): groupnb
+            for groupnb in order
+        }
+        for future in as_completed(futures):
+            groupnb = futures[future]
+            elapsed, steps = future.result()
+            metrics.merge_steps(steps)
+            logger.info(f"---- Tree {groupnb} done in {elapsed:.1f}s")
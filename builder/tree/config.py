@@ -19,3 +19,7 @@ LANG_LIST = ["en", "fr"]
 PSYCOPG_CONNECT_URL = (
     f"dbname='{DB_NAME}' user='{DB_USER}' host='{DB_HOST}' password='{DB_PASSWD}'"
 )
+
+SOLR_URL = "http://localhost:8983/solr"
+SOLR_USER = "solr"
+SOLR_PASSWD = config.get("SOLR_PASSWD")
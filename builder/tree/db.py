@@ -1,11 +1,139 @@
 import logging
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import Self
 
+import metrics
 import psycopg
 from config import PSYCOPG_CONNECT_URL
 
 logger = logging.getLogger("LifemapBuilder")
 
-TABLES = ["points", "branches", "polygons", "ranks", "cladecenters"]
+TABLES = [
+    "points",
+    "branches",
+    "polygons",
+    "ranks",
+    "cladecenters",
+    "branches_lowzoom",
+    "polygons_lowzoom",
+]
+
+# Columns and binary COPY types of the records written by Traverse. Geometries
+# are given as EWKB and received by postgis as binary geometry values.
+COPY_COLUMNS = {
+    "points": {
+        "id": "int8",
+        "taxid": "text",
+        "ref": "int2",
+        "sci_name": "text",
+        "common_name_en": "text",
+        "rank_en": "text",
+        "nbdesc": "int4",
+        "zoomview": "int4",
+        "tip": "bool",
+        "way": "bytea",
+    },
+    "branches": {
+        "id": "int8",
+        "branch": "bool",
+        "zoomview": "int4",
+        "ref": "int2",
+        "name": "text",
+        "way": "bytea",
+    },
+    "polygons": {
+        "id": "int8",
+        "ref": "int2",
+        "clade": "bool",
+        "taxid": "text",
+        "sci_name": "text",
+        "common_name_en": "text",
+        "rank_en": "text",
+        "nbdesc": "int4",
+        "zoomview": "int4",
+        "way": "bytea",
+    },
+    "cladecenters": {
+        "id": "int8",
+        "cladecenter": "bool",
+        "taxid": "text",
+        "sci_name": "text",
+        "common_name_en": "text",
+        "rank_en": "text",
+        "nbdesc": "int4",
+        "zoomview": "int4",
+        "way": "bytea",
+    },
+    "ranks": {
+        "id": "int8",
+        "ref": "int2",
+        "rankname": "bool",
+        "taxid": "text",
+        "sci_name": "text",
+        "zoomview": "int4",
+        "rank_en": "text",
+        "rank_fr": "text",
+        "nbdesc": "int4",
+        "convex": "float4",
+        "way": "bytea",
+    },
+    # Generalized geometries, one row for each tile zoom (genzoom) at which
+    # the full resolution row is displayed
+    "branches_lowzoom": {
+        "id": "int8",
+        "branch": "bool",
+        "zoomview": "int4",
+        "ref": "int2",
+        "genzoom": "int4",
+        "way": "bytea",
+    },
+    "polygons_lowzoom": {
+        "id": "int8",
+        "ref": "int2",
+        "clade": "bool",
+        "taxid": "text",
+        "nbdesc": "int4",
+        "zoomview": "int4",
+        "genzoom": "int4",
+        "way": "bytea",
+    },
+}
+
+
+# Indexes of each table, by name suffix. Tile queries of bbox filter on a
+# zoomview range, or a genzoom for generalized tables, and the tile bounding
+# box, see back/bbox/bbox.toml.j2, and mod_tile queries only on the bounding
+# box. Index names are prefixed by
+# their table name so that they are renamed along with it when published.
+_ZOOM_INDEXES = {
+    # Plain bounding box queries
+    "id": "USING GIST (way)",
+    # Zoomview range and bounding box queries
+    "zoomview_way": "USING GIST (zoomview, way)",
+    # Zoomview ranges over large parts of the table, once clustered
+    "zoomview_brin": "USING BRIN (zoomview)",
+}
+_GENZOOM_INDEXES = {
+    "genzoom_way": "USING GIST (genzoom, way)",
+}
+INDEXES = {
+    table: dict(_GENZOOM_INDEXES if table.endswith("_lowzoom") else _ZOOM_INDEXES)
+    for table in TABLES
+}
+# Rank labels are only queried with rankname=True
+INDEXES["ranks"]["rankname_zoomview_way"] = "USING GIST (zoomview, way) WHERE rankname"
+# Clustering order of each table: zoomview, or genzoom, then geometries along
+# a space filling curve. No query uses these indexes, which are dropped once
+# tables are clustered.
+CLUSTER_INDEXES = {
+    table: ("genzoom_order", "USING BTREE (genzoom, way)")
+    if table.endswith("_lowzoom")
+    else ("zoomview_order", "USING BTREE (zoomview, way)")
+    for table in TABLES
+}
 
 
 def db_connection() -> psycopg.Connection:
@@ -46,19 +174,25 @@ def init_db() -> None:
 
     logger.info("Creating new tables...")
     cur.execute(
-        "CREATE TABLE points (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text, full_name text,rank_en text, name text, nbdesc integer,taxid text,geom_txt text, way geometry(POINT,3857));"
+        "CREATE TABLE points (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text, full_name text,rank_en text, name text, nbdesc integer,taxid text, way geometry(POINT,3857));"
+    )
+    cur.execute(
+        "CREATE TABLE branches (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text,  full_name text,rank_en text, name text, nbdesc integer,taxid text, way geometry(LINESTRING,3857));"
+    )
+    cur.execute(
+        "CREATE TABLE polygons (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text,  full_name text,rank_en text, name text, nbdesc integer,taxid text, way geometry(POLYGON,3857));"
     )
     cur.execute(
-        "CREATE TABLE branches (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text,  full_name text,rank_en text, name text, nbdesc integer,taxid text,geom_txt text, way geometry(LINESTRING,3857));"
+        "CREATE TABLE ranks (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text,  full_name text, rank_en text, rank_fr text, name text, nbdesc integer, convex real, taxid text, way geometry(LINESTRING,3857));"
     )
     cur.execute(
-        "CREATE TABLE polygons (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text,  full_name text,rank_en text, name text, nbdesc integer,taxid text,geom_txt text, way geometry(POLYGON,3857));"
+        "CREATE TABLE cladecenters (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text, full_name text,rank_en text, name text, nbdesc integer,taxid text, way geometry(POINT,3857));"
     )
     cur.execute(
-        "CREATE TABLE ranks (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text,  full_name text, rank_en text, rank_fr text, name text, nbdesc integer, convex real, taxid text,geom_txt text, way geometry(LINESTRING,3857));"
+        "CREATE TABLE branches_lowzoom (id bigint,ref smallint,branch boolean,zoomview integer,genzoom integer, way geometry(LINESTRING,3857));"
     )
     cur.execute(
-        "CREATE TABLE cladecenters (id bigint,ref smallint,z_order smallint,branch boolean,tip boolean,zoomview integer,clade boolean,cladecenter boolean,rankname boolean,sci_name text,common_name_en text, full_name text,rank_en text, name text, nbdesc integer,taxid text,geom_txt text, way geometry(POINT,3857));"
+        "CREATE TABLE polygons_lowzoom (id bigint,ref smallint,clade boolean,taxid text,nbdesc integer,zoomview integer,genzoom integer, way geometry(POLYGON,3857));"
     )
     conn.commit()
 
@@ -72,84 +206,314 @@ def init_db() -> None:
     conn.close()
 
 
-def copy_db_to_prod() -> None:
+def _table_exists(cur: psycopg.Cursor, table: str) -> bool:
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+    return cur.fetchone()[0]  # type: ignore
+
+
+def _rename_table(cur: psycopg.Cursor, table: str, new_name: str) -> None:
+    """
+    Rename a table and its indexes, whose names are prefixed by the table name.
+    """
+    cur.execute(f"ALTER TABLE {table} RENAME TO {new_name};")  # type: ignore
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s;", (new_name,))
+    for (index,) in cur.fetchall():
+        if index.startswith(f"{table}_"):
+            cur.execute(
+                f"ALTER INDEX {index} RENAME TO {new_name}{index[len(table) :]};"
+            )  # type: ignore
+
+
+def build_tables_exist() -> bool:
+    """
+    Check if all build tables exist, i.e. they were built and not published yet.
+    """
+    conn = db_connection()
+    cur = conn.cursor()
+    res = all(_table_exists(cur, table) for table in TABLES)
+    conn.close()
+    return res
+
+
+def previous_tables_exist() -> bool:
+    """
+    Check if all tables of a previous build exist, as build or production tables.
+    """
+    conn = db_connection()
+    cur = conn.cursor()
+    res = all(
+        _table_exists(cur, table) or _table_exists(cur, f"{table}_prod")
+        for table in TABLES
+    )
+    conn.close()
+    return res
+
+
+def publish_tables() -> None:
     """
-    Create production database tables from building ones.
+    Swap the indexed build tables in as production tables.
+
+    All tables are renamed in a single transaction: build tables become
+    production ones, and the current production tables are kept as
+    {table}_prod_old for rollback, replacing the previous generation.
     """
     conn = db_connection()
     cur = conn.cursor()
 
     for table in TABLES:
-        logger.info(f"Copying {table}...")
-        cur.execute(f"DROP TABLE IF EXISTS {table}_prod;")  # type: ignore
-        cur.execute(f"CREATE TABLE {table}_prod AS TABLE {table};")  # type: ignore
+        logger.info(f"Publishing {table}...")
+        cur.execute(f"DROP TABLE IF EXISTS {table}_prod_old;")  # type: ignore
+        if _table_exists(cur, f"{table}_prod"):
+            _rename_table(cur, f"{table}_prod", f"{table}_prod_old")
+        _rename_table(cur, table, f"{table}_prod")
 
     conn.commit()
     conn.close()
 
 
-def create_geometries() -> None:
-    """
-    Create geometry columns in postgis db tables from geom_txt columns.
+def rollback_prod() -> None:
     """
+    Swap the previous generation of production tables back in.
 
+    The rolled back tables are kept as {table}_prod_old, so that a rollback
+    can be undone by calling this function again.
+    """
     conn = db_connection()
     cur = conn.cursor()
 
     for table in TABLES:
-        logger.info(f"Creating {table} geometry")
-        query = f"UPDATE {table} SET way = ST_Transform(ST_GeomFromText(geom_txt, 4326), 3857) WHERE way IS NULL;"
-        cur.execute(query)  # type: ignore
-        conn.commit()
+        if not _table_exists(cur, f"{table}_prod_old"):
+            raise RuntimeError(
+                f"No previous generation of {table}_prod to roll back to"
+            )
+        logger.info(f"Rolling back {table}_prod...")
+        _rename_table(cur, f"{table}_prod", f"{table}_prod_new")
+        _rename_table(cur, f"{table}_prod_old", f"{table}_prod")
+        _rename_table(cur, f"{table}_prod_new", f"{table}_prod_old")
+
+    conn.commit()
+    conn.close()
+
+
+def restore_build_tables(stale_ids: Iterable[int]) -> None:
+    """
+    Prepare the build tables of an incremental build, without the records of
+    `stale_ids`.
+
+    Build tables which were not published yet are kept. Published ones are
+    recreated from production tables, copying only the records which are
+    not stale, so that they are written once and not updated afterwards.
+    """
+    conn = db_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "CREATE TEMPORARY TABLE stale_ids (id bigint PRIMARY KEY) ON COMMIT DROP;"
+    )
+    with cur.copy("COPY stale_ids (id) FROM STDIN") as copy:
+        for id in stale_ids:
+            copy.write_row((id,))
+    cur.execute("ANALYZE stale_ids;")
 
-    logger.info("Dropping geom_txt columns")
     for table in TABLES:
-        query = f"ALTER TABLE {table} DROP COLUMN geom_txt;"
-        cur.execute(query)  # type: ignore
-        conn.commit()
+        if _table_exists(cur, table):
+            logger.info(f"Deleting changed records from {table}...")
+            cur.execute(
+                f"DELETE FROM {table} USING stale_ids WHERE {table}.id = stale_ids.id;"
+            )  # type: ignore
+        else:
+            logger.info(f"Restoring {table} from {table}_prod...")
+            cur.execute(f"CREATE TABLE {table} (LIKE {table}_prod);")  # type: ignore
+            cur.execute(
+                f"INSERT INTO {table} SELECT * FROM {table}_prod AS p "
+                "WHERE NOT EXISTS (SELECT FROM stale_ids AS s WHERE s.id = p.id);"
+            )  # type: ignore
+
+    conn.commit()
+    conn.close()
+
+
+def _table_size(cur: psycopg.Cursor, table: str) -> int:
+    cur.execute("SELECT pg_total_relation_size(%s);", (table,))
+    res = cur.fetchone()
+    return res[0] if res is not None else 0
 
+
+class CopyWriter:
+    """
+    Binary COPY into a table, kept open while records are streamed into it.
+
+    Each writer uses its own connection, as a connection can only run one
+    COPY at a time. Rows are sent to the server as they are written, so
+    records don't have to be materialized in memory. The transaction is
+    committed when the writer is closed without error.
+
+    The metrics of the COPY are set in `metrics` when the writer is closed.
+    Bytes written are measured as the growth of the table, which includes
+    rows written by concurrent writers into the same table.
+
+    Parameters
+    ----------
+    table : str
+        Table name, must be a key of COPY_COLUMNS.
+    """
+
+    def __init__(self, table: str) -> None:
+        columns = COPY_COLUMNS[table]
+        self.table = table
+        self.n_rows = 0
+        self.metrics: dict = {}
+        self.conn = db_connection()
+        self._stack = ExitStack()
+        cur = self._stack.enter_context(self.conn.cursor())
+        self._start_size = _table_size(cur, table)
+        self._measure = metrics.Measure()
+        self.copy = self._stack.enter_context(
+            cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN (FORMAT BINARY)")  # type: ignore
+        )
+        self.copy.set_types(list(columns.values()))
+
+    def write(self, records: Iterable[tuple]) -> None:
+        """
+        Write records, with values in COPY_COLUMNS order.
+        """
+        for record in records:
+            self.copy.write_row(record)
+            self.n_rows += 1
+
+    def close(self) -> None:
+        """
+        End the COPY and commit it.
+        """
+        self._stack.close()
+        self.conn.commit()
+        size = _table_size(self.conn.cursor(), self.table)
+        self.metrics = self._measure.values(self.n_rows, size - self._start_size)
+        self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._stack.__exit__(exc_type, exc, tb)
+            self.conn.close()
+
+
+def table_sizes(suffix: str = "") -> dict[str, int]:
+    """
+    Get the size on disk of build tables, or of the tables with a suffix such
+    as production ones.
+
+    Sizes don't include indexes, so that tables can be compared whether they
+    are indexed or not.
+
+    Parameters
+    ----------
+    suffix : str, optional
+        Suffix of the table names, such as "_prod", by default "".
+
+    Returns
+    -------
+    dict[str, int]
+        Size in bytes of each table, including TOAST, and 0 for missing
+        tables.
+    """
+    conn = db_connection()
+    cur = conn.cursor()
+    sizes = {}
+    for table in TABLES:
+        cur.execute("SELECT pg_table_size(to_regclass(%s));", (f"{table}{suffix}",))
+        res = cur.fetchone()
+        sizes[table] = res[0] if res is not None and res[0] is not None else 0
     conn.close()
+    return sizes
 
 
-def create_index() -> None:
+def _index_table(table: str, maintenance_work_mem: str | None) -> dict[str, float]:
     """
-    Apply create index, clustering and analyzing on postgis geometries.
+    Index, cluster and analyze a build table on its own connection.
+
+    Returns
+    -------
+    dict[str, float]
+        Time in seconds of each step.
     """
     conn = db_connection()
     cur = conn.cursor()
+    if maintenance_work_mem is not None:
+        cur.execute(
+            "SELECT set_config('maintenance_work_mem', %s, false);",
+            (maintenance_work_mem,),
+        )
 
-    logger.info("Creating indexes...")
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS branches_prod_id ON branches_prod USING GIST(way);"
-    )
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS ranks_prod_id ON ranks_prod USING GIST(way);"
-    )
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS points_prod_id ON points_prod USING GIST(way);"
-    )
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS cladecenters_prod_id ON cladecenters_prod USING GIST(way);"
-    )
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS polygons_prod_id ON polygons_prod USING GIST(way);"
-    )
+    timings = {}
+    start = time.perf_counter()
+    for name, definition in INDEXES[table].items():
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_{name} ON {table} {definition};"
+        )  # type: ignore
     conn.commit()
+    timings["index"] = time.perf_counter() - start
 
-    logger.info("Clustering...")
-    cur.execute("CLUSTER branches_prod USING branches_prod_id;")
-    cur.execute("CLUSTER ranks_prod USING ranks_prod_id;")
-    cur.execute("CLUSTER points_prod USING points_prod_id;")
-    cur.execute("CLUSTER cladecenters_prod USING cladecenters_prod_id;")
-    cur.execute("CLUSTER polygons_prod USING polygons_prod_id;")
+    start = time.perf_counter()
+    name, definition = CLUSTER_INDEXES[table]
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_{name} ON {table} {definition};")  # type: ignore
+    cur.execute(f"CLUSTER {table} USING {table}_{name};")  # type: ignore
+    cur.execute(f"DROP INDEX {table}_{name};")  # type: ignore
     conn.commit()
+    timings["cluster"] = time.perf_counter() - start
 
-    logger.info("Analyzing...")
-    cur.execute("ANALYZE branches_prod;")
-    cur.execute("ANALYZE ranks_prod;")
-    cur.execute("ANALYZE points_prod;")
-    cur.execute("ANALYZE cladecenters_prod;")
-    cur.execute("ANALYZE polygons_prod;")
+    start = time.perf_counter()
+    cur.execute(f"ANALYZE {table};")  # type: ignore
     conn.commit()
+    timings["analyze"] = time.perf_counter() - start
 
     conn.close()
+    return timings
+
+
+def create_index(workers: int = 1, maintenance_work_mem: str | None = None) -> None:
+    """
+    Apply create index, clustering and analyzing on postgis geometries of
+    the build tables, before they are published.
+
+    Tables are clustered by zoomview, then along the space filling curve of
+    postgis geometries ordering, so that the rows of a tile at a given zoom
+    are stored together, and the index of this order is then dropped as no
+    query uses it. Each table is processed on its own connection, and
+    up to `workers` tables at once, from the largest one.
+
+    Parameters
+    ----------
+    workers : int
+        Number of tables processed concurrently.
+    maintenance_work_mem : str | None
+        Value of maintenance_work_mem for each connection, such as "1GB".
+        Server default if None.
+    """
+    conn = db_connection()
+    cur = conn.cursor()
+    # Needed for the zoomview column of multicolumn GiST indexes
+    cur.execute("CREATE EXTENSION IF NOT EXISTS btree_gist;")
+    conn.commit()
+    conn.close()
+
+    sizes = table_sizes()
+    order = sorted(TABLES, key=lambda table: sizes[table], reverse=True)
+    logger.info(
+        f"Indexing, clustering and analyzing tables with {workers} connections..."
+    )
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {
+            pool.submit(_index_table, table, maintenance_work_mem): table
+            for table in order
+        }
+        for future in as_completed(futures):
+            table = futures[future]
+            timings = future.result()
+            logger.info(
+                f"  Table {table}: indexed in {timings['index']:.1f}s, "
+                f"clustered in {timings['cluster']:.1f}s, analyzed in {timings['analyze']:.1f}s"
+            )
@@ -3,13 +3,30 @@
 import logging
 from datetime import datetime
 from pathlib import Path
+from typing import Literal
 
+import metrics
+import numpy as np
 import polars as pl
 from config import BUILD_DIRECTORY, LMDATA_DIRECTORY
+from taxotree import preorder_intervals, taxid_positions
 from utils import LUCA
 
 logger = logging.getLogger("LifemapBuilder")
 
+# Root taxid of each kingdom
+KINGDOMS = {2157: "archaea", 2759: "eukaryotes", 2: "bacteria"}
+
+# Rows per row group and bytes per data page of the client layout. Row
+# groups are skipped by predicate pushdown from their column statistics,
+# and pages from the page index, so both are kept small enough for HTTP
+# range reads to fetch only the data matching a query
+CLIENT_ROW_GROUP_SIZE = 65_536
+CLIENT_PAGE_SIZE = 64 * 1024
+
+# Width in pixels of a map tile
+TILE_SIZE = 256
+
 
 def clean_lmdata() -> None:
     logger.info(" Cleaning lmdata directory...")
@@ -27,6 +44,25 @@ def clean_lmdata() -> None:
                 print(f"Error deleting {file_path}: {e}")
 
 
+def preorder_columns(lm: pl.DataFrame) -> pl.DataFrame:
+    """
+    Add the depth and the preorder entry and exit indexes of each taxon.
+
+    A taxon is in the subtree of another one if its entry lies between the
+    entry and the exit of the other one. The root has depth 0.
+    """
+    taxid = lm.get_column("taxid").to_numpy()
+    parent = taxid_positions(taxid, lm.get_column("parent").fill_null(-1).to_numpy())
+    parent[lm.get_column("parent").is_null().to_numpy()] = -1
+    depth = lm.get_column("ascend").list.len().to_numpy()
+    entry, exit = preorder_intervals(parent, depth)
+    return lm.with_columns(
+        depth=pl.Series(depth, dtype=pl.Int32),
+        entry=pl.Series(entry, dtype=pl.Int32),
+        exit=pl.Series(exit, dtype=pl.Int32),
+    )
+
+
 def convert_features(lm: pl.DataFrame) -> pl.DataFrame:
     # Add root
     lm = pl.concat(
@@ -59,12 +95,14 @@ def convert_features(lm: pl.DataFrame) -> pl.DataFrame:
         pl.col("zoom").fill_null(1).cast(pl.Int8),
         pl.col("sci_name").cast(pl.Utf8),
         pl.col("ascend").cast(pl.List(pl.Int32)),
-        # depth=pl.col("ascend").list.len(),
         parent=pl.col("ascend").list.get(0, null_on_oob=True).cast(pl.Int32),
     )
     # Compute n_children
     parents = lm.get_column("parent").unique()
     lm = lm.with_columns(leaf=pl.col("taxid").is_in(parents).not_())
+    # Rows are sorted in preorder, so that the subtree of a taxon is the
+    # range of rows from its entry to its exit
+    lm = preorder_columns(lm).sort("entry")
     # lm = lm.with_columns(
     #    child=pl.when(pl.col("leaf")).then(1).otherwise(None)
     # )
@@ -80,6 +118,9 @@ def convert_features(lm: pl.DataFrame) -> pl.DataFrame:
             "ascend": "pylifemap_ascend",
             "leaf": "pylifemap_leaf",
             "parent": "pylifemap_parent",
+            "depth": "pylifemap_depth",
+            "entry": "pylifemap_entry",
+            "exit": "pylifemap_exit",
         }
     )
     lm = lm.select(
@@ -91,28 +132,167 @@ def convert_features(lm: pl.DataFrame) -> pl.DataFrame:
             "pylifemap_ascend",
             "pylifemap_leaf",
             "pylifemap_parent",
+            "pylifemap_depth",
+            "pylifemap_entry",
+            "pylifemap_exit",
         ]
     )
     return lm
 
 
-def export_lmdata() -> None:
+def float32_precision(lon: np.ndarray, lat: np.ndarray, zoom: np.ndarray) -> bool:
+    """
+    Whether float32 coordinates are within half a pixel of the float64 ones,
+    at the zoom level of each taxon.
+    """
+    pixel = 360 / (TILE_SIZE * 2.0 ** zoom.astype(np.float64)) * np.cos(np.radians(lat))
+    error = np.maximum(
+        np.abs(lon - lon.astype(np.float32).astype(np.float64)),
+        np.abs(lat - lat.astype(np.float32).astype(np.float64)),
+    )
+    return bool(np.all(error <= pixel / 2))
+
+
+def client_layout(
+    lmdata: pl.DataFrame, features: pl.DataFrame
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Sort the converted and raw features by kingdom, zoom and preorder, for
+    selective reads by clients.
+
+    A pylifemap_kingdom column is added to the converted features, and a
+    kingdom column to the raw ones. Coordinates are stored as float32 if
+    the precision allows it at the zoom level of all taxa.
+
+    Parameters
+    ----------
+    lmdata : pl.DataFrame
+        Converted features, from convert_features.
+    features : pl.DataFrame
+        Raw features, whose ascend lists keep taxids as strings.
+
+    Returns
+    -------
+    tuple[pl.DataFrame, pl.DataFrame]
+        Converted and raw features in the client layout.
+    """
+    # The kingdom of a taxon is its ancestor at depth 1, LUCA having none
+    kingdom_taxid = (
+        pl.when(pl.col("pylifemap_depth") == 1)
+        .then(pl.col("taxid"))
+        .otherwise(pl.col("pylifemap_ascend").list.get(-2, null_on_oob=True))
+    )
+    # Kingdoms are sorted in the order of KINGDOMS, but stored as strings,
+    # which are dictionary encoded and whose statistics allow predicate
+    # pushdown
+    lmdata = (
+        lmdata.with_columns(
+            pylifemap_kingdom=kingdom_taxid.replace_strict(
+                KINGDOMS, default=None, return_dtype=pl.Enum(list(KINGDOMS.values()))
+            )
+        )
+        .sort(
+            "pylifemap_kingdom", "pylifemap_zoom", "pylifemap_entry", nulls_last=False
+        )
+        .with_columns(pl.col("pylifemap_kingdom").cast(pl.Utf8))
+    )
+
+    coordinates = ["pylifemap_x", "pylifemap_y"]
+    if float32_precision(
+        *(lmdata.get_column(col).to_numpy() for col in [*coordinates, "pylifemap_zoom"])
+    ):
+        lmdata = lmdata.with_columns(pl.col(coordinates).cast(pl.Float32))
+    else:
+        logger.info(
+            "  Coordinates kept as float64 for the precision of the deepest zoom levels"
+        )
+
+    # Raw features follow the order of the converted ones
+    features = (
+        lmdata.select(
+            pl.col("taxid").cast(pl.Utf8), kingdom=pl.col("pylifemap_kingdom")
+        )
+        .join(features, on="taxid", how="inner", maintain_order="left")
+        .select(*features.columns, "kingdom")
+        .with_columns(
+            pl.col("lon").cast(lmdata.schema["pylifemap_x"]),
+            pl.col("lat").cast(lmdata.schema["pylifemap_y"]),
+        )
+    )
+    return lmdata, features
+
+
+def write_client_parquet(
+    df: pl.DataFrame,
+    file: Path,
+    kingdom: str,
+    compression: Literal["lz4", "zstd"] = "zstd",
+) -> None:
+    """
+    Write a data frame in the client layout, and one file per kingdom named
+    after it, with small row groups and pages, column statistics and a page
+    index.
+    """
+    files = {None: file} | {
+        name: file.with_name(f"{file.stem}_{name}{file.suffix}")
+        for name in KINGDOMS.values()
+    }
+    for name, path in files.items():
+        frame = df if name is None else df.filter(pl.col(kingdom) == name)
+        frame.write_parquet(
+            path,
+            compression=compression,
+            row_group_size=CLIENT_ROW_GROUP_SIZE,
+            data_page_size=CLIENT_PAGE_SIZE,
+            statistics=True,
+        )
+        logger.info(f"  {path.name}: {path.stat().st_size / 1024**2:.1f} MB")
+
+
+def export_lmdata(
+    layout: Literal["preorder", "client"] = "preorder",
+    features_file: Path = BUILD_DIRECTORY / "TreeFeaturesComplete.parquet",
+    directory: Path = LMDATA_DIRECTORY,
+) -> None:
+    """
+    Export the features to the lmdata parquet files.
+
+    Parameters
+    ----------
+    layout : {"preorder", "client"}
+        With "preorder", rows of lmdata.parquet are sorted in preorder, so
+        that each clade is a contiguous range of rows. With "client", rows
+        of both files are sorted by kingdom, zoom and preorder, with small
+        row groups, and per-kingdom files are also written, so that clients
+        reading a kingdom or a zoom range only fetch the row groups needed.
+    features_file : Path
+        Parquet file of the complete features.
+    directory : Path
+        Directory of the lmdata files.
+    """
     # Copy parquet file to lmdata directory
     try:
-        features_file = BUILD_DIRECTORY / "TreeFeaturesComplete.parquet"
         features = pl.read_parquet(features_file)
 
         # We save data to two different parquet files:
         # - lmdata_R.parquet is the raw features dataset compressed with lz4,
-        #   which is less efficient but supported in R arrow package
-        dest_file_R = LMDATA_DIRECTORY / "lmdata_R.parquet"
-        features.write_parquet(dest_file_R, compression="lz4")
-
+        #   which is less efficient but supported in R arrow package. Its
+        #   ascend lists keep taxids as strings
         # - lmdata.parquet contains the converted features compressed with the
         #   default zstd compression
+        dest_file_R = directory / "lmdata_R.parquet"
+        dest_file_py = directory / "lmdata.parquet"
+        features_R = features.with_columns(pl.col("ascend").cast(pl.List(pl.Utf8)))
         lmdata = convert_features(features)
-        dest_file_py = LMDATA_DIRECTORY / "lmdata.parquet"
-        lmdata.write_parquet(dest_file_py)
+
+        if layout == "client":
+            lmdata, features_R = client_layout(lmdata, features_R)
+            write_client_parquet(features_R, dest_file_R, "kingdom", compression="lz4")
+            write_client_parquet(lmdata, dest_file_py, "pylifemap_kingdom")
+        else:
+            features_R.write_parquet(dest_file_R, compression="lz4")
+            lmdata.write_parquet(dest_file_py)
+        metrics.add(rows=len(lmdata))
 
     except Exception as e:
         raise RuntimeError(f"Error exporting data to parquet: {e}")
@@ -123,7 +303,7 @@ def export_lmdata() -> None:
     # Format the datetime as a string in the desired format
     now_str = now.strftime("%Y%m%d%H%M")
 
-    with open(LMDATA_DIRECTORY / "timestamp.txt", "w") as f:
+    with open(directory / "timestamp.txt", "w") as f:
         f.write(now_str)
 
     logger.info(" Copying parquet file to lmdata directory...")
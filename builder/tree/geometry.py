@@ -0,0 +1,81 @@
+"""
+Geometry encoding: projection to Web Mercator and EWKB serialization.
+
+Geometries are computed by Traverse in EPSG:4326 degrees, and written to postgis
+as EPSG:3857 EWKB, so that they can be copied directly into the `way` columns.
+"""
+
+import numpy as np
+
+SRID = 3857
+EARTH_RADIUS = 6378137.0
+
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+EWKB_SRID_FLAG = 0x20000000
+
+
+def to_web_mercator(coords: np.ndarray) -> np.ndarray:
+    """
+    Project longitude / latitude coordinates to EPSG:3857.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Coordinates in degrees, last dimension being (lon, lat).
+
+    Returns
+    -------
+    np.ndarray
+        Projected coordinates, same shape as `coords`.
+    """
+    x = EARTH_RADIUS * np.radians(coords[..., 0])
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(coords[..., 1]) / 2))
+    return np.stack((x, y), axis=-1)
+
+
+def _encode(
+    geom_type: int, coords: np.ndarray, counts: tuple[int, ...] = ()
+) -> list[bytes]:
+    """
+    Encode N geometries of the same type and number of points as EWKB.
+
+    All geometries having the same size, they are written in a single packed
+    structured array which is then split into fixed-size chunks.
+    """
+    fields: list[tuple] = [("byte_order", "u1"), ("type", "<u4"), ("srid", "<u4")]
+    fields += [(f"count{i}", "<u4") for i in range(len(counts))]
+    fields += [("coords", "<f8", coords.shape[1:])]
+    records = np.empty(len(coords), dtype=np.dtype(fields))
+    records["byte_order"] = 1  # little endian
+    records["type"] = geom_type | EWKB_SRID_FLAG
+    records["srid"] = SRID
+    for i, count in enumerate(counts):
+        records[f"count{i}"] = count
+    records["coords"] = to_web_mercator(coords)
+    data = records.tobytes()
+    size = records.dtype.itemsize
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def ewkb_points(coords: np.ndarray) -> list[bytes]:
+    """
+    EWKB of points from their (N, 2) degrees coordinates.
+    """
+    return _encode(WKB_POINT, coords)
+
+
+def ewkb_linestrings(coords: np.ndarray) -> list[bytes]:
+    """
+    EWKB of linestrings from their (N, n_points, 2) degrees coordinates.
+    """
+    return _encode(WKB_LINESTRING, coords, counts=(coords.shape[1],))
+
+
+def ewkb_polygons(rings: np.ndarray) -> list[bytes]:
+    """
+    EWKB of single ring polygons from their (N, n_points, 2) degrees
+    coordinates. Rings must be closed.
+    """
+    return _encode(WKB_POLYGON, rings, counts=(1, rings.shape[1]))
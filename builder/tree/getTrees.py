@@ -1,129 +1,293 @@
+import hashlib
+import json
 import logging
-from dataclasses import dataclass, field
+from pathlib import Path
 
+import polars as pl
 from config import LANG_LIST, TAXO_DIRECTORY
-from ete4 import Tree
+from taxotree import NAME_COLUMNS, TaxoTree
 from utils import get_ranks_translations, get_translations_fr
 
 logger = logging.getLogger("LifemapBuilder")
 
+# Parsed taxonomy snapshot. SNAPSHOT_VERSION must be increased when the
+# content of the snapshot changes, to invalidate existing ones.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = TAXO_DIRECTORY / "taxonomy_snapshot.arrow"
+SNAPSHOT_META_FILE = TAXO_DIRECTORY / "taxonomy_snapshot.json"
+# The snapshot replaced by the last parsing is kept for incremental builds
+PREVIOUS_SNAPSHOT_FILE = TAXO_DIRECTORY / "taxonomy_snapshot.previous.arrow"
+PREVIOUS_SNAPSHOT_META_FILE = TAXO_DIRECTORY / "taxonomy_snapshot.previous.json"
+SNAPSHOT_SOURCES = [
+    TAXO_DIRECTORY / "nodes.dmp",
+    TAXO_DIRECTORY / "names.dmp",
+    TAXO_DIRECTORY / "TAXONOMIC-VERNACULAR-FR-LATEST.txt",
+]
 
-@dataclass
-class Taxid:
-    sci_name: str = ""
-    authority: str = ""
-    synonym: str = ""
-    common_name: dict = field(default_factory=dict)
-    common_name_long: dict = field(default_factory=dict)
+
+def _read_dmp(path: Path, columns: dict[str, int]) -> pl.DataFrame:
+    """
+    Read columns of a taxdump .dmp file as strings.
+
+    Fields are separated by "\t|\t" and lines end with "\t|". As in a
+    ``line.split("|")`` parser, the file is split on "|" and tabs are removed
+    from the fields.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the .dmp file.
+    columns : dict[str, int]
+        Name and field index of the columns to read.
+
+    Returns
+    -------
+    pl.DataFrame
+        One string column per requested field.
+    """
+    df = pl.read_csv(
+        path,
+        separator="|",
+        has_header=False,
+        quote_char=None,
+        infer_schema=False,
+        truncate_ragged_lines=True,
+    )
+    return df.select(
+        pl.nth(index).str.replace_all("\t", "", literal=True).alias(name)
+        for name, index in columns.items()
+    )
 
 
-def get_attributes() -> dict:
+def read_names(taxo_fr_translations: dict[str, set] | None = None) -> pl.DataFrame:
     """
-    List attributes of each species per taxid
+    Read names.dmp and aggregate the names attributes of each taxid.
+
+    Scientific names keep the last value, authorities and synonyms are
+    joined with ", ". Common names are the first name and the joined list
+    of all names, french ones coming from the taxonomy-fr translations.
+
+    Parameters
+    ----------
+    taxo_fr_translations : dict[str, set], optional
+        French common names of each taxid, loaded if not given.
 
     Returns
     -------
-    dict
-        attributes dictionary.
+    pl.DataFrame
+        taxid column, and one column per NAME_COLUMNS attribute with "" when
+        the taxid has no such name.
     """
+    if taxo_fr_translations is None:
+        taxo_fr_translations = get_translations_fr()
+
+    names = _read_dmp(TAXO_DIRECTORY / "names.dmp", {"taxid": 0, "value": 1, "type": 3})
+    names = names.with_columns(pl.col("taxid").cast(pl.Int32))
+
+    def by_type(name_type: str):
+        return names.filter(pl.col("type") == name_type).group_by(
+            "taxid", maintain_order=True
+        )
+
+    common_names = {
+        "en": by_type("common name").agg(pl.col("value").alias("common_names")),
+        "fr": pl.DataFrame(
+            {
+                "taxid": [
+                    int(taxid) for taxid in taxo_fr_translations if taxid.isdigit()
+                ],
+                "common_names": [
+                    list(values)
+                    for taxid, values in taxo_fr_translations.items()
+                    if taxid.isdigit()
+                ],
+            },
+            schema={"taxid": pl.Int32, "common_names": pl.List(pl.Utf8)},
+        ),
+    }
+    attributes = [
+        by_type("scientific name").agg(pl.col("value").last().alias("sci_name")),
+        by_type("authority").agg(pl.col("value").str.join(", ").alias("authority")),
+        by_type("synonym").agg(pl.col("value").str.join(", ").alias("synonym")),
+    ]
+    for lang in LANG_LIST:
+        attributes.append(
+            common_names[lang].select(
+                "taxid",
+                pl.col("common_names").list.first().alias(f"common_name_{lang}"),
+                pl.col("common_names")
+                .list.join(", ")
+                .alias(f"common_name_long_{lang}"),
+            )
+        )
+
+    res = names.select("taxid").unique(maintain_order=True)
+    for df in attributes:
+        res = res.join(df, on="taxid", how="left", maintain_order="left")
+
+    escaped = ["sci_name"] + [f"common_name_{lang}" for lang in LANG_LIST]
+    return res.select(
+        "taxid",
+        *(
+            pl.col(col).fill_null("").str.replace_all("'", "''", literal=True)
+            if col in escaped
+            else pl.col(col).fill_null("")
+            for col in NAME_COLUMNS
+        ),
+    )
 
-    logger.info("Reading NCBI taxonomy...")
 
+def read_taxonomy(taxo_fr_translations: dict[str, set] | None = None) -> pl.DataFrame:
+    """
+    Parse nodes.dmp and names.dmp into a single table.
+
+    Returns
+    -------
+    pl.DataFrame
+        taxid, parent taxid, rank and NAME_COLUMNS attributes of each node,
+        in nodes.dmp order.
+    """
+    names = read_names(taxo_fr_translations)
+
+    nodes = _read_dmp(
+        TAXO_DIRECTORY / "nodes.dmp", {"taxid": 0, "parent": 1, "rank": 2}
+    )
+    nodes = nodes.with_columns(pl.col("taxid", "parent").cast(pl.Int32))
+
+    taxonomy = nodes.join(names, on="taxid", how="left", maintain_order="left")
+    missing = taxonomy.filter(pl.col("sci_name").is_null()).get_column("taxid")
+    if len(missing) > 0:
+        raise ValueError(
+            f"Taxids without names in names.dmp: {missing.head(10).to_list()}"
+        )
+    return taxonomy
+
+
+def snapshot_key() -> dict:
+    """
+    Identify the taxonomy source files of the current build by their checksums.
+    """
+    checksums = {}
+    for path in SNAPSHOT_SOURCES:
+        with open(path, "rb") as f:
+            checksums[path.name] = hashlib.file_digest(f, "sha256").hexdigest()
+    return {"version": SNAPSHOT_VERSION, "checksums": checksums}
+
+
+def _snapshot_meta(meta_file: Path) -> dict | None:
+    if not meta_file.exists():
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def current_snapshot_key() -> dict | None:
+    """
+    Key of the current taxonomy snapshot, if any.
+    """
+    meta = _snapshot_meta(SNAPSHOT_META_FILE)
+    return None if meta is None else meta["key"]
+
+
+def find_snapshot(key: dict) -> pl.DataFrame | None:
+    """
+    Get the current or previous taxonomy snapshot with the given key.
+
+    Returns
+    -------
+    pl.DataFrame | None
+        Taxonomy table, or None if no snapshot has this key.
+    """
+    for data_file, meta_file in (
+        (SNAPSHOT_FILE, SNAPSHOT_META_FILE),
+        (PREVIOUS_SNAPSHOT_FILE, PREVIOUS_SNAPSHOT_META_FILE),
+    ):
+        meta = _snapshot_meta(meta_file)
+        if meta is not None and meta["key"] == key and data_file.exists():
+            # Uncompressed IPC files are memory-mapped by read_ipc
+            return pl.read_ipc(data_file)
+    return None
+
+
+def load_taxonomy() -> pl.DataFrame:
+    """
+    Get the parsed taxonomy table, from the snapshot in TAXO_DIRECTORY if it
+    was built from the same taxdump and translation files, or by parsing
+    them and writing a new snapshot otherwise. In this case the replaced
+    snapshot is kept as the previous one.
+
+    The snapshot is an uncompressed Arrow IPC file, so that it can be
+    memory-mapped when read.
+
+    Returns
+    -------
+    pl.DataFrame
+        Taxonomy table, as returned by `read_taxonomy`.
+    """
+    # Download translations before computing their checksum
     taxo_fr_translations = get_translations_fr()
+    key = snapshot_key()
 
-    attr = {}  ##here we will list attribute of each species per taxid
-    with open(TAXO_DIRECTORY / "names.dmp") as f:
-        for line in f:
-            taxid = line.split("|")[0].replace("\t", "")
-            tid_val = line.split("|")[1].replace("\t", "")
-            tid_type = line.split("|")[3].replace("\t", "")
-            if taxid not in attr:
-                attr[taxid] = Taxid()
-                for lang in LANG_LIST:
-                    attr[taxid].common_name[lang] = []
-            if tid_type == "common name":
-                attr[taxid].common_name["en"].append(tid_val)
-            if taxid in taxo_fr_translations:
-                attr[taxid].common_name["fr"] = taxo_fr_translations[taxid]
-            if tid_type == "scientific name":
-                attr[taxid].sci_name = tid_val
-                # and get translation in french (if any)
-            if tid_type == "authority":
-                if attr[taxid].authority != "":
-                    attr[taxid].authority = attr[taxid].authority + ", " + tid_val
-                else:
-                    attr[taxid].authority = tid_val
-            if tid_type == "synonym":
-                if attr[taxid].synonym != "":
-                    attr[taxid].synonym = attr[taxid].synonym + ", " + tid_val
-                else:
-                    attr[taxid].synonym = tid_val
-
-    for tax_id in attr:
-        attr[tax_id].sci_name = attr[tax_id].sci_name.replace("'", "''")
-        for lang in LANG_LIST:
-            if len(attr[tax_id].common_name[lang]) > 0:
-                common_name_long = ", ".join(attr[tax_id].common_name[lang])
-                attr[tax_id].common_name_long[lang] = f"{common_name_long}"
-                common_name = next(iter(attr[tax_id].common_name[lang]))
-                attr[tax_id].common_name[lang] = f"{common_name.replace("'", "''")}"
-            else:
-                attr[tax_id].common_name[lang] = ""
-                attr[tax_id].common_name_long[lang] = ""
-
-    return attr
-
-
-def getTheTrees() -> dict:
-    attr = get_attributes()
-    ranks_translations = get_ranks_translations()
+    if current_snapshot_key() == key and SNAPSHOT_FILE.exists():
+        logger.info(f"  Loading parsed taxonomy from {SNAPSHOT_FILE}")
+        return pl.read_ipc(SNAPSHOT_FILE)
+
+    logger.info("Reading NCBI taxonomy...")
+    taxonomy = read_taxonomy(taxo_fr_translations)
+
+    if SNAPSHOT_META_FILE.exists() and SNAPSHOT_FILE.exists():
+        logger.info("  Taxonomy files changed since last snapshot")
+        SNAPSHOT_FILE.replace(PREVIOUS_SNAPSHOT_FILE)
+        SNAPSHOT_META_FILE.replace(PREVIOUS_SNAPSHOT_META_FILE)
 
-    tree = {}
+    # Write data before metadata, so that an interrupted write is never
+    # seen as a valid snapshot
+    SNAPSHOT_META_FILE.unlink(missing_ok=True)
+    tmp_file = SNAPSHOT_FILE.with_suffix(".tmp")
+    taxonomy.write_ipc(tmp_file, compression="uncompressed")
+    tmp_file.replace(SNAPSHOT_FILE)
+    with open(SNAPSHOT_META_FILE, "w") as f:
+        json.dump({"key": key, "n_nodes": len(taxonomy)}, f, indent=2)
+    logger.info(f"  Parsed taxonomy saved to {SNAPSHOT_FILE}")
+
+    return taxonomy
+
+
+def tree_from_taxonomy(taxonomy: pl.DataFrame) -> TaxoTree:
+    """
+    Build the tree of a parsed taxonomy table.
+    """
+    ranks_translations = get_ranks_translations()
 
     logger.info("Building the NCBI taxonomy tree...")
 
-    filepath = TAXO_DIRECTORY / "nodes.dmp"
-    with open(filepath) as fp:
-        _ = fp.readline()  ## remove the 1 | 1 edge
-        for line in fp:
-            line = line.split("|")
-            dad = line[1].replace("\t", "")
-            son = line[0].replace("\t", "")
-            rank = line[2].replace("\t", "")
-            rank_en = rank.replace("'", "''")
-            rank_fr = ranks_translations[rank]["fr"].replace("'", "''")
-
-            if dad not in tree:
-                tree[dad] = Tree()
-                tree[dad].props["name"] = dad
-                tree[dad].props["taxid"] = dad
-                tree[dad].props["sci_name"] = attr[dad].sci_name
-                tree[dad].props["common_name"] = {}
-                tree[dad].props["common_name_long"] = {}
-                for lang in LANG_LIST:
-                    tree[dad].props["common_name"][lang] = attr[dad].common_name[lang]
-                    tree[dad].props["common_name_long"][lang] = attr[dad].common_name_long[lang]
-                tree[dad].props["synonym"] = attr[dad].synonym
-                tree[dad].props["authority"] = attr[dad].authority
-            if son not in tree:
-                tree[son] = Tree()
-                tree[son].props["name"] = son
-                tree[son].props["taxid"] = son
-                tree[son].props["sci_name"] = attr[son].sci_name
-                tree[son].props["common_name"] = {}
-                tree[son].props["common_name_long"] = {}
-                tree[son].props["rank"] = {}
-                tree[son].props["rank"]["en"] = rank_en
-                tree[son].props["rank"]["fr"] = rank_fr
-                for lang in LANG_LIST:
-                    tree[son].props["common_name"][lang] = attr[son].common_name[lang]
-                    tree[son].props["common_name_long"][lang] = attr[son].common_name_long[lang]
-                tree[son].props["synonym"] = attr[son].synonym
-                tree[son].props["authority"] = attr[son].authority
-            else:
-                if "rank" not in tree[son].props:
-                    tree[son].props["rank"] = {}
-                    tree[son].props["rank"]["en"] = rank_en
-                    tree[son].props["rank"]["fr"] = rank_fr
-            tree[dad].add_child(tree[son])
+    # Ranks are interned in order of first appearance
+    rank_names = taxonomy.get_column("rank").unique(maintain_order=True)
+    rank_codes = taxonomy.get_column("rank").replace_strict(
+        rank_names, pl.int_range(len(rank_names), eager=True), return_dtype=pl.Int16
+    )
+    rank_table = pl.DataFrame(
+        {
+            "en": [rank.replace("'", "''") for rank in rank_names],
+            "fr": [
+                ranks_translations[rank]["fr"].replace("'", "''") for rank in rank_names
+            ],
+        }
+    )
+
+    tree = TaxoTree.from_parents(
+        taxid=taxonomy.get_column("taxid").to_numpy(),
+        parent_taxid=taxonomy.get_column("parent").to_numpy(),
+        rank=rank_codes.to_numpy(),
+        rank_table=rank_table,
+        names=taxonomy.select(NAME_COLUMNS),
+    )
+
+    logger.info("Counting leaves...")
+    tree.leaf_counts()
+
     return tree
+
+
+def getTheTrees() -> TaxoTree:
+    return tree_from_taxonomy(load_taxonomy())
@@ -0,0 +1,322 @@
+"""
+Incremental update of the postgis build tables.
+
+The tree of the previous build is rebuilt from its taxonomy snapshot and
+compared with the new one, group by group. Records ids are derived from
+taxids, so records of unchanged nodes are kept as they are.
+
+The layout of the children of a node only depends on the layout of the node
+and on the ordered leaf counts of the children, their sibling weights. A
+subtree is moved, and its records are written again, if the sibling weights
+of one of its ancestors changed. As leaf counts are summed up to the group
+root, adding or removing a leaf moves the whole group, and only groups whose
+leaves don't change are updated in place. Other changes, such as renames
+and rank changes, only rewrite the records of the nodes concerned.
+"""
+
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+
+import db
+import numpy as np
+from config import BUILD_DIRECTORY, TAXO_DIRECTORY
+from getTrees import current_snapshot_key, find_snapshot, tree_from_taxonomy
+from taxotree import NAME_COLUMNS, TaxoTree
+from Traverse import (
+    BRANCH,
+    CLADECENTER,
+    GROUP_ROOTS,
+    POINT,
+    POLYGON,
+    RANK,
+    Layout,
+    group_layout,
+    insert_luca_branch,
+    record_ids,
+    simplify_tree,
+    write_features,
+    write_records,
+)
+
+logger = logging.getLogger("LifemapBuilder")
+
+BUILD_STATE_FILE = BUILD_DIRECTORY / "build_state.json"
+
+# Above this share of changed nodes, a full rebuild is done instead
+MAX_CHANGED_FRACTION = 0.3
+
+
+def _ranks_checksum() -> str:
+    with open(TAXO_DIRECTORY / "ranks.csv", "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def save_build_state(simplify: bool) -> None:
+    """
+    Record which taxonomy snapshot the build tables were generated from.
+    """
+    state = {
+        "snapshot": current_snapshot_key(),
+        "simplify": simplify,
+        "ranks": _ranks_checksum(),
+    }
+    with open(BUILD_STATE_FILE, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def clear_build_state() -> None:
+    """
+    Forget the build state before the build tables are modified, so that
+    tables left incomplete by a failed build are never updated incrementally.
+    """
+    BUILD_STATE_FILE.unlink(missing_ok=True)
+
+
+def load_previous_tree(simplify: bool) -> TaxoTree | None:
+    """
+    Rebuild the tree of the previous build, if its taxonomy snapshot is
+    still available and it was built with the same options.
+    """
+    if not BUILD_STATE_FILE.exists():
+        logger.info("  No previous build state")
+        return None
+    with open(BUILD_STATE_FILE) as f:
+        state = json.load(f)
+    if state["simplify"] != simplify or state["ranks"] != _ranks_checksum():
+        logger.info("  Previous build used other options or rank translations")
+        return None
+    taxonomy = find_snapshot(state["snapshot"])
+    if taxonomy is None:
+        logger.info("  Taxonomy snapshot of previous build not found")
+        return None
+    tree = tree_from_taxonomy(taxonomy)
+    return simplify_tree(tree) if simplify else tree
+
+
+@dataclass
+class GroupDiff:
+    groupnb: str
+    t: TaxoTree
+    lay: Layout
+    # Indexes of the new nodes whose records must be written
+    dirty: np.ndarray
+    # Ids of the previous records to delete
+    stale_ids: np.ndarray
+    # If the branch from LUCA must be written again
+    luca_changed: bool
+
+
+def _sibling_positions(t: TaxoTree) -> np.ndarray:
+    """
+    Position of each node among the children of its parent, 0 for the root.
+    """
+    position = np.zeros(t.n_nodes, dtype=np.int64)
+    position[t.children] = np.arange(len(t.children)) - np.repeat(
+        t.child_offsets[:-1], t.n_children
+    )
+    return position
+
+
+def moved_nodes(old_t: TaxoTree, t: TaxoTree, old_index: np.ndarray) -> np.ndarray:
+    """
+    Nodes of a group whose layout changed.
+
+    A node keeps its layout if its parent keeps its own, if it has the same
+    parent and position among its siblings as in the previous tree, and if
+    the children of its parent have the same leaf counts, in the same order.
+
+    Parameters
+    ----------
+    old_t, t : TaxoTree
+        Previous and new trees of the group.
+    old_index : np.ndarray
+        Index in `old_t` of each node of `t`, -1 for new nodes.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the nodes of `t` which moved.
+    """
+    nbdesc, old_nbdesc = t.leaf_counts(), old_t.leaf_counts()
+    position, old_position = _sibling_positions(t), _sibling_positions(old_t)
+    child = np.flatnonzero(t.parent >= 0)
+    up = t.parent[child]
+    old_child, old_up = old_index[child], old_index[up]
+
+    # Nodes whose children sibling weights changed
+    matched = old_index >= 0
+    reweighted = ~matched
+    reweighted[matched] |= old_t.n_children[old_index[matched]] != t.n_children[matched]
+    comparable = np.flatnonzero(~reweighted[up])
+    old_sibling = old_t.children[
+        old_t.child_offsets[old_up[comparable]] + position[child[comparable]]
+    ]
+    differs = old_nbdesc[old_sibling] != nbdesc[child[comparable]]
+    reweighted |= np.bincount(up[comparable[differs]], minlength=t.n_nodes) > 0
+
+    # Nodes which were elsewhere in the previous tree
+    displaced = np.zeros(t.n_nodes, dtype=bool)
+    displaced[child] = (
+        (old_child < 0)
+        | (old_t.parent[old_child] != old_up)
+        | (old_position[old_child] != position[child])
+    )
+
+    moved = np.zeros(t.n_nodes, dtype=bool)
+    for level in t.levels()[1:]:
+        parent = t.parent[level]
+        moved[level] = moved[parent] | reweighted[parent] | displaced[level]
+    return moved
+
+
+def _record_ids(t: TaxoTree, nodes: np.ndarray) -> np.ndarray:
+    """
+    Ids of all the records of a set of nodes.
+    """
+    taxid = t.taxid[nodes]
+    return np.concatenate(
+        [
+            record_ids(taxid, slot)
+            for slot in (POINT, BRANCH, POLYGON, CLADECENTER, RANK)
+        ]
+    )
+
+
+def diff_group(old_tree: TaxoTree, tree: TaxoTree, groupnb: str) -> GroupDiff:
+    """
+    Compare a group of the previous and new trees.
+
+    A node is dirty, and its records are rewritten, if it is new, if it
+    moved, if its rank, names or leaf count changed or if it became a leaf
+    or a clade, or if its parent changed, as its branch is labelled with the
+    names of its parent. Records of removed nodes are deleted.
+
+    Parameters
+    ----------
+    old_tree, tree : TaxoTree
+        Previous and new global trees.
+    groupnb : str
+        Group number.
+
+    Returns
+    -------
+    GroupDiff
+        Group changes.
+    """
+    old_t = old_tree.subtree(GROUP_ROOTS[groupnb])
+    t, lay = group_layout(tree, groupnb)
+
+    lookup = np.full(
+        max(int(old_t.taxid.max()), int(t.taxid.max())) + 1, -1, dtype=np.int64
+    )
+    lookup[old_t.taxid] = np.arange(old_t.n_nodes)
+    old_index = lookup[t.taxid]
+    matched = np.flatnonzero(old_index >= 0)
+    old_matched = old_index[matched]
+
+    changed = moved_nodes(old_t, t, old_index)
+    changed[old_index < 0] = True
+    same = t.leaf_counts()[matched] == old_t.leaf_counts()[old_matched]
+    same &= t.is_leaf[matched] == old_t.is_leaf[old_matched]
+    for lang in ("en", "fr"):
+        same &= t.rank_names(lang)[matched] == old_t.rank_names(lang)[old_matched]
+    names = t.names[matched]
+    old_names = old_t.names[old_matched]
+    for col in NAME_COLUMNS:
+        same &= (names.get_column(col) == old_names.get_column(col)).to_numpy()
+    changed[matched] |= ~same
+
+    dirty = changed.copy()
+    dirty[1:] |= changed[t.parent[1:]]
+    dirty = np.flatnonzero(dirty)
+
+    # Records of removed nodes and previous records of dirty nodes
+    old_stale = np.ones(old_t.n_nodes, dtype=bool)
+    old_stale[old_matched] = False
+    old_dirty = old_index[dirty]
+    old_stale[old_dirty[old_dirty >= 0]] = True
+    stale_ids = _record_ids(old_t, np.flatnonzero(old_stale))
+
+    return GroupDiff(
+        groupnb=groupnb,
+        t=t,
+        lay=lay,
+        dirty=dirty,
+        stale_ids=stale_ids,
+        # The branch from LUCA uses the branch id of the root
+        luca_changed=bool(old_stale[old_t.root]),
+    )
+
+
+def update_tables(
+    tree: TaxoTree, simplify: bool, disable_progress: bool = False
+) -> bool:
+    """
+    Update the postgis build tables of the previous build to the new tree.
+
+    Parameters
+    ----------
+    tree : TaxoTree
+        New global tree.
+    simplify : bool
+        If the tree was simplified.
+    disable_progress : bool
+        If True, disable progress bars
+
+    Returns
+    -------
+    bool
+        False, without any change to the tables, if a full rebuild is needed
+        because the previous build is not usable or too many nodes changed.
+    """
+    logger.info("---- Comparing with previous build...")
+    if not db.previous_tables_exist():
+        logger.info("  Tables of previous build not found")
+        return False
+    old_tree = load_previous_tree(simplify)
+    if old_tree is None:
+        return False
+
+    diffs = [diff_group(old_tree, tree, g) for g in GROUP_ROOTS]
+
+    n_dirty = sum(len(diff.dirty) for diff in diffs)
+    n_nodes = sum(diff.t.n_nodes for diff in diffs)
+    for diff in diffs:
+        logger.info(
+            f"  Group {diff.groupnb}: {len(diff.dirty)} of {diff.t.n_nodes} nodes changed"
+        )
+    if n_dirty > MAX_CHANGED_FRACTION * n_nodes:
+        logger.info(f"  {n_dirty} changed nodes out of {n_nodes}, doing a full rebuild")
+        return False
+
+    # Kept records are copied once, and changed ones are written after them
+    stale_ids = np.concatenate([diff.stale_ids for diff in diffs])
+    logger.info(
+        f"---- Restoring build tables without {len(stale_ids)} changed records..."
+    )
+    clear_build_state()
+    db.restore_build_tables(stale_ids.tolist())
+
+    for diff in diffs:
+        if (
+            len(diff.dirty) == 0
+            and (BUILD_DIRECTORY / f"TreeFeatures{diff.groupnb}.parquet").exists()
+        ):
+            continue
+        logger.info(f"---- Updating tree {diff.groupnb}...")
+        write_records(
+            diff.t,
+            diff.lay,
+            diff.groupnb,
+            nodes=diff.dirty,
+            disable_progress=disable_progress,
+        )
+        if diff.luca_changed:
+            insert_luca_branch(diff.t, diff.groupnb, diff.lay)
+        write_features(
+            diff.t, diff.lay, diff.groupnb, disable_progress=disable_progress
+        )
+
+    return True
@@ -0,0 +1,261 @@
+"""
+Performance metrics of the build stages.
+
+The metrics of each stage run by the pipeline are written to METRICS_FILE,
+next to metadata.json: wall time, CPU time of the process and of its
+children, peak resident memory of the main process, rows processed and
+bytes written. Steps of a stage, such as the COPY of each table in the
+traversal, are recorded with the same metrics under the stage. Steps
+recorded in worker processes, such as the traversal of each group in
+parallel, have the peak resident memory of their worker.
+
+The metrics of the previous build are kept in PREVIOUS_METRICS_FILE, and
+the stages and steps which got slower than in the previous build by more
+than a threshold are flagged.
+"""
+
+import json
+import logging
+import resource
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from config import BUILD_DIRECTORY
+
+logger = logging.getLogger("LifemapBuilder")
+
+METRICS_FILE = BUILD_DIRECTORY / "build_metrics.json"
+PREVIOUS_METRICS_FILE = BUILD_DIRECTORY / "build_metrics.previous.json"
+
+# Relative increase of wall time above which a stage is flagged as slower
+SLOWDOWN_THRESHOLD = 0.2
+
+# Stages and steps shorter than this in seconds are not compared, their
+# times being mostly noise
+MIN_COMPARED_TIME = 1.0
+
+
+def cpu_time() -> float:
+    """
+    User and system CPU time of the process and of its terminated children, in seconds.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of the process, in MB.
+
+    It is read from /proc (Linux), where it can be reset, and is the peak
+    since the start of the process otherwise.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> None:
+    """
+    Reset the peak resident memory of the process to its current memory, if possible.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class Measure:
+    """
+    Wall time and CPU time of the process since the creation of the measure.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = cpu_time()
+
+    def values(self, rows: int | None = None, bytes_written: int | None = None) -> dict:
+        wall_time = time.perf_counter() - self.start
+        return {
+            "wall_time_s": round(wall_time, 3),
+            "cpu_time_s": round(cpu_time() - self.start_cpu, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "rows": rows,
+            "rows_per_s": round(rows / wall_time) if rows and wall_time > 0 else None,
+            "bytes_written": bytes_written,
+        }
+
+
+class _StageCounts:
+    def __init__(self):
+        self.rows: int | None = None
+        self.bytes_written = 0
+
+
+# Counts of the stage being measured, and steps recorded in this process
+_current: _StageCounts | None = None
+_steps: dict[str, dict] = {}
+
+
+def add(rows: int = 0, bytes_written: int = 0) -> None:
+    """
+    Add rows processed and bytes written to the stage being measured, if any.
+    """
+    if _current is None:
+        return
+    _current.rows = (_current.rows or 0) + rows
+    _current.bytes_written += bytes_written
+
+
+def record(name: str, values: dict) -> None:
+    """
+    Record the metrics of a step of the current stage.
+    """
+    _steps[name] = values
+
+
+def take_steps() -> dict[str, dict]:
+    """
+    Remove and return the steps recorded in this process, so that worker
+    processes can send them to the main one, which records them with
+    `merge_steps`.
+    """
+    steps = dict(_steps)
+    _steps.clear()
+    return steps
+
+
+def merge_steps(steps: dict[str, dict]) -> None:
+    _steps.update(steps)
+
+
+@contextmanager
+def measure(outputs: list[Path]) -> Generator[dict]:
+    """
+    Measure a stage, whose metrics are set in the yielded dictionary when
+    it ends, even if it fails.
+
+    Bytes written are the size of the outputs of the stage, plus the bytes
+    added with `add`, such as database tables.
+    """
+    global _current
+    reset_peak_rss()
+    take_steps()
+    _current = _StageCounts()
+    measured = Measure()
+    metrics = {}
+    try:
+        yield metrics
+    finally:
+        size = sum(path.stat().st_size for path in outputs if path.is_file())
+        metrics.update(measured.values(_current.rows, _current.bytes_written + size))
+        steps = take_steps()
+        if steps:
+            metrics["steps"] = steps
+        _current = None
+
+
+def slowdowns(
+    previous: dict, current: dict, threshold: float = SLOWDOWN_THRESHOLD
+) -> list[dict]:
+    """
+    Stages and steps whose wall time increased by more than `threshold`.
+
+    Parameters
+    ----------
+    previous, current : dict
+        Contents of two metrics files.
+    threshold : float
+        Relative increase of wall time, 0.2 for 20% slower.
+
+    Returns
+    -------
+    list[dict]
+        Name, previous and current wall times of each slower stage or step,
+        steps being named {stage}/{step}.
+    """
+
+    def flatten(report: dict) -> dict[str, float]:
+        times = {}
+        for name, stage in report.get("stages", {}).items():
+            if stage.get("status") != "done":
+                continue
+            times[name] = stage["wall_time_s"]
+            for step, values in stage.get("steps", {}).items():
+                times[f"{name}/{step}"] = values["wall_time_s"]
+        return times
+
+    before, after = flatten(previous), flatten(current)
+    return [
+        {"name": name, "previous": before[name], "current": wall_time}
+        for name, wall_time in after.items()
+        if name in before
+        and before[name] > 0
+        and max(before[name], wall_time) >= MIN_COMPARED_TIME
+        and wall_time > before[name] * (1 + threshold)
+    ]
+
+
+class BuildMetrics:
+    """
+    Metrics of the stages of a build, written to METRICS_FILE.
+    """
+
+    def __init__(self, threshold: float = SLOWDOWN_THRESHOLD):
+        self.threshold = threshold
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.stages: dict[str, dict] = {}
+
+    def skipped(self, name: str) -> None:
+        self.stages[name] = {"status": "skipped"}
+
+    @contextmanager
+    def stage(self, name: str, outputs: list[Path]) -> Generator[None]:
+        entry = self.stages[name] = {"status": "failed"}
+        metrics = {}
+        try:
+            with measure(outputs) as metrics:
+                yield
+                entry["status"] = "done"
+        finally:
+            entry.update(metrics)
+
+    def write(self) -> None:
+        """
+        Write the metrics, keeping the previous ones, and log the stages
+        which got slower.
+        """
+        report = {
+            "started": self.started,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "slowdown_threshold": self.threshold,
+            "stages": self.stages,
+        }
+        previous = None
+        if METRICS_FILE.exists():
+            with open(METRICS_FILE) as f:
+                previous = json.load(f)
+            METRICS_FILE.replace(PREVIOUS_METRICS_FILE)
+        report["slowdowns"] = (
+            [] if previous is None else slowdowns(previous, report, self.threshold)
+        )
+        with open(METRICS_FILE, "w") as f:
+            json.dump(report, f, indent=2)
+
+        for slowdown in report["slowdowns"]:
+            logger.warning(
+                f"  {slowdown['name']} took {slowdown['current']:.1f}s instead of "
+                f"{slowdown['previous']:.1f}s in the previous build "
+                f"(+{slowdown['current'] / slowdown['previous'] - 1:.0%})"
+            )
+        logger.info(f"  Build metrics written to {METRICS_FILE}")
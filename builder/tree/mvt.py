@@ -0,0 +1,253 @@
+"""
+Mapbox Vector Tiles encoding.
+
+Only what Lifemap tiles need is implemented: points, linestrings and single
+ring polygons, with string, number and boolean properties. Geometries are
+given in tile coordinates, already quantized to the tile extent. See
+https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+"""
+
+import struct
+
+import numpy as np
+
+EXTENT = 4096
+
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+GEOM_POLYGON = 3
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_CLOSE_PATH = 7
+
+
+def _varint(value: int) -> bytes:
+    if value < len(_SMALL_VARINTS):
+        return _SMALL_VARINTS[value]
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+_SMALL_VARINTS = [bytes([value]) for value in range(0x80)] + [
+    bytes([(value & 0x7F) | 0x80, value >> 7]) for value in range(0x80, 0x4000)
+]
+
+
+def varints(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode an array of non negative integers as varints.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Concatenated varints bytes, as uint8, and number of bytes of each value.
+    """
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += values >= np.uint64(1 << (7 * k))
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    for k in range(int(lengths.max(initial=0))):
+        selected = lengths > k
+        byte = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        byte |= np.where(lengths[selected] > k + 1, np.uint64(0x80), np.uint64(0))
+        out[starts[selected] + k] = byte
+    return out, lengths
+
+
+def _split(data: np.ndarray, lengths: np.ndarray, counts: np.ndarray) -> list[bytes]:
+    """
+    Split varints, as returned by `varints`, in groups of `counts` values.
+    """
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    ends = offsets[np.cumsum(counts)]
+    starts = offsets[np.cumsum(counts) - counts]
+    buffer = data.tobytes()
+    return [buffer[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def _field(number: int, wire_type: int) -> bytes:
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes_field(number: int, data: bytes) -> bytes:
+    return _field(number, 2) + _varint(len(data)) + data
+
+
+def _encode_value(value: str | float) -> bytes:
+    if isinstance(value, str):
+        return _bytes_field(1, value.encode())
+    # bool must be tested before int, of which it is a subclass
+    if isinstance(value, bool):
+        return _field(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        return _field(4, 0) + _varint(value & 0xFFFFFFFFFFFFFFFF)
+    return _field(2, 5) + struct.pack("<f", value)
+
+
+def _command(command: int, count: int) -> int:
+    return (command & 0x7) | (count << 3)
+
+
+def encode_geometries(geom_type: int, coords: np.ndarray) -> list[bytes | None]:
+    """
+    Encode geometries with the same number of points as MVT commands.
+
+    All geometries are encoded at once, as encoding each geometry separately
+    is dominated by the overhead of numpy calls on a few points.
+
+    Parameters
+    ----------
+    geom_type : int
+        GEOM_POINT, GEOM_LINESTRING or GEOM_POLYGON.
+    coords : np.ndarray
+        Integer tile coordinates, (n_geometries, n_points, 2). Polygon rings
+        may be closed or not, and are reoriented as exterior rings.
+
+    Returns
+    -------
+    list[bytes | None]
+        Packed commands of each geometry, or None if the geometry is
+        degenerate once quantized.
+    """
+    coords = coords.astype(np.int64)
+    if geom_type == GEOM_POINT:
+        coords = coords[:, :1]
+    if geom_type == GEOM_POLYGON:
+        # Exterior rings have a positive area in tile coordinates, y going
+        # down. Repeated points don't change the area.
+        x, y = coords[..., 0], coords[..., 1]
+        area = np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)
+        coords = np.where((area < 0)[:, None, None], coords[:, ::-1], coords)
+
+    # Drop repeated points, and the closing point of rings
+    keep = np.ones(coords.shape[:2], dtype=bool)
+    keep[:, 1:] = np.any(coords[:, 1:] != coords[:, :-1], axis=2)
+    if geom_type == GEOM_POLYGON:
+        first = np.argmax(keep[:, ::-1], axis=1)
+        last = coords.shape[1] - 1 - first
+        closing = np.all(coords[np.arange(len(coords)), last] == coords[:, 0], axis=1)
+        keep[np.flatnonzero(closing & (last > 0)), last[closing & (last > 0)]] = False
+    n_points = keep.sum(axis=1)
+    min_points = {GEOM_POINT: 1, GEOM_LINESTRING: 2, GEOM_POLYGON: 3}[geom_type]
+    valid = n_points >= min_points
+    if geom_type == GEOM_POLYGON:
+        valid &= area != 0
+    keep &= valid[:, None]
+    n_points = n_points[valid]
+
+    # Parameters of the commands: zigzag encoded deltas between points
+    points = coords[keep]
+    deltas = np.diff(points, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    feature_starts = np.cumsum(n_points) - n_points
+    deltas[feature_starts] = points[feature_starts]
+    params = ((deltas << 1) ^ (deltas >> 63)).ravel()
+
+    # Commands of each geometry: MoveTo, first point, LineTo, other points
+    # and ClosePath
+    is_line = int(geom_type != GEOM_POINT)
+    n_commands = 2 * n_points + 1 + is_line + int(geom_type == GEOM_POLYGON)
+    command_starts = np.cumsum(n_commands) - n_commands
+    param_feature = np.repeat(np.arange(len(n_points)), 2 * n_points)
+    param_index = np.arange(len(params)) - 2 * feature_starts[param_feature]
+    commands = np.empty(int(n_commands.sum()), dtype=np.int64)
+    commands[command_starts] = _command(CMD_MOVE_TO, 1)
+    commands[
+        command_starts[param_feature] + 1 + param_index + is_line * (param_index >= 2)
+    ] = params
+    if is_line:
+        commands[command_starts + 3] = _command(CMD_LINE_TO, 1) + ((n_points - 2) << 3)
+    if geom_type == GEOM_POLYGON:
+        commands[command_starts + n_commands - 1] = _command(CMD_CLOSE_PATH, 1)
+
+    geometries: list[bytes | None] = [None] * len(valid)
+    for k, geometry in zip(
+        np.flatnonzero(valid).tolist(), _split(*varints(commands), n_commands)
+    ):
+        geometries[k] = geometry
+    return geometries
+
+
+class LayerEncoder:
+    """
+    Encoder of a tile layer, collecting features and their properties.
+    """
+
+    def __init__(self, name: str, extent: int = EXTENT):
+        self.name = name
+        self.extent = extent
+        self.keys: dict[str, int] = {}
+        self.values: dict[tuple[type, str | float], int] = {}
+        self.features: list[bytes] = []
+
+    def add_features(
+        self,
+        ids: np.ndarray,
+        geom_type: int,
+        geometries: list[bytes | None],
+        properties: dict[str, np.ndarray],
+    ) -> None:
+        """
+        Add features, with their geometries as given by `encode_geometries`.
+        Features without geometry are skipped.
+
+        Parameters
+        ----------
+        ids : np.ndarray
+            Features ids.
+        geom_type : int
+            GEOM_POINT, GEOM_LINESTRING or GEOM_POLYGON.
+        geometries : list[bytes | None]
+            Encoded geometries.
+        properties : dict[str, np.ndarray]
+            Values of each property. NaN values are null, and not encoded.
+        """
+        kept = np.array([geometry is not None for geometry in geometries], dtype=bool)
+        n = int(kept.sum())
+        # Key and value indexes of each feature, -1 for null values
+        tags = np.full((n, 2 * len(properties)), -1, dtype=np.int64)
+        for k, (key, values) in enumerate(properties.items()):
+            values = np.asarray(values)[kept]
+            present = (
+                ~np.isnan(values)
+                if values.dtype.kind == "f"
+                else np.ones(n, dtype=bool)
+            )
+            unique, inverse = np.unique(values[present], return_inverse=True)
+            indexes = [
+                self.values.setdefault((type(v), v), len(self.values))
+                for v in unique.tolist()
+            ]
+            tags[present, 2 * k] = self.keys.setdefault(key, len(self.keys))
+            tags[present, 2 * k + 1] = np.array(indexes, dtype=np.int64)[inverse]
+        present = tags >= 0
+        data, lengths = varints(tags[present])
+        encoded_tags = _split(data, lengths, present.sum(axis=1))
+
+        geom_type_field = _field(3, 0) + _varint(geom_type)
+        for fid, feature_tags, geometry in zip(
+            ids[kept].tolist(), encoded_tags, (g for g in geometries if g is not None)
+        ):
+            self.features.append(
+                _field(1, 0)
+                + _varint(fid)
+                + _bytes_field(2, feature_tags)
+                + geom_type_field
+                + _bytes_field(4, geometry)
+            )
+
+    def encode(self) -> bytes:
+        layer = _field(15, 0) + _varint(2) + _bytes_field(1, self.name.encode())
+        layer += b"".join(_bytes_field(2, feature) for feature in self.features)
+        layer += b"".join(_bytes_field(3, key.encode()) for key in self.keys)
+        layer += b"".join(
+            _bytes_field(4, _encode_value(value)) for _, value in self.values
+        )
+        layer += _field(5, 0) + _varint(self.extent)
+        return _bytes_field(3, layer)
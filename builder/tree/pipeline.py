@@ -0,0 +1,194 @@
+"""
+Build stages, and their checkpoints in the build manifest.
+
+Each stage declares the files it reads and writes, the modules whose code
+it runs, its parameters, and the stages whose results it uses without
+reading them from files, such as database tables. Its key is a hash of the
+content of its input files, of the source of its modules, of its
+parameters and of the last runs of these stages, so that a stage is run
+again after any of them.
+
+The key and status of each stage are recorded in MANIFEST_FILE once it is
+completed or has failed. A rerun skips the stages whose key didn't change
+and whose outputs still exist, and so resumes from the first stage that is
+invalid or failed. The performance of the stages run is written to the
+build metrics.
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+import time
+import uuid
+from collections.abc import Callable
+from collections.abc import Set as AbstractSet
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from types import ModuleType
+
+import metrics
+from config import BUILD_DIRECTORY
+
+logger = logging.getLogger("LifemapBuilder")
+
+MANIFEST_FILE = BUILD_DIRECTORY / "build_manifest.json"
+
+# Changing this version invalidates all the stages of previous builds
+MANIFEST_VERSION = 1
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[], None]
+    inputs: list[Path] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+    modules: list[ModuleType] = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    # Stages whose results are used without being read from inputs
+    after: list[str] = field(default_factory=list)
+    # Stages checking remote sources, such as downloads, are always run
+    cached: bool = True
+
+
+def load_manifest() -> dict:
+    if not MANIFEST_FILE.exists():
+        return {}
+    with open(MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    return manifest["stages"] if manifest.get("version") == MANIFEST_VERSION else {}
+
+
+def save_manifest(stages: dict) -> None:
+    # The manifest is replaced at once, so that an interrupted write never
+    # leaves a partial one
+    tmp_file = MANIFEST_FILE.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "stages": stages}, f, indent=2)
+    tmp_file.replace(MANIFEST_FILE)
+
+
+def invalidate(names: list[str]) -> None:
+    """
+    Remove stages from the manifest, so that the next build runs them again.
+    """
+    stages = load_manifest()
+    for name in names:
+        stages.pop(name, None)
+    save_manifest(stages)
+
+
+class FileHashes:
+    """
+    SHA-256 of files, computed once per content: the hash of a file is
+    reused while its size and modification time don't change.
+    """
+
+    def __init__(self):
+        self.hashes: dict[tuple[str, int, int], str] = {}
+
+    def __call__(self, path: Path) -> str | None:
+        if not path.is_file():
+            return None
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            with open(path, "rb") as f:
+                self.hashes[key] = hashlib.file_digest(f, "sha256").hexdigest()
+        return self.hashes[key]
+
+
+def stage_key(stage: Stage, file_hash: FileHashes, manifest: dict) -> str:
+    """
+    Hash of the inputs, code, parameters and previous stages of a stage.
+    """
+    content = {
+        "inputs": {str(path): file_hash(path) for path in stage.inputs},
+        "code": {
+            module.__name__: file_hash(Path(inspect.getfile(module)))
+            for module in stage.modules
+        },
+        "params": stage.params,
+        "after": {name: manifest.get(name, {}).get("run") for name in stage.after},
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def run_stages(
+    stages: list[Stage],
+    skip: AbstractSet[str] = frozenset(),
+    rerun: AbstractSet[str] = frozenset(),
+    slowdown_threshold: float = metrics.SLOWDOWN_THRESHOLD,
+) -> None:
+    """
+    Run the stages in order, skipping those which are up to date, and write
+    their metrics.
+
+    Parameters
+    ----------
+    stages : list[Stage]
+        Stages of the build, in execution order.
+    skip : AbstractSet[str]
+        Stages not to run, whose manifest entries are kept.
+    rerun : AbstractSet[str]
+        Stages run even if they are up to date.
+    slowdown_threshold : float
+        Relative increase of wall time above which a stage is flagged as
+        slower than in the previous build.
+    """
+    build_metrics = metrics.BuildMetrics(slowdown_threshold)
+    try:
+        _run_stages(stages, skip, rerun, build_metrics)
+    finally:
+        build_metrics.write()
+
+
+def _run_stages(
+    stages: list[Stage],
+    skip: AbstractSet[str],
+    rerun: AbstractSet[str],
+    build_metrics: metrics.BuildMetrics,
+) -> None:
+    manifest = load_manifest()
+    file_hash = FileHashes()
+    for stage in stages:
+        if stage.name in skip:
+            logger.info(f"--- Skipping {stage.name} as requested ---")
+            build_metrics.skipped(stage.name)
+            continue
+        key = stage_key(stage, file_hash, manifest)
+        previous = manifest.get(stage.name, {})
+        if (
+            stage.cached
+            and stage.name not in rerun
+            and previous.get("status") == "done"
+            and previous.get("key") == key
+            and all(path.exists() for path in stage.outputs)
+        ):
+            logger.info(f"--- Stage {stage.name} is up to date, skipped ---")
+            build_metrics.skipped(stage.name)
+            continue
+
+        logger.info(f"-- Stage {stage.name}...")
+        start = time.perf_counter()
+        try:
+            with build_metrics.stage(stage.name, stage.outputs):
+                stage.run()
+        except BaseException as e:
+            manifest[stage.name] = {"key": key, "status": "failed", "error": repr(e)}
+            save_manifest(manifest)
+            raise
+        elapsed = time.perf_counter() - start
+        manifest[stage.name] = {
+            "key": key,
+            "status": "done",
+            "run": uuid.uuid4().hex,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "duration": round(elapsed, 1),
+        }
+        save_manifest(manifest)
+        logger.info(f"-- Done in {elapsed:.1f}s")
@@ -0,0 +1,231 @@
+"""
+PMTiles v3 archive writer.
+
+Tiles can be added in any order. Their data is appended to a temporary file,
+deduplicated by content, and copied in tile id order when the archive is
+finalized, so that the archive is clustered. See
+https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Self
+
+HEADER_SIZE = 127
+# Header and root directory must fit in the first 16 KiB
+ROOT_DIRECTORY_SIZE = 16384 - HEADER_SIZE
+COMPRESSION_GZIP = 2
+TILE_TYPE_MVT = 1
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    """
+    PMTiles tile id: tiles of lower zooms come first, then tiles of a zoom
+    along a Hilbert curve.
+    """
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    s = (1 << z) // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        x &= s - 1
+        y &= s - 1
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _compress(data: bytes) -> bytes:
+    return gzip.compress(data, mtime=0)
+
+
+def serialize_directory(entries: list[tuple[int, int, int, int]]) -> bytes:
+    """
+    Serialize and compress directory entries, given as sorted
+    (tile_id, offset, length, run_length) tuples.
+    """
+    data = bytearray(_varint(len(entries)))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        data += _varint(tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        data += _varint(run_length)
+    for _, _, length, _ in entries:
+        data += _varint(length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        # Offsets contiguous to the previous entry are written as 0
+        _, previous_offset, previous_length, _ = entries[i - 1]
+        contiguous = i > 0 and offset == previous_offset + previous_length
+        data += _varint(0 if contiguous else offset + 1)
+    return _compress(bytes(data))
+
+
+def build_directories(
+    entries: list[tuple[int, int, int, int]],
+) -> tuple[bytes, bytes, int]:
+    """
+    Build the root directory, and leaf directories if all entries don't fit
+    in the root directory.
+
+    Returns
+    -------
+    tuple[bytes, bytes, int]
+        Root directory, leaf directories and number of leaf directories.
+    """
+    root = serialize_directory(entries)
+    if len(root) <= ROOT_DIRECTORY_SIZE:
+        return root, b"", 0
+    leaf_size = 4096
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[start : start + leaf_size])
+            root_entries.append((entries[start][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_DIRECTORY_SIZE:
+            return root, bytes(leaves), len(root_entries)
+        leaf_size *= 2
+
+
+class PMTilesWriter:
+    """
+    Write a PMTiles archive of gzipped MVT tiles.
+
+    The archive is written to a temporary file and moved to `path` when
+    finalized, so that a server reading the previous archive is not affected.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.tiles_path = path.with_name(path.name + ".tiles.tmp")
+        # Kept open until the archive is finalized or closed
+        self.tiles_file = open(self.tiles_path, "w+b")  # noqa: SIM115
+        # Location of each distinct tile content in the temporary tiles file
+        self.contents: dict[bytes, tuple[int, int]] = {}
+        self.tiles: list[tuple[int, int, int]] = []
+        self.size = 0
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.tiles_file.close()
+        self.tiles_path.unlink(missing_ok=True)
+        self.tmp_path.unlink(missing_ok=True)
+
+    def add_tile(self, z: int, x: int, y: int, data: bytes) -> None:
+        """
+        Add a tile, already gzipped.
+        """
+        digest = hashlib.sha256(data).digest()
+        if digest not in self.contents:
+            self.contents[digest] = (self.size, len(data))
+            self.tiles_file.write(data)
+            self.size += len(data)
+        offset, length = self.contents[digest]
+        self.tiles.append((zxy_to_tileid(z, x, y), offset, length))
+
+    def finalize(
+        self,
+        metadata: dict,
+        min_zoom: int,
+        max_zoom: int,
+        bounds: tuple[float, float, float, float],
+    ) -> None:
+        """
+        Write the archive.
+
+        Parameters
+        ----------
+        metadata : dict
+            JSON metadata, with the `vector_layers` of the tiles.
+        min_zoom, max_zoom : int
+            Zoom levels of the tiles.
+        bounds : tuple[float, float, float, float]
+            Bounds of the tiles data, as min lon, min lat, max lon, max lat.
+        """
+        self.tiles.sort()
+        # Lay out contents in the order of their first tile
+        placed: dict[int, int] = {}
+        layout = []
+        entries: list[tuple[int, int, int, int]] = []
+        data_length = 0
+        for tile_id, tmp_offset, length in self.tiles:
+            if tmp_offset not in placed:
+                placed[tmp_offset] = data_length
+                layout.append((tmp_offset, length))
+                data_length += length
+            offset = placed[tmp_offset]
+            if entries:
+                last_id, last_offset, last_length, run_length = entries[-1]
+                if tile_id == last_id + run_length and offset == last_offset:
+                    entries[-1] = (last_id, last_offset, last_length, run_length + 1)
+                    continue
+            entries.append((tile_id, offset, length, 1))
+
+        root, leaves, _ = build_directories(entries)
+        meta = _compress(json.dumps(metadata).encode())
+        root_offset = HEADER_SIZE
+        meta_offset = root_offset + len(root)
+        leaves_offset = meta_offset + len(meta)
+        data_offset = leaves_offset + len(leaves)
+        min_lon, min_lat, max_lon, max_lat = (round(v * 1e7) for v in bounds)
+        header = struct.pack(
+            "<7sB11Q6B4iB2i",
+            b"PMTiles",
+            3,
+            root_offset,
+            len(root),
+            meta_offset,
+            len(meta),
+            leaves_offset,
+            len(leaves),
+            data_offset,
+            data_length,
+            len(self.tiles),
+            len(entries),
+            len(layout),
+            1,  # clustered
+            COMPRESSION_GZIP,
+            COMPRESSION_GZIP,
+            TILE_TYPE_MVT,
+            min_zoom,
+            max_zoom,
+            min_lon,
+            min_lat,
+            max_lon,
+            max_lat,
+            min_zoom,
+            (min_lon + max_lon) // 2,
+            (min_lat + max_lat) // 2,
+        )
+
+        self.tiles_file.flush()
+        with open(self.tmp_path, "wb") as f:
+            f.write(header + root + meta + leaves)
+            for tmp_offset, length in layout:
+                self.tiles_file.seek(tmp_offset)
+                f.write(self.tiles_file.read(length))
+        os.replace(self.tmp_path, self.path)
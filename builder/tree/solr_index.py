@@ -0,0 +1,229 @@
+"""
+Loading of the build documents into the Solr cores.
+
+The documents of each live core are loaded into a build core, then the two
+cores are swapped, so that searches are served by the previous documents
+until loading is finished. The previous documents are kept in the build
+core for rollback.
+"""
+
+import logging
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import metrics
+import requests
+from config import BUILD_DIRECTORY, SOLR_PASSWD, SOLR_URL, SOLR_USER
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("LifemapBuilder")
+
+# Newline delimited JSON files of the documents of each live core
+CORES = {
+    "taxo": [f"TreeFeatures{i}.json" for i in range(1, 4)],
+    "addi": [f"ADDITIONAL.{i}.json" for i in range(1, 4)],
+}
+
+# Number of documents sent per update request
+BATCH_SIZE = 10_000
+
+# Timeout in seconds of each request
+TIMEOUT = 600
+
+
+def build_core(core: str) -> str:
+    return f"{core}_build"
+
+
+def solr_session(workers: int = 1) -> requests.Session:
+    """
+    HTTP session to the Solr server, with one pooled connection per worker.
+    """
+    session = requests.Session()
+    if SOLR_PASSWD is not None:
+        session.auth = (SOLR_USER, SOLR_PASSWD)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _core_admin(session: requests.Session, url: str, **params: str) -> dict:
+    response = session.get(
+        f"{url}/admin/cores", params={**params, "wt": "json"}, timeout=TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def _update(session: requests.Session, url: str, core: str, data: bytes) -> None:
+    response = session.post(
+        f"{url}/{core}/update",
+        data=data,
+        headers={"Content-Type": "application/json"},
+        timeout=TIMEOUT,
+    )
+    response.raise_for_status()
+
+
+def _post_batch(
+    session: requests.Session, url: str, core: str, data: bytes, n_docs: int
+) -> int:
+    _update(session, url, core, data)
+    return n_docs
+
+
+def count_documents(session: requests.Session, url: str, core: str) -> int:
+    response = session.get(
+        f"{url}/{core}/select",
+        params={"q": "*:*", "rows": 0, "wt": "json"},
+        timeout=TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json()["response"]["numFound"]
+
+
+def create_build_core(session: requests.Session, url: str, core: str) -> None:
+    """
+    Create the build core of a live core if it doesn't exist.
+
+    Its instance directory, named after the build core in the Solr home,
+    must already contain the configuration of the live core.
+    """
+    name = build_core(core)
+    if _core_admin(session, url, action="STATUS", core=name)["status"].get(name):
+        return
+    logger.info(f"  Creating core {name}...")
+    _core_admin(session, url, action="CREATE", name=name, instanceDir=name)
+
+
+def iter_batches(
+    paths: list[Path], batch_size: int = BATCH_SIZE
+) -> Iterator[tuple[bytes, int]]:
+    """
+    Read newline delimited JSON documents by batches.
+
+    Yields
+    ------
+    tuple[bytes, int]
+        JSON array of the documents of a batch, and their number.
+    """
+    batch = []
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                batch.append(line)
+                if len(batch) == batch_size:
+                    yield b"[" + b",".join(batch) + b"]", len(batch)
+                    batch = []
+    if batch:
+        yield b"[" + b",".join(batch) + b"]", len(batch)
+
+
+def load_core(
+    session: requests.Session,
+    url: str,
+    core: str,
+    paths: list[Path],
+    batch_size: int = BATCH_SIZE,
+    workers: int = 1,
+) -> int:
+    """
+    Replace the documents of a core by the documents of newline delimited
+    JSON files, and commit them.
+
+    Batches are read while up to `workers` of them are being sent, and at
+    most `workers` others are held in memory.
+
+    Returns
+    -------
+    int
+        Number of documents loaded.
+    """
+    _update(session, url, core, b'{"delete": {"query": "*:*"}}')
+    n_docs = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        pending = set()
+        for data, n in iter_batches(paths, batch_size):
+            if len(pending) >= 2 * max(workers, 1):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                n_docs += sum(future.result() for future in done)
+            pending.add(pool.submit(_post_batch, session, url, core, data, n))
+        n_docs += sum(future.result() for future in pending)
+    _update(session, url, core, b'{"commit": {}}')
+    return n_docs
+
+
+def load_cores(
+    url: str = SOLR_URL,
+    directory: Path = BUILD_DIRECTORY,
+    batch_size: int = BATCH_SIZE,
+    workers: int = 1,
+) -> None:
+    """
+    Load the documents of each live core into its build core, and swap
+    them once all documents are committed.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the Solr server.
+    directory : Path
+        Directory of the documents files.
+    batch_size : int
+        Number of documents per update request.
+    workers : int
+        Number of concurrent update requests.
+    """
+    session = solr_session(workers)
+    for core, files in CORES.items():
+        name = build_core(core)
+        create_build_core(session, url, core)
+        logger.info(f"  Loading {name}...")
+        start = time.perf_counter()
+        n_docs = load_core(
+            session,
+            url,
+            name,
+            [directory / file for file in files],
+            batch_size,
+            workers,
+        )
+        elapsed = time.perf_counter() - start
+        metrics.add(rows=n_docs)
+        logger.info(
+            f"  {n_docs} documents loaded in {elapsed:.1f}s ({n_docs / elapsed:.0f} docs/s)"
+        )
+
+        n_found = count_documents(session, url, name)
+        if n_found != n_docs:
+            raise RuntimeError(
+                f"{name} has {n_found} documents instead of {n_docs}, not swapped in"
+            )
+        logger.info(f"  Swapping {name} in as {core}...")
+        _core_admin(session, url, action="SWAP", core=core, other=name)
+    session.close()
+
+
+def rollback_cores(url: str = SOLR_URL) -> None:
+    """
+    Swap the previous documents of each live core back in.
+
+    The rolled back documents are kept in the build core, so that a rollback
+    can be undone by calling this function again.
+    """
+    session = solr_session()
+    for core in CORES:
+        name = build_core(core)
+        if not _core_admin(session, url, action="STATUS", core=name)["status"].get(
+            name
+        ):
+            raise RuntimeError(f"No previous documents of {core} to roll back to")
+        logger.info(f"Rolling back {core}...")
+        _core_admin(session, url, action="SWAP", core=core, other=name)
+    session.close()
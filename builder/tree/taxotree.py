@@ -0,0 +1,438 @@
+"""
+Compact array representation of the NCBI taxonomy tree.
+
+Instead of one ete4 ``Tree`` object (and its ``props`` dictionaries) per taxid,
+the tree is stored as a set of NumPy arrays indexed by node number:
+
+- ``parent`` gives the index of the parent of each node (-1 for the root)
+- ``child_offsets`` / ``children`` give the children of each node in a CSR
+  layout: children of node ``i`` are ``children[child_offsets[i]:child_offsets[i + 1]]``
+- ``rank`` is a code into the interned ``rank_table`` data frame
+- string attributes are stored as Arrow columns in the ``names`` data frame
+"""
+
+import logging
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import polars as pl
+
+logger = logging.getLogger("LifemapBuilder")
+
+NAME_COLUMNS = [
+    "sci_name",
+    "common_name_en",
+    "common_name_fr",
+    "common_name_long_en",
+    "common_name_long_fr",
+    "synonym",
+    "authority",
+]
+
+
+@dataclass
+class TaxoTree:
+    taxid: np.ndarray
+    parent: np.ndarray
+    child_offsets: np.ndarray
+    children: np.ndarray
+    rank: np.ndarray
+    rank_table: pl.DataFrame
+    names: pl.DataFrame
+    nbdesc: np.ndarray | None = field(default=None, repr=False)
+
+    @classmethod
+    def from_parents(
+        cls,
+        taxid: np.ndarray,
+        parent_taxid: np.ndarray,
+        rank: np.ndarray,
+        rank_table: pl.DataFrame,
+        names: pl.DataFrame,
+    ) -> "TaxoTree":
+        """
+        Build a tree from a taxid -> parent taxid edge list.
+
+        Children are kept in the order in which they appear in the edge list,
+        which is the order ete4 used when adding them with ``add_child``.
+
+        Parameters
+        ----------
+        taxid : np.ndarray
+            Taxid of each node.
+        parent_taxid : np.ndarray
+            Taxid of the parent of each node. A node which is its own parent is the root.
+        rank : np.ndarray
+            Rank code of each node, as an index in `rank_table`.
+        rank_table : pl.DataFrame
+            Rank names table, with one column per language.
+        names : pl.DataFrame
+            String attributes of each node, aligned with `taxid`.
+
+        Returns
+        -------
+        TaxoTree
+            The tree.
+        """
+        taxid = taxid.astype(np.int32)
+        lookup = np.full(int(taxid.max()) + 1, -1, dtype=np.int32)
+        lookup[taxid] = np.arange(len(taxid), dtype=np.int32)
+        parent = lookup[parent_taxid]
+        if (parent < 0).any():
+            missing = np.asarray(parent_taxid)[parent < 0][:10]
+            raise ValueError(f"Unknown parent taxids: {missing}")
+        parent[parent == np.arange(len(taxid))] = -1
+
+        children, child_offsets = _csr(parent, np.flatnonzero(parent >= 0))
+
+        return cls(
+            taxid=taxid,
+            parent=parent,
+            child_offsets=child_offsets,
+            children=children,
+            rank=np.asarray(rank),
+            rank_table=rank_table,
+            names=names,
+        )
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.taxid)
+
+    @property
+    def root(self) -> int:
+        return int(np.flatnonzero(self.parent < 0)[0])
+
+    @property
+    def n_children(self) -> np.ndarray:
+        return np.diff(self.child_offsets)
+
+    @property
+    def is_leaf(self) -> np.ndarray:
+        return self.child_offsets[1:] == self.child_offsets[:-1]
+
+    def index(self, taxid: int | str) -> int:
+        """
+        Return the node index of a taxid.
+        """
+        res = np.flatnonzero(self.taxid == int(taxid))
+        if len(res) == 0:
+            raise KeyError(f"Taxid {taxid} not found in tree")
+        return int(res[0])
+
+    def children_of(self, i: int) -> np.ndarray:
+        return self.children[self.child_offsets[i] : self.child_offsets[i + 1]]
+
+    def levels(self, root: int | None = None) -> list[np.ndarray]:
+        """
+        Breadth-first traversal of the subtree rooted at `root`.
+
+        Returns
+        -------
+        list[np.ndarray]
+            Node indexes of each depth level. Concatenating them gives the
+            same order as ete4 "levelorder" traversal.
+        """
+        levels = []
+        frontier = np.array([self.root if root is None else root], dtype=np.int64)
+        while len(frontier) > 0:
+            levels.append(frontier)
+            starts = self.child_offsets[frontier]
+            counts = self.child_offsets[frontier + 1] - starts
+            total = int(counts.sum())
+            if total == 0:
+                break
+            # Positions of all children of the frontier in the children array
+            shift = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            frontier = self.children[np.arange(total) + shift].astype(np.int64)
+        return levels
+
+    def depths(self) -> np.ndarray:
+        """
+        Depth of each node in the tree, the root being at depth 0.
+        """
+        depth = np.zeros(self.n_nodes, dtype=np.int32)
+        for d, level in enumerate(self.levels()):
+            depth[level] = d
+        return depth
+
+    def ancestor_paths(
+        self, base: tuple[int, ...] = ()
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Taxids of the ancestors of each node, from its parent to the root,
+        followed by `base`.
+
+        Paths are computed in a single top-down pass, level by level, the
+        path of each node being its parent followed by the path of its parent.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            Offsets, of length n_nodes + 1, and flat int32 values of the
+            paths: the path of node `i` is `values[offsets[i]:offsets[i + 1]]`.
+        """
+        levels = self.levels()
+        lengths = np.empty(self.n_nodes, dtype=np.int64)
+        for depth, level in enumerate(levels):
+            lengths[level] = depth + len(base)
+        offsets = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        values = np.empty(int(offsets[-1]), dtype=np.int32)
+        taxid = self.taxid.astype(np.int32)
+        values[offsets[self.root] + np.arange(len(base))] = base
+        for depth, level in enumerate(levels[1:], start=1):
+            parent = self.parent[level]
+            values[offsets[level]] = taxid[parent]
+            shift = np.arange(depth - 1 + len(base))
+            values[offsets[level][:, None] + 1 + shift] = values[
+                offsets[parent][:, None] + shift
+            ]
+        return offsets, values
+
+    def leaf_counts(self) -> np.ndarray:
+        """
+        Number of leaves under each node. A leaf counts as one.
+
+        Counts are computed once for all nodes, in a single bottom-up pass
+        level by level from the deepest one, and cached in `nbdesc`.
+        """
+        if self.nbdesc is None:
+            start = time.perf_counter()
+            levels = self.levels()
+            node_depth = np.empty(self.n_nodes, dtype=np.int32)
+            for depth, level in enumerate(levels):
+                node_depth[level] = depth
+            counts = subtree_sums(
+                self.parent, node_depth, self.is_leaf.astype(np.int64)
+            )
+            self.nbdesc = counts
+            logger.info(
+                f"  Leaf counts of {self.n_nodes} nodes computed in {time.perf_counter() - start:.2f}s"
+            )
+        return self.nbdesc
+
+    def take(self, nodes: np.ndarray) -> "TaxoTree":
+        """
+        Build a new tree made of `nodes`, node `nodes[k]` becoming node `k`.
+
+        `nodes[0]` becomes the root of the new tree, and every other node must
+        have its parent in `nodes`. Children keep their relative order.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        new_index = np.full(self.n_nodes, -1, dtype=np.int32)
+        new_index[nodes] = np.arange(len(nodes), dtype=np.int32)
+        parent = new_index[self.parent[nodes]]
+        parent[0] = -1
+        if (parent[1:] < 0).any():
+            raise ValueError("Node list is not closed under the parent relation")
+
+        # Keep siblings in the order they had in the original children array
+        child_position = np.empty(self.n_nodes, dtype=np.int64)
+        child_position[self.children] = np.arange(len(self.children))
+        order = 1 + np.argsort(child_position[nodes[1:]], kind="stable")
+        children, child_offsets = _csr(parent, order)
+
+        return TaxoTree(
+            taxid=self.taxid[nodes],
+            parent=parent,
+            child_offsets=child_offsets,
+            children=children,
+            rank=self.rank[nodes],
+            rank_table=self.rank_table,
+            names=self.names[nodes],
+        )
+
+    def subtree(self, taxid: int | str) -> "TaxoTree":
+        """
+        Extract the subtree rooted at `taxid`, with nodes renumbered in
+        breadth-first order (the root is node 0).
+        """
+        nodes = np.concatenate(self.levels(self.index(taxid)))
+        tree = self.take(nodes)
+        # Leaf counts of a whole subtree don't change
+        tree.nbdesc = self.leaf_counts()[nodes]
+        return tree
+
+    def prune(self, remove: np.ndarray) -> "TaxoTree":
+        """
+        Remove the nodes flagged in the `remove` boolean mask, and all their
+        descendants. The root is always kept.
+        """
+        levels = self.levels()
+        removed = np.asarray(remove, dtype=bool).copy()
+        removed[self.root] = False
+        for level in levels[1:]:
+            removed[level] |= removed[self.parent[level]]
+        keep = np.concatenate(levels)
+        keep = keep[~removed[keep]]
+        return self.take(keep)
+
+    def ancestors(self, i: int) -> list[int]:
+        """
+        Node indexes of the ancestors of `i`, from its parent to the root.
+        """
+        res = []
+        i = self.parent[i]
+        while i >= 0:
+            res.append(int(i))
+            i = self.parent[i]
+        return res
+
+    def rank_names(self, lang: str) -> np.ndarray:
+        """
+        Rank name of each node in the given language.
+        """
+        return self.rank_table.get_column(lang).to_numpy()[self.rank]
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        String attribute `name` of each node.
+        """
+        return self.names.get_column(name).to_numpy()
+
+
+def subtree_sums(
+    parent: np.ndarray, depth: np.ndarray, values: np.ndarray
+) -> np.ndarray:
+    """
+    Sum of a per-node value over the subtree of each node, the node included.
+
+    Sums are computed in a single bottom-up pass: nodes are bucketed by depth,
+    then the sums of each level are added to their parents, from the deepest
+    level up. Several trees can be aggregated at once.
+
+    Parameters
+    ----------
+    parent : np.ndarray
+        Index of the parent of each node, -1 for roots.
+    depth : np.ndarray
+        Depth of each node, roots being at depth 0.
+    values : np.ndarray
+        Value of each node, integer or float.
+
+    Returns
+    -------
+    np.ndarray
+        Subtree sums, as int64 for integer values and float64 otherwise.
+    """
+    sums = np.asarray(values).astype(
+        np.float64 if np.asarray(values).dtype.kind == "f" else np.int64
+    )
+    for level in reversed(_depth_levels(depth)[1:]):
+        sums += np.bincount(
+            parent[level], weights=sums[level], minlength=len(sums)
+        ).astype(sums.dtype)
+    return sums
+
+
+def preorder_intervals(
+    parent: np.ndarray, depth: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Preorder index of each node, and preorder index of the last node of its
+    subtree.
+
+    Node y is in the subtree of node x if and only if
+    ``entry[x] <= entry[y] <= exit[x]``, so that once nodes are sorted by
+    entry, each subtree is a contiguous range. Indexes are computed in a
+    single top-down pass from the subtree sizes: the entry of a node follows
+    the entry of its parent and the subtrees of its previous siblings.
+    Siblings, and trees when there are several, are numbered in the order
+    of their indexes.
+
+    Parameters
+    ----------
+    parent : np.ndarray
+        Index of the parent of each node, -1 for roots.
+    depth : np.ndarray
+        Depth of each node, roots being at depth 0.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Entry and exit preorder indexes, as int64.
+    """
+    sizes = subtree_sums(parent, depth, np.ones(len(parent), dtype=np.int64))
+    entry = np.zeros(len(parent), dtype=np.int64)
+    for d, level in enumerate(_depth_levels(depth)):
+        if d > 0:
+            level = level[np.argsort(parent[level], kind="stable")]
+        level_sizes = sizes[level]
+        # Size of the subtrees of the previous siblings of each node
+        before = np.cumsum(level_sizes) - level_sizes
+        if d == 0:
+            entry[level] = before
+            continue
+        level_parent = parent[level]
+        first = np.flatnonzero(np.r_[True, level_parent[1:] != level_parent[:-1]])
+        before -= np.repeat(before[first], np.diff(np.r_[first, len(level)]))
+        entry[level] = entry[level_parent] + 1 + before
+    return entry, entry + sizes - 1
+
+
+def taxid_positions(keys: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """
+    Position of each query in `keys`, or -1 if absent.
+
+    Keys are unique taxids, and queries are taxids. As taxids are dense
+    enough, positions are looked up in a table indexed by taxid.
+    """
+    table = np.full(
+        int(max(keys.max(initial=0), queries.max(initial=0))) + 1, -1, dtype=np.int64
+    )
+    table[keys] = np.arange(len(keys))
+    return table[queries]
+
+
+def list_series(name: str, offsets: np.ndarray, values: np.ndarray) -> pl.Series:
+    """
+    Build a list series from the offsets and flat values of its lists.
+    """
+    return (
+        pl.DataFrame({"offset": offsets[:-1], "length": np.diff(offsets)})
+        .select(
+            pl.lit(pl.Series(values))
+            .implode()
+            .list.slice(pl.col("offset"), pl.col("length"))
+            .alias(name)
+        )
+        .to_series()
+    )
+
+
+def _depth_levels(depth: np.ndarray) -> list[np.ndarray]:
+    """
+    Indexes of the nodes at each depth, in increasing order.
+    """
+    depth = np.asarray(depth)
+    if len(depth) == 0:
+        return []
+    order = np.argsort(depth, kind="stable")
+    bounds = np.searchsorted(depth[order], np.arange(int(depth.max()) + 2))
+    return [order[bounds[d] : bounds[d + 1]] for d in range(int(depth.max()) + 1)]
+
+
+def _csr(parent: np.ndarray, order: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the CSR children arrays of a tree.
+
+    Parameters
+    ----------
+    parent : np.ndarray
+        Parent index of each node, -1 for the root.
+    order : np.ndarray
+        Non-root node indexes, in the order siblings must appear.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        children and child_offsets arrays.
+    """
+    children = order[np.argsort(parent[order], kind="stable")].astype(np.int32)
+    counts = np.bincount(parent[order], minlength=len(parent))
+    child_offsets = np.zeros(len(parent) + 1, dtype=np.int64)
+    np.cumsum(counts, out=child_offsets[1:])
+    return children, child_offsets
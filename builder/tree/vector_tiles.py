@@ -0,0 +1,518 @@
+"""
+Offline generation of the composite vector tiles in a PMTiles archive.
+
+Features of the poly-layer, ranks-layer and branches-layer layers are built
+from the layout of the tree, and selected in each tile with the same filters
+as the composite tileset of bbox (see back/bbox/bbox.toml.j2), so that the
+archive holds the tiles bbox would serve: up to the last low zoom, polygons
+and branches are the generalized geometries of the tile zoom, as in the
+polygons_lowzoom and branches_lowzoom tables, and they are the full
+resolution ones above. Features are saved as numpy arrays, memory-mapped by
+a pool of processes which encode the tiles by blocks of neighbouring tiles.
+"""
+
+import gzip
+import json
+import logging
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import metrics
+import numpy as np
+from config import BUILD_DIRECTORY
+from geometry import to_web_mercator
+from mvt import EXTENT, GEOM_LINESTRING, GEOM_POLYGON, LayerEncoder, encode_geometries
+from pmtiles_archive import PMTilesWriter
+from taxotree import TaxoTree
+from tqdm import tqdm
+from Traverse import (
+    BRANCH,
+    CHUNK_SIZE,
+    GROUP_ROOTS,
+    LOWZOOM_ZOOMS,
+    POLYGON,
+    RANK,
+    branch_lines,
+    clade_geometries,
+    close_rings,
+    group_layout,
+    lowzoom_branches,
+    lowzoom_rings,
+    record_ids,
+)
+
+logger = logging.getLogger("LifemapBuilder")
+
+PMTILES_FILE = BUILD_DIRECTORY / "lifemap.pmtiles"
+
+# Half width of the web mercator grid, in meters
+ORIGIN = 20037508.342789248
+# buffer_size of bbox layers, in pixels of 256 pixels tiles
+BUFFER_SIZE = 256
+# query_limit of the ranks layer
+RANKS_LIMIT = 100
+# Side of the squares of tiles encoded by each task
+BLOCK_SIZE = 16
+# Above this zoom, coordinates of the longest branches could overflow MVT integers
+MAX_ZOOM = 22
+
+LAYERS = {
+    "poly-layer": GEOM_POLYGON,
+    "ranks-layer": GEOM_LINESTRING,
+    "branches-layer": GEOM_LINESTRING,
+}
+
+# Features of each layer, memory-mapped in worker processes
+_features: dict[str, dict[str, np.ndarray]] = {}
+_rank_names: dict[str, np.ndarray] = {}
+
+
+def visible(
+    layer: str, zoomview: np.ndarray, genzoom: np.ndarray, zoom: int
+) -> np.ndarray:
+    """
+    Mask of the features of a layer displayed at a tile zoom, as in the
+    queries of the composite tileset.
+
+    `genzoom` is the zoom of generalized features, and -1 for full
+    resolution ones.
+    """
+    if layer == "ranks-layer":
+        return (zoomview >= zoom - 4) & (zoomview <= zoom - 2)
+    if zoom in LOWZOOM_ZOOMS:
+        return genzoom == zoom
+    if layer == "poly-layer":
+        return (genzoom < 0) & (zoomview >= zoom - 4) & (zoomview <= zoom + 1)
+    return (genzoom < 0) & (zoomview < zoom + 11)
+
+
+def _pad(coords: np.ndarray, n_points: int) -> np.ndarray:
+    """
+    Repeat the last point of geometries up to `n_points` points, so that
+    geometries of different sizes can be stored in a single array. Repeated
+    points are dropped when tiles are encoded.
+    """
+    return np.concatenate(
+        [coords, np.repeat(coords[:, -1:], n_points - coords.shape[1], axis=1)], axis=1
+    )
+
+
+def _group_features(
+    tree: TaxoTree, groupnb: str, min_zoom: int, max_zoom: int
+) -> dict[str, dict[str, np.ndarray]]:
+    """
+    Features of a group displayed between two zooms, with coordinates in degrees.
+    """
+    t, lay = group_layout(tree, groupnb)
+    zoomview = lay.zoomview.astype(np.int32)
+    ref = int(groupnb)
+    low_zooms = [zoom for zoom in LOWZOOM_ZOOMS if min_zoom <= zoom <= max_zoom]
+    # First zoom of full resolution polygons and branches, if any
+    full_zoom = max(min_zoom, LOWZOOM_ZOOMS.stop)
+    full = max_zoom >= full_zoom
+
+    # Branch from LUCA, as a line of 3 points like other branches, displayed
+    # at all zooms
+    luca = np.array([[[0.0, -4.226497], [lay.x[0], lay.y[0]], [lay.x[0], lay.y[0]]]])
+    luca_zooms = [*low_zooms, *([-1] if full else [])]
+    branches = {
+        "coords": [np.repeat(luca, len(luca_zooms), axis=0)],
+        "id": [record_ids(np.full(len(luca_zooms), t.taxid[0]), BRANCH)],
+        "zoomview": [np.full(len(luca_zooms), 4, dtype=np.int32)],
+        "genzoom": [np.array(luca_zooms, dtype=np.int32)],
+    }
+    nodes = np.flatnonzero(t.parent >= 0)
+    if full:
+        shown = nodes[zoomview[nodes] < max_zoom + 11]
+        branches["coords"].append(branch_lines(lay, shown, t.parent[shown]))
+        branches["id"].append(record_ids(t.taxid[shown], BRANCH))
+        branches["zoomview"].append(zoomview[shown])
+        branches["genzoom"].append(np.full(len(shown), -1, dtype=np.int32))
+    for start in range(0, len(nodes) if low_zooms else 0, CHUNK_SIZE):
+        chunk = nodes[start : start + CHUNK_SIZE]
+        for zoom, group, coords in lowzoom_branches(lay, chunk, t.parent[chunk]):
+            if zoom in low_zooms:
+                branches["coords"].append(_pad(coords, 3))
+                branches["id"].append(record_ids(t.taxid[chunk[group]], BRANCH))
+                branches["zoomview"].append(zoomview[chunk[group]])
+                branches["genzoom"].append(np.full(len(group), zoom, dtype=np.int32))
+
+    # Ranks are displayed on a subset of the zoomviews of full resolution
+    # polygons
+    clades = np.flatnonzero(
+        ~t.is_leaf & (zoomview >= min_zoom - 4) & (zoomview <= max_zoom + 1)
+    )
+    rings, rank_lines, convexity = [], [], []
+    for start in range(0, len(clades), CHUNK_SIZE):
+        chunk = clades[start : start + CHUNK_SIZE]
+        geom = clade_geometries(
+            lay.x[chunk], lay.y[chunk], lay.ray[chunk], lay.alpha[chunk]
+        )
+        rings.append(close_rings(geom.rings))
+        rank_lines.append(geom.rank_lines)
+        convexity.append(geom.convexity)
+    rings = np.concatenate(rings) if rings else np.empty((0, 60, 2))
+    shown = (zoomview[clades] >= full_zoom - 4) & full
+    polygons = {
+        "coords": [rings[shown]],
+        "id": [record_ids(t.taxid[clades[shown]], POLYGON)],
+        "zoomview": [zoomview[clades[shown]]],
+        "nbdesc": [lay.nbdesc[clades[shown]]],
+        "taxid": [t.taxid[clades[shown]].astype(str)],
+        "genzoom": [np.full(int(shown.sum()), -1, dtype=np.int32)],
+    }
+    if low_zooms:
+        low_clades = np.flatnonzero(~t.is_leaf & (zoomview <= max(low_zooms) + 1))
+        for zoom, group, low_rings in lowzoom_rings(lay, low_clades):
+            if zoom in low_zooms:
+                polygons["coords"].append(low_rings)
+                polygons["id"].append(record_ids(t.taxid[low_clades[group]], POLYGON))
+                polygons["zoomview"].append(zoomview[low_clades[group]])
+                polygons["nbdesc"].append(lay.nbdesc[low_clades[group]])
+                polygons["taxid"].append(t.taxid[low_clades[group]].astype(str))
+                polygons["genzoom"].append(np.full(len(group), zoom, dtype=np.int32))
+    n_points = max(coords.shape[1] for coords in polygons["coords"])
+    polygons["coords"] = [_pad(coords, n_points) for coords in polygons["coords"]]
+    polygons = {name: np.concatenate(values) for name, values in polygons.items()}
+    branches = {name: np.concatenate(values) for name, values in branches.items()}
+
+    ranks = {
+        "coords": np.concatenate(rank_lines) if rank_lines else np.empty((0, 3, 2)),
+        "id": record_ids(t.taxid[clades], RANK),
+        "zoomview": zoomview[clades],
+        "taxid": t.taxid[clades].astype(str),
+        "convex": np.concatenate(convexity) if convexity else np.empty(0),
+        "rank_en": t.rank_names("en")[clades],
+        "rank_fr": t.rank_names("fr")[clades],
+    }
+    shown = ranks["zoomview"] <= max_zoom - 2
+    ranks = {name: values[shown] for name, values in ranks.items()}
+    ranks["genzoom"] = np.full(int(shown.sum()), -1, dtype=np.int32)
+
+    layers = {"poly-layer": polygons, "ranks-layer": ranks, "branches-layer": branches}
+    for features in layers.values():
+        features["ref"] = np.full(len(features["id"]), ref, dtype=np.int8)
+    return layers
+
+
+def save_features(
+    tree: TaxoTree, directory: Path, min_zoom: int, max_zoom: int
+) -> tuple[float, float, float, float]:
+    """
+    Build the features of all groups and save them as numpy arrays.
+
+    Polygons are sorted by decreasing number of descendants and branches by
+    zoomview, as in the queries of the composite tileset. Coordinates are
+    projected to EPSG:3857, and rank names are encoded as indexes in lists
+    saved in rank_names.json.
+
+    Returns
+    -------
+    tuple[float, float, float, float]
+        Bounds of the features, as min lon, min lat, max lon, max lat.
+    """
+    groups = [
+        _group_features(tree, groupnb, min_zoom, max_zoom) for groupnb in GROUP_ROOTS
+    ]
+
+    rank_names = {}
+    lower, upper = [], []
+    for layer in LAYERS:
+        features = {
+            name: np.concatenate([group[layer][name] for group in groups])
+            for name in groups[0][layer]
+        }
+        if layer == "poly-layer":
+            order = np.argsort(-features.pop("nbdesc"), kind="stable")
+        elif layer == "branches-layer":
+            order = np.argsort(features["zoomview"], kind="stable")
+        else:
+            order = np.arange(len(features["id"]))
+            for lang in ("en", "fr"):
+                rank_names[lang], features[f"rank_{lang}"] = np.unique(
+                    features[f"rank_{lang}"], return_inverse=True
+                )
+        if len(order) > 0:
+            lower.append(features["coords"].min(axis=(0, 1)))
+            upper.append(features["coords"].max(axis=(0, 1)))
+        features["coords"] = to_web_mercator(features["coords"])
+        features["bounds"] = np.concatenate(
+            (features["coords"].min(axis=1), features["coords"].max(axis=1)), axis=1
+        )
+        for name, values in features.items():
+            np.save(directory / f"{layer}.{name}.npy", values[order])
+
+    with open(directory / "rank_names.json", "w") as f:
+        json.dump({lang: names.tolist() for lang, names in rank_names.items()}, f)
+    (min_lon, min_lat), (max_lon, max_lat) = (
+        np.min(lower, axis=0),
+        np.max(upper, axis=0),
+    )
+    return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
+
+def _load_features(directory: str) -> None:
+    """
+    Memory-map the features in a worker process.
+    """
+    for layer in LAYERS:
+        _features[layer] = {
+            path.name.split(".")[1]: np.load(path, mmap_mode="r")
+            for path in Path(directory).glob(f"{layer}.*.npy")
+        }
+    with open(Path(directory) / "rank_names.json") as f:
+        _rank_names.update(
+            {lang: np.array(names) for lang, names in json.load(f).items()}
+        )
+
+
+def _properties(layer: str, selected: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Properties of features, as selected by the composite tileset queries.
+    """
+    features = _features[layer]
+    flag = np.ones(len(selected), dtype=bool)
+    if layer == "poly-layer":
+        return {
+            "ref": features["ref"][selected],
+            "zoomview": features["zoomview"][selected],
+            "clade": flag,
+            "taxid": features["taxid"][selected],
+        }
+    if layer == "ranks-layer":
+        return {
+            "ref": features["ref"][selected],
+            "zoomview": features["zoomview"][selected],
+            "rankname": flag,
+            "rank_en": _rank_names["en"][features["rank_en"][selected]],
+            "rank_fr": _rank_names["fr"][features["rank_fr"][selected]],
+            "convex": features["convex"][selected],
+            "taxid": features["taxid"][selected],
+        }
+    return {
+        "ref": features["ref"][selected],
+        "branch": flag,
+        "zoomview": features["zoomview"][selected],
+    }
+
+
+def _intersecting(
+    bounds: np.ndarray, box: tuple[float, float, float, float]
+) -> np.ndarray:
+    xmin, ymin, xmax, ymax = box
+    return (
+        (bounds[:, 0] <= xmax)
+        & (bounds[:, 2] >= xmin)
+        & (bounds[:, 1] <= ymax)
+        & (bounds[:, 3] >= ymin)
+    )
+
+
+def encode_tile(
+    zoom: int, x: int, y: int, candidates: dict[str, np.ndarray]
+) -> bytes | None:
+    """
+    Encode a tile from the features of each layer which may intersect it.
+
+    Returns
+    -------
+    bytes | None
+        Gzipped MVT tile, or None if the tile is empty.
+    """
+    size = 2 * ORIGIN / 2**zoom
+    buffer = size * BUFFER_SIZE / 256
+    xmin = -ORIGIN + x * size
+    ymax = ORIGIN - y * size
+    box = (xmin - buffer, ymax - size - buffer, xmin + size + buffer, ymax + buffer)
+
+    layers = []
+    for layer, geom_type in LAYERS.items():
+        features = _features[layer]
+        selected = candidates[layer]
+        selected = selected[_intersecting(features["bounds"][selected], box)]
+        if layer == "ranks-layer":
+            selected = selected[:RANKS_LIMIT]
+        coords = features["coords"][selected]
+        tile_coords = np.stack(
+            (
+                (coords[..., 0] - xmin) * EXTENT / size,
+                (ymax - coords[..., 1]) * EXTENT / size,
+            ),
+            axis=-1,
+        )
+        tile_coords = np.rint(tile_coords).astype(np.int64)
+        encoder = LayerEncoder(layer)
+        encoder.add_features(
+            features["id"][selected],
+            geom_type,
+            encode_geometries(geom_type, tile_coords),
+            _properties(layer, selected),
+        )
+        if encoder.features:
+            layers.append(encoder.encode())
+    if not layers:
+        return None
+    return gzip.compress(b"".join(layers), mtime=0)
+
+
+def _encode_block(
+    zoom: int, x0: int, y0: int, x1: int, y1: int
+) -> list[tuple[int, int, bytes]]:
+    """
+    Encode the non empty tiles of a block of tiles, x in [x0, x1[ and y in [y0, y1[.
+    """
+    size = 2 * ORIGIN / 2**zoom
+    buffer = size * BUFFER_SIZE / 256
+    box = (
+        -ORIGIN + x0 * size - buffer,
+        ORIGIN - y1 * size - buffer,
+        -ORIGIN + x1 * size + buffer,
+        ORIGIN - y0 * size + buffer,
+    )
+    candidates = {}
+    for layer, features in _features.items():
+        shown = visible(
+            layer, features["zoomview"], features["genzoom"], zoom
+        ) & _intersecting(features["bounds"], box)
+        candidates[layer] = np.flatnonzero(shown)
+
+    tiles = []
+    if all(len(indexes) == 0 for indexes in candidates.values()):
+        return tiles
+    for x in range(x0, x1):
+        for y in range(y0, y1):
+            data = encode_tile(zoom, x, y, candidates)
+            if data is not None:
+                tiles.append((x, y, data))
+    return tiles
+
+
+def _blocks(
+    zoom: int, bounds: tuple[float, float, float, float]
+) -> list[tuple[int, int, int, int, int]]:
+    """
+    Blocks of tiles of a zoom covering the bounds of the features.
+    """
+    n = 2**zoom
+    (xmin, ymin), (xmax, ymax) = to_web_mercator(np.array([bounds[:2], bounds[2:]]))
+    size = 2 * ORIGIN / n
+    x_start = max(int((xmin + ORIGIN) // size) - 1, 0)
+    x_end = min(int((xmax + ORIGIN) // size) + 2, n)
+    y_start = max(int((ORIGIN - ymax) // size) - 1, 0)
+    y_end = min(int((ORIGIN - ymin) // size) + 2, n)
+    return [
+        (zoom, x, y, min(x + BLOCK_SIZE, x_end), min(y + BLOCK_SIZE, y_end))
+        for x in range(x_start, x_end, BLOCK_SIZE)
+        for y in range(y_start, y_end, BLOCK_SIZE)
+    ]
+
+
+def write_pmtiles(
+    tree: TaxoTree,
+    min_zoom: int = 0,
+    max_zoom: int = 8,
+    workers: int = 1,
+    disable_progress: bool = False,
+) -> None:
+    """
+    Generate the composite vector tiles of a range of zooms into PMTILES_FILE.
+
+    Parameters
+    ----------
+    tree : TaxoTree
+        Global tree.
+    min_zoom, max_zoom : int
+        Zoom levels of the generated tiles.
+    workers : int
+        Number of processes encoding tiles.
+    disable_progress : bool
+        If True, disable progress bars
+    """
+    if not 0 <= min_zoom <= max_zoom <= MAX_ZOOM:
+        raise ValueError(
+            f"Vector tiles zooms must be between 0 and {MAX_ZOOM}, got {min_zoom} to {max_zoom}"
+        )
+
+    with tempfile.TemporaryDirectory(dir=BUILD_DIRECTORY) as directory:
+        logger.info("Building tiles features...")
+        bounds = save_features(tree, Path(directory), min_zoom, max_zoom)
+        blocks = [
+            block
+            for zoom in range(min_zoom, max_zoom + 1)
+            for block in _blocks(zoom, bounds)
+        ]
+
+        logger.info(f"Encoding tiles of zooms {min_zoom} to {max_zoom}...")
+        start = time.perf_counter()
+        n_tiles = dict.fromkeys(range(min_zoom, max_zoom + 1), 0)
+        # Workers are spawned, as forking a process which already used polars
+        # threads may deadlock
+        with (
+            PMTilesWriter(PMTILES_FILE) as writer,
+            ProcessPoolExecutor(
+                max_workers=max(workers, 1),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_features,
+                initargs=(directory,),
+            ) as pool,
+            tqdm(total=len(blocks), disable=disable_progress) as progress,
+        ):
+            futures = {pool.submit(_encode_block, *block): block[0] for block in blocks}
+            for future in as_completed(futures):
+                zoom = futures[future]
+                for x, y, data in future.result():
+                    writer.add_tile(zoom, x, y, data)
+                    n_tiles[zoom] += 1
+                progress.update()
+            elapsed = time.perf_counter() - start
+
+            metadata = {
+                "name": "lifemap",
+                "format": "pbf",
+                "vector_layers": [
+                    {
+                        "id": "poly-layer",
+                        "fields": {
+                            "ref": "Number",
+                            "zoomview": "Number",
+                            "clade": "Boolean",
+                            "taxid": "String",
+                        },
+                    },
+                    {
+                        "id": "ranks-layer",
+                        "fields": {
+                            "ref": "Number",
+                            "zoomview": "Number",
+                            "rankname": "Boolean",
+                            "rank_en": "String",
+                            "rank_fr": "String",
+                            "convex": "Number",
+                            "taxid": "String",
+                        },
+                    },
+                    {
+                        "id": "branches-layer",
+                        "fields": {
+                            "ref": "Number",
+                            "branch": "Boolean",
+                            "zoomview": "Number",
+                        },
+                    },
+                ],
+            }
+            writer.finalize(metadata, min_zoom, max_zoom, bounds)
+            n_contents, size = len(writer.contents), writer.size
+
+    for zoom, count in n_tiles.items():
+        logger.info(f"  Zoom {zoom}: {count} tiles")
+    total = sum(n_tiles.values())
+    metrics.add(rows=total)
+    logger.info(
+        f"  {total} tiles ({n_contents} distinct, {size / 1024**2:.1f} MB) encoded in {elapsed:.1f}s, "
+        f"{total / max(elapsed, 1e-9):.0f} tiles/s"
+    )
+    logger.info(f"  Written to {PMTILES_FILE}")
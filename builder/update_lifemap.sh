@@ -13,6 +13,14 @@ echo "Builder started at `date`"
 echo "- RESTARTING CONTAINERS"
 docker compose -f ~/back/docker-compose.yml restart
 
+# Solr documents are loaded by the builder into the taxo_build and
+# addi_build cores, then swapped in. Instance directories of these cores
+# are created on first use with the configuration of the live cores.
+echo "- PREPARING SOLR BUILD CORES"
+for core in taxo addi; do
+    docker exec $SOLR_CONTAINER sh -c "test -d /var/solr/data/${core}_build || (mkdir /var/solr/data/${core}_build && cp -r /var/solr/data/${core}/conf /var/solr/data/${core}_build/)"
+done
+
 echo "- BUILD TREE"
 uv run python tree/Main.py --disable-progress
 
@@ -22,28 +30,13 @@ mkdir -p $WWW_STATIC_DIR/data
 cp $BUILD_RESULTS_DIR/lmdata/* $WWW_STATIC_DIR/data
 cp $BUILD_RESULTS_DIR/metadata.json $WWW_STATIC_DIR/
 
-# Update Solr
-echo "- UPDATING SOLR"
-echo "-- deleting taxo collection content"
-echo "Deleting taxo..."
-curl --user solr:$SOLR_PASSWD http://localhost:8983/solr/taxo/update -H 'Content-type:application/xml' -d '<delete><query>*:*</query></delete>' -o /dev/null
-echo "Deleting addi..."
-curl --user solr:$SOLR_PASSWD http://localhost:8983/solr/addi/update -H 'Content-type:application/xml' -d '<delete><query>*:*</query></delete>' -o /dev/null
-echo "-- Uploading tree features"
-for num in $(seq 1 3); do
-    echo "Uploading TreeFeatures${num}..."
-    curl --user solr:$SOLR_PASSWD http://localhost:8983/solr/taxo/update -H 'Content-type:application/json' -T $BUILD_RESULTS_DIR/TreeFeatures${num}.json -X POST -o /dev/null | cat
-done
-echo "-- Uploading additional informations"
-for num in $(seq 1 3); do
-    echo "Uploading ADDITIONAL.${num}..."
-    curl --user solr:$SOLR_PASSWD http://localhost:8983/solr/addi/update -H 'Content-type:application/json' -T $BUILD_RESULTS_DIR/ADDITIONAL.${num}.json -X POST -o /dev/null | cat
-done
-echo "-- Committing changes"
-echo "Committing taxo changes..."
-curl --user solr:$SOLR_PASSWD http://localhost:8983/solr/taxo/update?commit=true -o /dev/null
-echo "Committing addi changes..."
-curl --user solr:$SOLR_PASSWD http://localhost:8983/solr/addi/update?commit=true -o /dev/null
+# Publish the vector tiles archive, unless the build skipped it. The archive
+# is replaced atomically as clients read it by ranges.
+if [ -f $BUILD_RESULTS_DIR/lifemap.pmtiles ]; then
+    echo "- COPYING lifemap.pmtiles TO WEB ROOT"
+    cp $BUILD_RESULTS_DIR/lifemap.pmtiles $WWW_STATIC_DIR/lifemap.pmtiles.tmp
+    mv $WWW_STATIC_DIR/lifemap.pmtiles.tmp $WWW_STATIC_DIR/lifemap.pmtiles
+fi
 
 # Restart Caddy to clean cache
 echo "-- Restart Caddy"